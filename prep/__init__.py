@@ -1,3 +1,4 @@
-from .source import *
-from .build_rec import *
-from .auto import *
\ No newline at end of file
+from .lazy import lazy_exports
+
+# the names of these modules are exported, each is imported the first time one of its names is used
+__getattr__, __dir__ = lazy_exports(__name__,['source','build_rec','fetch','identity','prefilter','auto'])
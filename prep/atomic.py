@@ -0,0 +1,23 @@
+import os
+
+def write_atomic(path, content, mode='w'):
+    '''
+    Writes a file through a temporary file next to it that replaces it at the end, so readers never see half of it and a crash leaves the previous version.
+
+    Parameters
+    ----------
+    path : str
+        The file. Missing directories are created.
+    content : str, bytes or callable
+        What to write, or a function that writes to the open file, e.g. lambda f: np.save(f,a).
+    mode : str, optional
+        Mode the temporary file is opened with, 'wb' for bytes. The default is 'w'.
+    '''
+    os.makedirs(os.path.dirname(os.path.abspath(path)),exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp,mode) as f:
+        if callable(content):
+            content(f)
+        else:
+            f.write(content)
+    os.replace(tmp,path)
@@ -1,95 +1,390 @@
-from prep.source import *
+import numpy as np
+import pandas as pd
 from astropy.time import Time
-import tempfile
-import os
-import glob
+import astropy.units as u
+from prep.source import alerce_api, antares, yse
+from prep.source.store import lc_store, get_fit_store
+from prep.source.salt import warm_cache
+from prep.source.table import get_bandflux_table
+import threading
+from prep.fetch import fetch_all, candidate_name
+from prep.fetch import fetch_limits as fetch_defaults
+from prep.identity import candidate_groups
+from prep.prefilter import candidate_filter
+from prep.pool import fit_pool
+from prep.metrics import get_metrics, reset_metrics
 from prep.build_rec import post as pst
+from prep.outbox import get_outbox
 from prep.build_rec import build_rec as bs
+from prep.cli import main
 import time
 
 
 
 
-def run(sources=['antares','alerce','yse'],post=True):
-    ps= []
+def fit_object(obj,cache=True,warm=False,extra=None,method='minuit'):
+    '''
+    Runs the SALT3 fit on an object whose light curve has been fetched and builds the recommendation string. Module level so it can be sent to a process pool.
+
+    Parameters
+    ----------
+    obj : prep.source object
+        Object returned by prep.fetch.fetch_object.
+    cache : bool, optional
+        If True, reuses a stored fit when the photometry has not changed, see prep.source.store.fit_store. The default is True.
+    warm : bool, optional
+        If True, warm starts the fit from the object's previous solution. Needs cache. The default is False.
+    extra : list of prep.source.photometry.lightcurve, optional
+        Photometry of the same object from other sources to fit together with its own. The default is None.
+    method : str, optional
+        Fitting method, 'minuit', 'grid' or 'table', see prep.source.salt.fit_salt3. The default is 'minuit'.
+
+    Returns
+    -------
+    string : str or None
+        The recommendation string, or None if the fit failed.
+    '''
+    try:
+        with get_metrics().timer('fit'):
+            obj.salt3(cache=get_fit_store() if cache else None,warm=warm,extra=extra,method=method)
+        return bs(obj).string
+    except Exception as e:
+        print(f'failed on {obj.name}\n{e}')
+        return
+
+
+def fit_task(obj,cache=True,warm=False,extra=None,method='minuit'):
+    '''
+    fit_object for a worker process. The metrics of the fit are collected separately and returned with it so the parent can merge them.
+
+    Returns
+    -------
+    string : str or None
+        The recommendation string, or None if the fit failed.
+    metrics : dict
+        prep.metrics.run_metrics.snapshot() of the fit.
+    '''
+    m = reset_metrics()
+    return fit_object(obj,cache,warm,extra,method), m.snapshot()
+
+
+def get_candidates(sources=['antares','alerce','yse'],min_prob=None,antares_budget=None,since=None):
+    '''
+    Queries each source for new candidates.
+
+    Parameters
+    ----------
+    sources : list of str, optional
+        Sources to query. The default is ['antares','alerce','yse'].
+    min_prob : float, optional
+        If given, ALeRCE candidates whose lc_classifier top class is not SNIa with at least this probability are dropped before their detections are fetched. The default is None.
+    antares_budget : dict, optional
+        Limits of the ANTARES stream, e.g. {'max_candidates':100,'max_time':600}, see prep.source.antares.antares_stream. The default is None which uses its defaults.
+    since : dict, optional
+        Per source, only candidates with a detection at or after this MJD are returned: ALeRCE by lastmjd, ANTARES by newest_alert_observation_time and YSE by latest_detection. A missing source or None means no limit. The default is None.
+
+    Returns
+    -------
+    candidates : list of tuple
+        (source, item) pairs in the order they should be fitted. See prep.fetch.fetch_object.
+    '''
+    metrics = get_metrics()
+    since = since or {}
+    candidates = []
     if 'alerce' in sources:
-        aq=alerce_api.query_alerce()
-        for i in range(aq['oid'].values.size):
-            try:
-                ao=alerce_api.alerce_object(aq.iloc[i])
-                ao.get_lc()
-                ao.salt3()
-                ps.append(bs(ao).string)
-            except Exception as e:
-                print(f'failed on {aq.iloc[i].oid}\n{e}')
-                continue
-    
+        with metrics.timer('query_alerce'):
+            # every page of the query, the next one is fetched while this one is gated
+            n = kept = 0
+            query = alerce_api.default_query(since=since.get('alerce'))
+            for aq in alerce_api.iter_alerce(query):
+                n += len(aq)
+                if min_prob is not None and len(aq):
+                    # read from the page when the query filtered by class, else one request per page, cached for get_top_class
+                    top = alerce_api.page_probabilities(aq,query)
+                    ok = top.index[[alerce_api.class_gate(t,min_prob) for t in zip(top.class_name,top.probability)]]
+                    aq = aq[aq.oid.isin(ok)]
+                kept += len(aq)
+                for i in range(aq['oid'].values.size):
+                    candidates.append(('alerce',aq.iloc[i]))
+            if min_prob is not None:
+                print(f'class gate dropped {n-kept} of {n} ALeRCE candidates')
+
     if 'antares' in sources:
-        today = Time.now()
-        query = (
-        Search()
-        .filter("range", **{"properties.num_mag_values": {"gte": 4, "lte": 100}})
-        .filter('range',**{'properties.oldest_alert_observation_time': {"gte":(today-7*u.day).mjd}})
-        #.filter("term", tags="extragalactic")
-        # .filter("term", tags="high_amplitude_transient_candidate")
-        .to_dict()
-        )
-        aq=antares.query_antares(query)
-        j=0
-        for locus in aq:
-            if j>50:
-                break
-            try:
-                ao=antares.antares_object(locus)
-                print(ao.name)
-                ao.get_lc()
-                ao.salt3()
-                ps.append(bs(ao).string)
-            except Exception as e:
-                print(f'failed on {locus.properties["ztf_object_id"]}'+'\n'+str(e))
-                
-            j+=1
-    
+        with metrics.timer('query_antares'):
+            from elasticsearch_dsl import Search
+            today = Time.now()
+            query = (
+            Search()
+            .filter("range", **{"properties.num_mag_values": {"gte": 4, "lte": 100}})
+            .filter('range',**{'properties.oldest_alert_observation_time': {"gte":(today-7*u.day).mjd}})
+            #.filter("term", tags="extragalactic")
+            # .filter("term", tags="high_amplitude_transient_candidate")
+            )
+            if since.get('antares') is not None:
+                query = query.filter('range',**{'properties.newest_alert_observation_time': {"gte":since['antares']}})
+            query = query.to_dict()
+            # loci are downloaded and converted here, within the budget
+            stream = antares.antares_stream(query,**(antares_budget or {}))
+            for obj in stream:
+                candidates.append(('antares',obj))
+            print(stream.report())
+
     if 'yse' in sources:
-        # maybe introduce temp file to save csv
-        with tempfile.TemporaryDirectory() as td:
-            yq = yse.young_and_fast(td)
-            gp = glob.glob(os.path.join(td,'YSE_*.csv'))[0]
-            qd=pd.read_csv(gp,skiprows=1,names=['name','classification','first_detection','latest_detection','number_of_detection','group_name'])
-        qd.sort_values(by='number_of_detection',ascending=False,inplace=True)
-        f4=qd.query('number_of_detection>=4')
-        for name in f4.name.values:
-            try:
-                y1=yse.yse_object(name)
-                y1.get_lc()
-                y1.salt3()
-                ps.append(bs(y1).string)
-            except Exception as e:
-                print(f'failed on {name}\n{e}')
-                continue
+        with metrics.timer('query_yse'):
+            qd = yse.young_and_fast()
+            qd.sort_values(by='number_of_detection',ascending=False,inplace=True)
+            f4=qd.query('number_of_detection>=4')
+            # MJD of the latest detection tells the light curve store if a download is needed
+            latest = (pd.to_datetime(f4.latest_detection,errors='coerce',utc=True)-pd.Timestamp('1858-11-17',tz='UTC'))/pd.Timedelta(days=1)
+            if since.get('yse') is not None:
+                # the explorer query has no time parameter, objects without a date are kept
+                new = ~(latest < since['yse'])
+                f4, latest = f4[new], latest[new]
+            for name, last_mjd in zip(f4.name.values,latest.values):
+                candidates.append(('yse',(name,None if np.isnan(last_mjd) else float(last_mjd))))
+    return candidates
+
+
+def run(sources=['antares','alerce','yse'],post=True,workers=1,fetch_limits=None,cache=True,warm=False,match_radius=2.0,combine=False,method='minuit',prefilter=False,cuts=None,min_prob=None,antares_budget=None,fit_timeout=None,deadline=None,report=None,prometheus=None,post_wait=300,poll=None):
+    '''
+    Queries the sources, fits every candidate and posts the recommendations to Slack.
 
+    Parameters
+    ----------
+    sources : list of str, optional
+        Sources to query. The default is ['antares','alerce','yse'].
+    post : bool, optional
+        If True, posts the recommendations to Slack. The default is True.
+    workers : int, optional
+        Number of worker processes used for fitting. The default is 1 which fits in this process.
+    fetch_limits : dict, optional
+        Maximum concurrent light curve downloads per source, e.g. {'alerce':2}. The default is None which uses prep.fetch.fetch_limits.
+    cache : bool, optional
+        If True, light curves are kept in an on-disk lc_store and only downloaded again when the source reports newer detections, and fits of unchanged photometry are reused from a fit_store. The default is True.
+    warm : bool, optional
+        If True, fits start from each object's previous solution with narrowed bounds, falling back to a cold fit when needed. Needs cache. The default is False.
+    match_radius : float, optional
+        Candidates within this many arcseconds of each other, or sharing a ZTF, ANTARES, TNS or YSE name, are fetched and fitted once. The default is 2.
+    combine : bool, optional
+        If True, the photometry of every source an object was found in is fitted together. The default is False.
+    method : str, optional
+        'minuit' fits each object with sncosmo.fit_lc, 'grid' searches a redshift, color and t0 grid first and polishes the best cell, which is less prone to local minima in z. 'table' does the same with precomputed bandfluxes, see prep.source.table. The default is 'minuit'.
+    prefilter : bool, optional
+        If True, candidates whose light curves are clearly not young SNe Ia are dropped before fitting, see prep.prefilter.candidate_filter. The default is False.
+    cuts : dict, optional
+        Prefilter thresholds that replace the defaults in prep.prefilter.prefilter_cuts. The default is None.
+    min_prob : float, optional
+        Minimum ALeRCE lc_classifier SNIa probability of ALeRCE candidates, checked for all of them in bulk before any detections are fetched. The default is None which keeps all of them.
+    antares_budget : dict, optional
+        Limits on the number of converted ANTARES loci, the time spent on them and the loci downloaded at once, see prep.source.antares.antares_stream. The number in flight defaults to the ANTARES fetch limit. The default is None.
+    fit_timeout : float, optional
+        Seconds a single fit may take. A fit that overruns is killed and skipped. The default is None for no limit.
+    deadline : float, optional
+        Seconds the whole run may take. Downloads and fits still running then are abandoned, the results so far are posted and the rest is reported as skipped. The ANTARES stream gets the same time limit unless antares_budget sets one. With a fit_timeout or deadline, fits run in worker processes even with workers=1. The default is None for no limit.
+    report : str, optional
+        Path of a JSON file the stage latencies, failures by exception type, downloaded bytes and fit iterations of the run are written to, see prep.metrics.run_metrics.report. The default is None.
+    prometheus : str, optional
+        Path of a Prometheus textfile with the same metrics, e.g. in the directory of the node_exporter textfile collector. The default is None.
+    post_wait : float, optional
+        Seconds to wait for Slack at the end of the run. Messages that could not be posted by then, e.g. because of a rate limit, are kept in the outbox of prep.outbox and sent later. The default is 300.
+    poll : prep.poll.poll_state, optional
+        If given, the sources are only queried for objects detected since the last poll and only new candidates, or ones with new detections, are fitted. The state is updated once the run finished, with the candidates that were fitted, dropped by the prefilter or merged into another, so failed downloads and fits and candidates cut off by the deadline are tried again by the next polls, up to max_retries of the poll_state. The default is None which queries the whole 7 day window, see run_continuous.
+    '''
+    metrics = reset_metrics()
     if post:
-        ps = '\n'.join(ps)
-        pst(ps,channel='D041VTL9LRY')
+        # sends what an earlier run left in the outbox while this one works
+        get_outbox()
+    # YSE-PZ lookups are memoized for the length of one run
+    yse.reset_yse_client()
+    store = lc_store() if cache else None
+    if method == 'table':
+        # built once here, workers memory-map the file
+        get_bandflux_table()
+    start = time.monotonic()
+    stop = None if deadline is None else start+deadline
+    antares_budget = dict(antares_budget or {})
+    antares_budget.setdefault('max_inflight',dict(fetch_defaults,**(fetch_limits or {}))['antares'])
+    if deadline is not None:
+        antares_budget.setdefault('max_time',deadline)
+    if poll is None:
+        candidates = get_candidates(sources,min_prob,antares_budget)
+    else:
+        candidates = poll.new(get_candidates(sources,min_prob,antares_budget,poll.since(sources)))
+        print(f'{len(candidates)} new or updated candidates')
+    groups = candidate_groups(candidates,radius=match_radius,combine=combine)
+    for i, dups in groups.duplicates().items():
+        print(f'{candidate_name(*candidates[i])} also found as '+', '.join(candidate_name(*candidates[j]) for j in dups))
+    tofetch = groups.to_fetch()
+    filt = candidate_filter(cuts) if prefilter else None
+    fetched = [0]
+    rejected = []
+
+    def more():
+        # a group whose preferred member failed to download falls back to its next one
+        nxt = groups.next_fetch()
+        tofetch.extend(nxt)
+        return [candidates[i] for i in nxt]
+
+    def ready():
+        # yields (index, object, extra light curves) once a group can be fitted
+        for k, obj in fetch_all([candidates[i] for i in tofetch],fetch_limits,store,deadline=stop,more=more):
+            fetched[0] += 1
+            r = groups.arrived(tofetch[k],obj)
+            if r is None:
+                continue
+            if filt is not None and not filt.keep_object(r[1],r[2]):
+                print(f'prefilter dropped {r[1].name}')
+                rejected.append(r[0])
+                continue
+            yield r
+
+    results = [None]*len(candidates)
+    timed_out, skipped = [], []
+    if (workers is None or workers <= 1) and fit_timeout is None and deadline is None:
+        for i, obj, extra in ready():
+            results[i] = fit_object(obj,cache,warm,extra,method)
+    else:
+        # warm_cache loads the SALT3 model and bandpasses once per worker.
+        # forkserver keeps workers from being forked out of the threaded fetch stage.
+        # Workers are separate processes so a fit past fit_timeout or the deadline can be killed.
+        with fit_pool(workers or 1,fit_timeout,warm_cache,preload=['prep.auto']) as pool:
+            def submit():
+                # fits start as soon as each light curve arrives
+                try:
+                    for i, obj, extra in ready():
+                        pool.submit(i,fit_task,obj,cache,warm,extra,method)
+                finally:
+                    pool.close()
+            feeder = threading.Thread(target=submit,daemon=True)
+            feeder.start()
+            for i, status, value in pool.results(stop):
+                if status == 'done':
+                    results[i] = value[0]
+                    metrics.merge(value[1])
+                elif status == 'error':
+                    print(f'failed on {candidate_name(*candidates[i])}\n{value}')
+                    metrics.observe('fit',0.,value.split(':')[0])
+                elif status == 'timeout':
+                    print(f'fit of {candidate_name(*candidates[i])} timed out after {fit_timeout} s')
+                    metrics.observe('fit',fit_timeout,'Timeout')
+            feeder.join()
+            timed_out, skipped = pool.timed_out, pool.skipped
+    if store is not None:
+        store.close()
+    if filt is not None:
+        print(filt.report())
+    ps = [r for r in results if r is not None]
+    # candidates the deadline cut off, either before their download finished or before their fit
+    unfetched = len(tofetch)-fetched[0]
+    notes = []
+    if unfetched or skipped:
+        notes.append(f'run deadline of {deadline} s reached: {unfetched} candidates not fetched and {len(skipped)} not fitted')
+    if timed_out:
+        notes.append(f'{len(timed_out)} fits timed out: '+', '.join(candidate_name(*candidates[i]) for i in timed_out))
+    for n in notes:
+        print(n)
+    metrics.count('candidates',len(candidates))
+    metrics.count('not_fetched',unfetched)
+    metrics.count('not_fitted',len(skipped))
+    metrics.count('recommended',len(ps))
+
+    try:
+        if post and (ps or notes):
+            # partial results are posted with what was left out, split into messages Slack accepts
+            pst('\n'.join(ps+notes),channel='D041VTL9LRY',timeout=post_wait)
+    finally:
+        write_metrics(metrics,report,prometheus,start)
+    if poll is not None:
+        # failed and cut off candidates are left for the next poll
+        done = [i for i,r in enumerate(results) if r is not None]+rejected+groups.skipped
+        poll.commit([candidates[j] for i in done for j in groups.members(i)])
 
     return 0
 
 
-def run_sched(sep= 86400): # 24 hours in seconds
+def write_metrics(metrics,report=None,prometheus=None,start=None):
+    '''
+    Prints how long the run and its stages took and writes the report and Prometheus textfile if paths are given.
+
+    Parameters
+    ----------
+    metrics : prep.metrics.run_metrics
+        Metrics of the run.
+    report, prometheus : str, optional
+        Paths of the JSON report and the Prometheus textfile. The default is None.
+    start : float, optional
+        time.monotonic() at the start of the run, recorded as the 'run' stage. The default is None.
+    '''
+    if start is not None:
+        metrics.observe('run',time.monotonic()-start)
+    for stage, s in metrics.report()['stages'].items():
+        failed = sum(s['failed'].values())
+        print(f"{stage}: {s['ok']} ok, {failed} failed, p50 {s['latency']['p50']:.2f} s, max {s['latency']['max']:.2f} s")
+    if report:
+        metrics.write_json(report)
+    if prometheus:
+        metrics.write_prometheus(prometheus)
+
+
+def run_sched(sep= 86400, **kwargs): # 24 hours in seconds
+    '''
+    Calls run every sep seconds. Unless a deadline is given, each run gets sep seconds so it finishes before the next one is due. A run that still overruns skips the start times it missed instead of overlapping the next run.
+
+    Parameters
+    ----------
+    sep : float, optional
+        Seconds between the starts of two runs. The default is 86400.
+    **kwargs
+        Arguments of run.
+    '''
+    if kwargs.get('deadline') is None:
+        kwargs['deadline'] = sep
+    t0 = time.monotonic()
     while True:
-        t1 = time.monotonic()
-        run()
-        t2 = time.monotonic()
-        td = t2-t1
-        time.sleep(sep-td) # calculation offset so it runs at the same time every day
+        run(**kwargs)
+        # next start time on the original schedule
+        td = time.monotonic()-t0
+        time.sleep(sep-td%sep)
     return 0
 
 
-if __name__ == '__main__':
-    print('running')
-    run_sched()
+def run_continuous(interval=600,intervals=None,state=None,cycles=None,**kwargs):
+    '''
+    Polls the sources every few minutes instead of once a day. Each poll asks a source only for objects detected since its previous poll and fits and posts just the new candidates, so the work per poll follows the number of new alerts. The watermarks are kept in a prep.poll.poll_state, which by default is saved in the cache directory so a restart continues where it stopped.
 
-def main():
-    print('running')
-    run_sched()
-    return 0
\ No newline at end of file
+    Parameters
+    ----------
+    interval : float, optional
+        Seconds between two polls of a source. The default is 600.
+    intervals : dict, optional
+        Intervals of single sources that replace interval, e.g. {'yse':3600}. The default is None.
+    state : prep.poll.poll_state, optional
+        Watermarks to poll from. The default is None which loads the saved ones.
+    cycles : int, optional
+        Stop after this many runs. The default is None which polls forever.
+    **kwargs
+        Arguments of run. A deadline applies to every poll.
+    '''
+    from prep.poll import poll_state
+    sources = kwargs.pop('sources',['antares','alerce','yse'])
+    intervals = {s:(intervals or {}).get(s,interval) for s in sources}
+    state = poll_state() if state is None else state
+    due = dict.fromkeys(sources,time.monotonic())
+    n = 0
+    while cycles is None or n < cycles:
+        now = time.monotonic()
+        ready = [s for s in sources if due[s] <= now]
+        if ready:
+            run(sources=ready,poll=state,**kwargs)
+            print(state.report())
+            n += 1
+            for s in ready:
+                # a poll that overran skips the times it missed
+                due[s] += intervals[s]*(int((time.monotonic()-due[s])//intervals[s])+1)
+        if cycles is None or n < cycles:
+            time.sleep(max(0.,min(due.values())-time.monotonic()))
+    return 0
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+import io
+import json
+import time
+import resource
+import argparse
+import tracemalloc
+from contextlib import redirect_stdout
+import numpy as np
+import pandas as pd
+from astropy.time import Time
+from prep.metrics import reset_metrics
+from prep.source.bandpassdict import bandpassdict
+from prep.source.photometry import ztf_fid, ztf_passband
+from prep.source.salt import get_model
+from prep.fetch import object_from_photometry
+
+# How each source reports photometry: band labels as they appear in its data with their bandpassdict keys,
+# days between visits, fraction of bands observed per visit and 5 sigma limiting magnitude.
+bench_sources = {
+    'alerce':{'bands':ztf_fid,'cadence':2.,'fill':0.7,'mlim':20.5},
+    'antares':{'bands':ztf_passband,'cadence':2.,'fill':0.7,'mlim':20.5},
+    'yse':{'bands':{('GPC1','g'):'Band: GPC1 - g',('GPC1','r'):'Band: GPC1 - r',('GPC1','i'):'Band: GPC1 - i',
+                    ('ZTF-Cam','g-ZTF'):'Band: ZTF-Cam - g-ZTF',('ZTF-Cam','r-ZTF'):'Band: ZTF-Cam - r-ZTF'},
+           'cadence':3.,'fill':0.5,'mlim':21.5},
+}
+
+# ranges the true parameters are drawn from, phase is the age of the light curve relative to t0
+bench_params = {'z':(0.02,0.15),'x1':(-2.,2.),'c':(-0.15,0.15),'phase':(-8.,10.),'absmag':(-19.4,-19.2)}
+
+def synthetic_lightcurve(source, rng, now=None, min_points=4, zp=27.5, source_name='salt3'):
+    '''
+    Draws a SALT3 light curve observed the way a source reports it, with detections only like the alert streams.
+
+    Parameters
+    ----------
+    source : str
+        'alerce', 'antares' or 'yse', see bench_sources.
+    rng : np.random.Generator
+        Random numbers.
+    now : float, optional
+        MJD the light curve ends at. The default is None which uses the current time.
+    min_points : int, optional
+        Light curves with fewer detections are drawn again. The default is 4.
+    zp : float, optional
+        Zero point of the fluxes. The default is 27.5.
+    source_name : str, optional
+        sncosmo source. The default is 'salt3'.
+
+    Returns
+    -------
+    data : pd.DataFrame
+        Detections with the columns of the source, see prep.fetch.object_from_photometry.
+    truth : dict
+        z, t0, x0, x1 and c of the model.
+    '''
+    setup = bench_sources[source]
+    labels = list(setup['bands'])
+    bands = np.array([bandpassdict[setup['bands'][b]] for b in labels])
+    now = Time.now().mjd if now is None else now
+    model = get_model(source_name)
+    while True:
+        p = {k:rng.uniform(*v) for k,v in bench_params.items()}
+        t0 = now-p['phase']
+        model.set(z=p['z'],t0=t0,x1=p['x1'],c=p['c'])
+        model.set_source_peakabsmag(p['absmag'],'bessellb','ab')
+        visits = np.arange(t0-20.,now+0.01,setup['cadence'])+rng.uniform(-0.3,0.3)
+        t, b = np.meshgrid(visits,np.arange(len(labels)),indexing='ij')
+        keep = rng.random(t.shape) < setup['fill']
+        t, b = t[keep], b[keep]
+        flux = model.bandflux(bands[b],t,zp=zp,zpsys='ab') if t.size else np.zeros(0)
+        # sky noise from the limiting magnitude and 1% calibration noise
+        err = np.hypot(10**(-0.4*(setup['mlim']-zp))/5,0.01*flux)
+        obs = flux+rng.normal(0,err)
+        det = obs > 5*err
+        if det.sum() >= min_points:
+            break
+    t, b, obs, err = t[det], b[det], obs[det], err[det]
+    mag = zp-2.5*np.log10(obs)
+    magerr = 2.5/np.log(10)*err/obs
+    truth = dict(zip(model.param_names,model.parameters))
+    band = [labels[i] for i in b]
+    if source == 'alerce':
+        data = pd.DataFrame({'mjd':t,'magpsf':mag,'sigmapsf':magerr,'fid':band,'has_stamp':True})
+    elif source == 'antares':
+        data = pd.DataFrame({'ant_mjd':t,'ant_mag':mag,'ant_magerr':magerr,'ant_passband':band})
+    else:
+        data = pd.DataFrame({'MJD':t,'MAG':mag,'MAGERR':magerr,'FLUXCAL':obs,
+                             'INSTRUMENT':[x[0] for x in band],'FLT':[x[1] for x in band]})
+    return data.sort_values(data.columns[0]).reset_index(drop=True), truth
+
+def _recovery(fits, truths):
+    # bias, robust scatter and worst error of each parameter
+    out = {}
+    for k in ['z','t0','x1','c']:
+        d = np.array([f[k]-t[k] for f,t in zip(fits,truths) if f is not None])
+        if d.size == 0:
+            out[k] = None
+            continue
+        out[k] = {'bias':float(np.median(d)),'scatter':float(1.4826*np.median(np.abs(d-np.median(d)))),'max':float(np.abs(d).max())}
+    return out
+
+def run_bench(n=20, sources=('alerce','antares','yse'), methods=('minuit',), seed=0, trace_memory=False):
+    '''
+    Fits synthetic light curves through the salt3 method of each source class and measures the fitting core, without any network access.
+
+    Parameters
+    ----------
+    n : int, optional
+        Light curves per source. The same ones are used for every method. The default is 20.
+    sources : list of str, optional
+        Sources whose formats are simulated. The default is all of bench_sources.
+    methods : list of str, optional
+        Fitting methods, see prep.source.salt.fit_salt3. The default is ('minuit',).
+    seed : int, optional
+        Seed of the light curves. The default is 0.
+    trace_memory : bool, optional
+        If True, the peak Python allocation of each block is measured with tracemalloc, which slows the fits down. The default is False.
+
+    Returns
+    -------
+    report : dict
+        Per 'source/method': fits per second, latency percentiles in seconds, failures by exception type, fit iterations, peak memory and the bias, scatter and largest error of z, t0, x1 and c.
+    '''
+    now = Time.now().mjd
+    report = {'n':n,'seed':seed,'results':{}}
+    for source in sources:
+        # seeded per source so a light curve does not depend on which other sources run
+        rng = np.random.default_rng([seed,list(bench_sources).index(source)])
+        sample = [synthetic_lightcurve(source,rng,now) for _ in range(n)]
+        for method in methods:
+            # a first fit outside the timing loads the model, bandpasses and bandflux table
+            with redirect_stdout(io.StringIO()):
+                object_from_photometry(source,'warmup',sample[0][0]).salt3(method=method)
+            metrics = reset_metrics()
+            if trace_memory:
+                tracemalloc.start()
+            fits = []
+            t = time.perf_counter()
+            for i, (data, truth) in enumerate(sample):
+                obj = object_from_photometry(source,f'bench{i}',data)
+                try:
+                    # the sources print every fit
+                    with metrics.timer('fit'), redirect_stdout(io.StringIO()):
+                        obj.salt3(method=method)
+                    fits.append(obj.salt_params)
+                except Exception:
+                    fits.append(None)
+            wall = time.perf_counter()-t
+            peak = None
+            if trace_memory:
+                peak = tracemalloc.get_traced_memory()[1]/2**20
+                tracemalloc.stop()
+            r = metrics.report()
+            fit = r['stages']['fit']
+            report['results'][f'{source}/{method}'] = {
+                'fits':n,'fits_per_sec':n/wall,'latency':fit['latency'],'failed':fit['failed'],
+                'fit_iterations':r['fit_iterations'],'traced_peak_mb':peak,
+                'max_rss_mb':resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024,
+                'recovery':_recovery(fits,[s[1] for s in sample])}
+    return report
+
+def compare(report, baseline, tolerance=0.2):
+    '''
+    Finds blocks that got slower than a baseline report.
+
+    Parameters
+    ----------
+    report, baseline : dict
+        Outputs of run_bench.
+    tolerance : float, optional
+        Allowed fractional drop in fits per second and rise in median latency. The default is 0.2.
+
+    Returns
+    -------
+    regressions : list of str
+        One message per slower block, empty if none.
+    '''
+    out = []
+    for key, r in report['results'].items():
+        b = baseline['results'].get(key)
+        if b is None:
+            continue
+        if r['fits_per_sec'] < (1-tolerance)*b['fits_per_sec']:
+            out.append(f"{key}: {r['fits_per_sec']:.2f} fits/s, baseline {b['fits_per_sec']:.2f}")
+        if r['latency']['p50'] > (1+tolerance)*b['latency']['p50']:
+            out.append(f"{key}: median latency {r['latency']['p50']:.3f} s, baseline {b['latency']['p50']:.3f} s")
+    return out
+
+def print_report(report):
+    '''
+    Prints a run_bench report as a table.
+    '''
+    print(f"{'source/method':<16}{'fits/s':>8}{'p50':>8}{'p90':>8}{'p99':>8}{'fail':>6}{'ncall':>7}{'rss MB':>8}{'dz':>8}{'dt0':>7}{'dx1':>7}{'dc':>7}")
+    for key, r in report['results'].items():
+        lat, rec = r['latency'], r['recovery']
+        sc = lambda k: f"{rec[k]['scatter']:.3f}" if rec[k] else '-'
+        print(f"{key:<16}{r['fits_per_sec']:>8.2f}{lat['p50']:>8.3f}{lat['p90']:>8.3f}{lat['p99']:>8.3f}{sum(r['failed'].values()):>6}"
+              f"{r['fit_iterations']['mean'] or 0:>7.0f}{r['max_rss_mb']:>8.0f}{sc('z'):>8}{sc('t0'):>7}{sc('x1'):>7}{sc('c'):>7}")
+    print('recovery columns are the robust scatter of fitted minus true values')
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m prep.bench',description='Offline SALT3 fitting benchmark on synthetic light curves.')
+    parser.add_argument('-n',type=int,default=20,help='light curves per source (default: 20)')
+    parser.add_argument('-s','--sources',nargs='+',default=list(bench_sources),choices=list(bench_sources),help='source formats to simulate')
+    parser.add_argument('-m','--methods',nargs='+',default=['minuit'],choices=['minuit','grid','table'],help='fitting methods (default: minuit)')
+    parser.add_argument('--seed',type=int,default=0,help='random seed (default: 0)')
+    parser.add_argument('--trace-memory',action='store_true',help='measure peak allocations with tracemalloc (slower)')
+    parser.add_argument('--json',default=None,metavar='PATH',help='write the report to a JSON file')
+    parser.add_argument('--baseline',default=None,metavar='PATH',help='JSON report to compare against, exits with 1 on a regression')
+    parser.add_argument('--tolerance',type=float,default=0.2,help='allowed slowdown relative to the baseline (default: 0.2)')
+    args = parser.parse_args()
+    report = run_bench(args.n,args.sources,args.methods,args.seed,args.trace_memory)
+    print_report(report)
+    if args.json:
+        with open(args.json,'w') as f:
+            json.dump(report,f,indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report,json.load(f),args.tolerance)
+        for r in regressions:
+            print('regression:',r)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -1,7 +1,40 @@
 import numpy as np 
 import pandas as pd
 import requests as req
-from .auth import toku
+from .credentials import get_credential
+from .transport import get_transport, install
+
+_session = None
+
+def slack_token():
+    '''
+    The Slack token, read when posting. See prep.credentials.get_credential.
+
+    Returns
+    -------
+    token : str
+    '''
+    token = get_credential('toku')
+    if not token and get_transport().mode == 'replay':
+        # nothing is sent when replaying
+        return 'replay'
+    if not token:
+        raise RuntimeError('no Slack token, set PREP_TOKU or toku in prep/auth.py')
+    return token
+
+def get_slack_session():
+    '''
+    Returns the session used to post to Slack, put under the transport of prep.transport.
+
+    Returns
+    -------
+    session : requests.Session
+    '''
+    global _session
+    if _session is None:
+        _session = req.Session()
+        install(_session,'slack')
+    return _session
 
 class build_rec:
     def __init__(self, obj):
@@ -49,9 +82,9 @@ class build_rec:
         df1['url'] = self.url
         return df1
     
-    def post(self,string=None,channel='D03BK3YKUQN'):
+    def post(self,string=None,channel='D03BK3YKUQN',timeout=60):
         '''
-        Posts to a slack channel. If no string is provided, will use the string attribute of the object.
+        Posts to a slack channel through the outbox of prep.outbox. If no string is provided, will use the string attribute of the object.
 
         Parameters
         ----------
@@ -59,38 +92,39 @@ class build_rec:
             String to post to slack. If None, will use the string attribute of the object.
         channel : str, optional
             Channel to post to. Specific to workspace the bot token has been installed in.
+        timeout : float, optional
+            Seconds to wait for Slack. Messages not posted by then are sent in the background and kept in the outbox if the process stops. The default is 60.
         '''
         if string is None:
             string = self.string
-        p1=req.post('https://slack.com/api/chat.postMessage',
-                 params={'channel':channel,
-                         'text':string,
-                         'mrkdwn':'true',
-                         'parse':'none'},
-                         headers={'Authorization': f'Bearer {toku}'})
-        p1.raise_for_status()
-        if p1.status_code == 200:
-            print('Posted to Slack')
+        post(string,channel,timeout)
 
-def post(string=None, channel='D03BK3YKUQN'):
-        '''
-    Posts to a slack channel. If no string is provided, will use the string attribute of the object. This is a standalone function for autmation purposes.
+def post(string=None, channel='D03BK3YKUQN', timeout=60):
+    '''
+    Posts to a slack channel. This is a standalone function for automation purposes. Long strings are split into several messages at line breaks, which are sent by the outbox of prep.outbox with retries.
 
     Parameters
     ----------
-    string : str, optional
-        String to post to slack. If None, will use the string attribute of the object.
+    string : str
+        String to post to slack.
     channel : str, optional
         Channel to post to. Specific to workspace the bot token has been installed in.
-        '''
-        if string is None:
-            raise ValueError('No string provided')
-        p1=req.post('https://slack.com/api/chat.postMessage',
-                 params={'channel':channel,
-                         'text':string,
-                         'mrkdwn':'true',
-                         'parse':'none'},
-                         headers={'Authorization': f'Bearer {toku}'})
-        p1.raise_for_status()
-        if p1.status_code == 200:
-            print('Posted to Slack')
\ No newline at end of file
+    timeout : float, optional
+        Seconds to wait for Slack. Messages not posted by then are sent in the background and kept in the outbox if the process stops. The default is 60.
+
+    Returns
+    -------
+    pending : int
+        Number of messages not posted yet.
+    '''
+    if string is None:
+        raise ValueError('No string provided')
+    from .outbox import get_outbox
+    outbox = get_outbox()
+    outbox.send(string,channel)
+    n = outbox.flush(timeout)
+    if n == 0:
+        print('Posted to Slack')
+    else:
+        print(f'{n} messages not posted to Slack yet, they stay in the outbox')
+    return n
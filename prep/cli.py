@@ -0,0 +1,87 @@
+import argparse
+
+def main():
+    parser = argparse.ArgumentParser(prog='auto-prep',description='Recommends young SNe Ia from ALeRCE, ANTARES and YSE.')
+    parser.add_argument('-w','--workers',type=int,default=1,help='number of worker processes used for fitting (default: 1)')
+    parser.add_argument('--fetch-limit',nargs=2,action='append',metavar=('SOURCE','N'),default=[],help='maximum concurrent light curve downloads from SOURCE (repeatable)')
+    parser.add_argument('-s','--sources',nargs='+',default=['antares','alerce','yse'],choices=['antares','alerce','yse'],help='sources to query')
+    parser.add_argument('--once',action='store_true',help='run once instead of every 24 hours')
+    parser.add_argument('--poll',type=float,default=None,metavar='SECONDS',help='poll the sources continuously at this interval, fitting only new or updated candidates')
+    parser.add_argument('--poll-interval',nargs=2,action='append',metavar=('SOURCE','SECONDS'),default=[],help='polling interval of one source, e.g. --poll-interval yse 3600 (repeatable)')
+    parser.add_argument('--stream-file',default=None,metavar='PATH',help='consume alerts from a file with one JSON alert per line as it grows, instead of querying')
+    parser.add_argument('--stream-kafka',default=None,metavar='TOPIC',help='consume alerts from a Kafka topic, instead of querying (needs confluent-kafka)')
+    parser.add_argument('--kafka-servers',default='localhost:9092',metavar='HOSTS',help='Kafka bootstrap servers (default: localhost:9092)')
+    parser.add_argument('--kafka-group',default='prep',metavar='ID',help='Kafka consumer group (default: prep)')
+    parser.add_argument('--debounce',type=float,default=5.,metavar='SECONDS',help='with a stream, refit an object once it had no new alert for this long (default: 5)')
+    parser.add_argument('--no-post',dest='post',action='store_false',help='do not post to Slack')
+    parser.add_argument('--warm-start',dest='warm',action='store_true',help="start fits from each object's previous solution")
+    parser.add_argument('--match-radius',type=float,default=2.0,help='cross-match radius in arcseconds for merging candidates (default: 2)')
+    parser.add_argument('--combine',action='store_true',help='fit the photometry of all sources an object was found in together')
+    parser.add_argument('--grid',dest='method',action='store_const',const='grid',default='minuit',help='fit on a redshift, color and t0 grid before minimizing')
+    parser.add_argument('--table',dest='method',action='store_const',const='table',help='like --grid with precomputed SALT3 bandfluxes instead of spectral integration')
+    parser.add_argument('--prefilter',action='store_true',help='drop candidates that fail cheap light-curve feature cuts before fitting')
+    parser.add_argument('--cut',nargs=2,action='append',metavar=('NAME','VALUE'),default=[],help="prefilter threshold, e.g. --cut max_age 20, or 'none' to switch a cut off, implies --prefilter (repeatable)")
+    parser.add_argument('--min-class-prob',type=float,default=None,metavar='P',help='drop ALeRCE candidates whose top class is not SNIa with probability at least P')
+    parser.add_argument('--antares-max',type=int,default=50,metavar='N',help='stop after N ANTARES loci were converted successfully (default: 50)')
+    parser.add_argument('--antares-time',type=float,default=None,metavar='SECONDS',help='wall-clock limit on downloading ANTARES loci')
+    parser.add_argument('--antares-inflight',type=int,default=None,metavar='N',help='maximum ANTARES loci downloaded at the same time (default: the ANTARES fetch limit)')
+    parser.add_argument('--fit-timeout',type=float,default=None,metavar='SECONDS',help='kill a fit that takes longer than this')
+    parser.add_argument('--deadline',type=float,default=None,metavar='SECONDS',help='post the results found so far after this long (default: none with --once, else 24 hours)')
+    parser.add_argument('--report',default=None,metavar='PATH',help='write a JSON report of stage timings, failures, bytes fetched and fit iterations')
+    parser.add_argument('--prometheus',default=None,metavar='PATH',help='write the same metrics as a Prometheus textfile for node_exporter')
+    parser.add_argument('--record',default=None,metavar='PATH',help='also write every ALeRCE, ANTARES, YSE-PZ and Slack response to this archive')
+    parser.add_argument('--replay',default=None,metavar='PATH',help='answer every request from an archive written with --record, without network access')
+    parser.add_argument('--replay-latency',default=None,metavar='SECONDS',help="wait this long before every replayed response, or 'recorded' for the original times")
+    parser.add_argument('--no-cache',dest='cache',action='store_false',help='always download full light curves and refit every object')
+    args = parser.parse_args()
+    if args.stream_file and args.stream_kafka:
+        parser.error('--stream-file and --stream-kafka cannot be combined')
+    if args.once and args.poll:
+        parser.error('--once and --poll cannot be combined')
+    if args.record and args.replay:
+        parser.error('--record and --replay cannot be combined')
+    latency = args.replay_latency
+    if latency is not None and latency != 'recorded':
+        latency = float(latency)
+    limits = {source:int(n) for source,n in args.fetch_limit}
+    cuts = {name:None if value.lower() == 'none' else float(value) for name,value in args.cut}
+    budget = {'max_candidates':args.antares_max,'max_time':args.antares_time}
+    if args.antares_inflight is not None:
+        budget['max_inflight'] = args.antares_inflight
+    # the pipeline is only imported once the arguments are parsed, so --help is quick
+    from prep.auto import run, run_sched, run_continuous
+    from prep.transport import get_transport, set_transport
+    if args.record:
+        transport = set_transport('record',args.record)
+    elif args.replay:
+        transport = set_transport('replay',args.replay,latency)
+    else:
+        transport = get_transport()
+    if args.stream_file or args.stream_kafka:
+        from prep.stream import alert_consumer, file_topic, kafka_topic
+        if args.stream_file:
+            topic = file_topic(args.stream_file)
+        else:
+            topic = kafka_topic(args.stream_kafka,args.kafka_servers,args.kafka_group)
+        consumer = alert_consumer(topic,args.debounce,cache=args.cache,warm=args.warm,method=args.method,post=args.post)
+        print('consuming alerts')
+        try:
+            consumer.run()
+        finally:
+            topic.close()
+            transport.close()
+        return 0
+    kwargs = dict(sources=args.sources,post=args.post,workers=args.workers,fetch_limits=limits,cache=args.cache,warm=args.warm,match_radius=args.match_radius,combine=args.combine,method=args.method,prefilter=args.prefilter or bool(cuts),cuts=cuts,min_prob=args.min_class_prob,antares_budget=budget,fit_timeout=args.fit_timeout,deadline=args.deadline,report=args.report,prometheus=args.prometheus)
+    print('running')
+    try:
+        if args.once:
+            run(**kwargs)
+        elif args.poll:
+            run_continuous(args.poll,{source:float(t) for source,t in args.poll_interval},**kwargs)
+        else:
+            run_sched(**kwargs)
+    finally:
+        transport.close()
+        if transport.mode != 'live':
+            print(f'{transport.mode}: '+', '.join(f'{k} {v}' for k,v in transport.stats.items()))
+    return 0
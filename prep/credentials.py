@@ -0,0 +1,28 @@
+import os
+import importlib
+
+# environment variable checked first for each name in prep/auth.py
+credential_env = {'login':'PREP_LOGIN','password':'PREP_PASSWORD','toku':'PREP_TOKU'}
+
+def get_credential(name):
+    '''
+    Looks up a credential when it is needed rather than at import time, so prep works without prep/auth.py as long as the service that needs it is not used.
+
+    Parameters
+    ----------
+    name : str
+        'login' or 'password' for YSE-PZ, 'toku' for the Slack token.
+
+    Returns
+    -------
+    value : str or None
+        The environment variable of credential_env if it is set, else the value in prep/auth.py, else None.
+    '''
+    value = os.environ.get(credential_env[name])
+    if value is not None:
+        return value
+    try:
+        auth = importlib.import_module('prep.auth')
+    except ImportError:
+        return
+    return getattr(auth,name,None)
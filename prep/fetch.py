@@ -0,0 +1,197 @@
+import pandas as pd
+from prep.source import alerce_api, antares, yse
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import ExitStack, nullcontext
+from prep.metrics import get_metrics
+
+# maximum number of light curves downloaded at the same time from each service
+fetch_limits = {'alerce':4,'antares':4,'yse':4}
+
+def candidate_name(source, item):
+    '''
+    Name of a candidate for log messages.
+
+    Parameters
+    ----------
+    source : str
+        One of 'alerce', 'antares' or 'yse'.
+    item : pd.Series, antares_client.models.Locus, prep.source.antares.antares_object or tuple
+        The ALeRCE query row, ANTARES locus or object from antares_stream, or YSE (name, last_mjd) of the candidate.
+
+    Returns
+    -------
+    name : str
+    '''
+    if source == 'alerce':
+        return item.oid
+    elif source == 'antares':
+        if isinstance(item,antares.antares_object):
+            return item.name
+        return item.properties["ztf_object_id"]
+    return item[0]
+
+def candidate_mjd(source, item):
+    '''
+    MJD of the latest detection of a candidate as reported by the query that found it.
+
+    Parameters
+    ----------
+    source : str
+        One of 'alerce', 'antares' or 'yse'.
+    item : pd.Series, antares_client.models.Locus, prep.source.antares.antares_object or tuple
+        The candidate, see candidate_name.
+
+    Returns
+    -------
+    mjd : float or None
+        None if the source did not report it.
+    '''
+    if source == 'alerce':
+        mjd = item.get('lastmjd')
+    elif source == 'antares':
+        if isinstance(item,antares.antares_object):
+            mjd = item.lc['ant_mjd'].max() if len(item.lc) else None
+        else:
+            mjd = item.properties.get('newest_alert_observation_time')
+    else:
+        mjd = item[1]
+    return None if mjd is None or mjd != mjd else float(mjd)
+
+def fetch_object(source, item, store=None):
+    '''
+    Builds the source object of a candidate and downloads its light curve.
+
+    Parameters
+    ----------
+    source : str
+        One of 'alerce', 'antares' or 'yse'.
+    item : pd.Series, antares_client.models.Locus, prep.source.antares.antares_object or tuple
+        The ALeRCE query row, ANTARES locus or object from antares_stream, or YSE (name, last_mjd) of the candidate.
+    store : prep.source.store.lc_store, optional
+        Light curve store passed on to get_lc. The position of the object is recorded in it as well. The default is None.
+
+    Returns
+    -------
+    obj : prep.source object or None
+        The object with its light curve, or None if anything failed.
+    '''
+    # loci from antares_stream were downloaded and timed there
+    done = source == 'antares' and isinstance(item,antares.antares_object)
+    try:
+        with nullcontext() if done else get_metrics().timer(f'fetch_{source}'):
+            if source == 'alerce':
+                obj = alerce_api.alerce_object(item)
+            elif source == 'antares':
+                obj = item if done else antares.antares_object(item)
+                print(obj.name)
+            else:
+                obj = yse.yse_object(item[0],last_mjd=item[1])
+            obj.get_lc(store)
+        if store is not None:
+            store.record(source,obj.name,obj.ra,obj.dec)
+        return obj
+    except Exception as e:
+        print(f'failed on {candidate_name(source,item)}\n{e}')
+        return
+
+class _locus:
+    # the parts of an antares_client Locus that antares_object reads
+    def __init__(self, name, lc, ra=0., dec=0., locus_id=None):
+        self.locus_id = locus_id or f'ANT{name}'
+        self.properties = {'ztf_object_id':name}
+        self.ra, self.dec = ra, dec
+        self.catalogs = []
+        self.lightcurve = lc
+
+def object_from_photometry(source, name, data, ra=0., dec=0., locus_id=None):
+    '''
+    Builds the source object of a candidate from photometry that is already at hand, e.g. synthetic or from an alert stream, without touching the network, as if get_lc had run.
+
+    Parameters
+    ----------
+    source : str
+        One of 'alerce', 'antares' or 'yse'.
+    name : str
+        ZTF object id, or YSE name.
+    data : pd.DataFrame
+        Photometry with the columns get_lc of the source produces: mjd, magpsf, sigmapsf and fid for ALeRCE, ant_mjd, ant_mag, ant_magerr and ant_passband for ANTARES, MJD, MAG, MAGERR, FLUXCAL, FLT and INSTRUMENT for YSE.
+    ra, dec : float, optional
+        Position in degrees. The default is 0.
+    locus_id : str, optional
+        ANTARES locus id, used for the url. The default is None.
+
+    Returns
+    -------
+    obj : prep.source object
+    '''
+    if source == 'alerce':
+        obj = alerce_api.alerce_object(pd.Series({'oid':name,'meanra':ra,'meandec':dec,'lastmjd':data['mjd'].max()}))
+        obj.lc = data
+    elif source == 'antares':
+        obj = antares.antares_object(_locus(name,data,ra,dec,locus_id))
+        obj.release()
+    else:
+        # the constructor looks the object up on YSE-PZ
+        obj = yse.yse_object.__new__(yse.yse_object)
+        obj.name = name
+        obj.ns = name.split('SN')[-1].strip()
+        obj.ra, obj.dec = ra, dec
+        obj.data = None
+        obj.url = obj._gen_YSE_PZ_url()
+        # no YSE-PZ redshift, so z is fitted like for the other sources
+        obj.header = {}
+        obj.last_mjd = data['MJD'].max()
+        obj.lc_data = obj.pdata = data
+    return obj
+
+def fetch_all(candidates, limits=None, store=None, deadline=None, more=None):
+    '''
+    Downloads the light curves of all candidates concurrently. Each source gets its own thread pool so the number of requests in flight to one service never exceeds its limit.
+
+    Parameters
+    ----------
+    candidates : list of tuple
+        (source, item) pairs, see prep.auto.get_candidates.
+    limits : dict, optional
+        Maximum concurrent downloads per source, overriding fetch_limits. The default is None.
+    store : prep.source.store.lc_store, optional
+        Light curve store passed on to get_lc. The default is None.
+    deadline : float, optional
+        time.monotonic() value after which no more downloads are waited for. Abandoned downloads keep running in the background and may write to store after it was closed, which lc_store.close allows for. The default is None.
+    more : callable, optional
+        Called without arguments after each result is handled. Returns further (source, item) pairs to download, e.g. another source of an object whose download failed. They are numbered after the candidates before them. The default is None.
+
+    Yields
+    ------
+    i : int
+        Index of the candidate in candidates.
+    obj : prep.source object or None
+        The object with its light curve, or None if fetching failed. Yielded as soon as the download finishes.
+    '''
+    limits = dict(fetch_limits, **(limits or {}))
+    with ExitStack() as stack:
+        pools = {}
+        futures = {}
+
+        def submit(i, source, item):
+            if source not in pools:
+                pools[source] = ThreadPoolExecutor(max_workers=max(1,limits.get(source,1)))
+                # downloads still running when iteration stops are not waited for
+                stack.callback(pools[source].shutdown, wait=False, cancel_futures=True)
+            futures[pools[source].submit(fetch_object,source,item,store)] = i
+
+        n = 0
+        for source, item in candidates:
+            submit(n,source,item)
+            n += 1
+        while futures:
+            timeout = None if deadline is None else max(0.,deadline-time.monotonic())
+            done, _ = wait(futures,timeout=timeout,return_when=FIRST_COMPLETED)
+            if not done:
+                return
+            for f in done:
+                yield futures.pop(f), f.result()
+                for source, item in (more() if more is not None else []):
+                    submit(n,source,item)
+                    n += 1
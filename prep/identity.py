@@ -0,0 +1,261 @@
+import re
+from prep.source.sky import sky_index
+from prep.source.antares import antares_object
+
+# sources whose photometry is preferred when the same object comes from several
+source_preference = ['yse','alerce','antares']
+
+def normalize_alias(name):
+    '''
+    Normalizes an object name so that e.g. "SN 2023abc", "AT2023abc" and "2023abc" compare equal.
+
+    Parameters
+    ----------
+    name : str
+        ZTF object id, ANTARES locus id, TNS or YSE name.
+
+    Returns
+    -------
+    alias : str
+    '''
+    name = str(name).strip()
+    return re.sub(r'^(SN|AT)\s*(?=\d{4})','',name).lower()
+
+def candidate_aliases(source, item):
+    '''
+    Collects the names and position of a candidate that are known before its light curve is fetched. ANTARES catalog matches are only loaded for loci matched to TNS.
+
+    Parameters
+    ----------
+    source : str
+        One of 'alerce', 'antares' or 'yse'.
+    item : pd.Series, antares_client.models.Locus, prep.source.antares.antares_object or tuple
+        The ALeRCE query row, ANTARES locus or object from antares_stream, or YSE (name, last_mjd) of the candidate.
+
+    Returns
+    -------
+    aliases : list of str
+        Normalized names of the candidate.
+    ra, dec : float or None
+        Position in degrees, None if not known before the light curve is fetched.
+    '''
+    if source == 'alerce':
+        return [normalize_alias(item.oid)], item.meanra, item.meandec
+    elif source == 'antares' and isinstance(item,antares_object):
+        return [normalize_alias(n) for n in [item.name,item.locus_id]+item.tns_names], item.ra, item.dec
+    elif source == 'antares':
+        aliases = [normalize_alias(item.properties['ztf_object_id']),normalize_alias(item.locus_id)]
+        # same link antares_object.check_yse uses, read from the locus instead of a query
+        if 'tns_public_objects' in item.catalogs:
+            try:
+                tns = item.catalog_objects.get('tns_public_objects') or []
+                aliases += [normalize_alias(t['name']) for t in tns if 'name' in t]
+            except Exception:
+                pass
+        return aliases, item.ra, item.dec
+    return [normalize_alias(item[0])], None, None
+
+class identity_index:
+
+    def __init__(self, radius=2.0):
+        '''
+        Merges candidates that are the same physical object. Two entries are linked if they share a name (ZTF oid, ANTARES locus id, TNS or YSE name) or lie within radius of each other.
+
+        Parameters
+        ----------
+        radius : float, optional
+            Cross-match radius in arcseconds. The default is 2.
+        '''
+        self.radius = radius
+        self._parent = {}
+        self._alias = {}
+        self._sky = sky_index()
+
+    def _find(self, key):
+        while self._parent[key] != key:
+            self._parent[key] = self._parent[self._parent[key]]
+            key = self._parent[key]
+        return key
+
+    def link(self, a, b):
+        '''
+        Records that entries a and b are the same object.
+        '''
+        ra, rb = self._find(a), self._find(b)
+        if ra != rb:
+            self._parent[rb] = ra
+
+    def add(self, key, aliases=(), ra=None, dec=None):
+        '''
+        Adds an entry and links it to every known entry with a shared alias or within radius.
+
+        Parameters
+        ----------
+        key : hashable
+            Identifier of the entry, e.g. its index in the candidate list.
+        aliases : list of str, optional
+            Normalized names of the entry. The default is ().
+        ra, dec : float, optional
+            Position in degrees. The default is None.
+
+        Returns
+        -------
+        matches : list
+            Keys of earlier entries that were linked to this one.
+        '''
+        self._parent.setdefault(key,key)
+        matches = []
+        for a in aliases:
+            if a in self._alias:
+                matches.append(self._alias[a])
+            else:
+                self._alias[a] = key
+        if ra is not None and dec is not None:
+            matches += self._sky.query(ra,dec,self.radius)
+            self._sky.add(key,ra,dec)
+        for m in matches:
+            self.link(m,key)
+        return matches
+
+    def same(self, a, b):
+        '''
+        Returns True if entries a and b are the same object.
+        '''
+        return self._find(a) == self._find(b)
+
+    def groups(self):
+        '''
+        Returns
+        -------
+        groups : list of list
+            Keys of the entries of each distinct object, in insertion order.
+        '''
+        out = {}
+        for key in self._parent:
+            out.setdefault(self._find(key),[]).append(key)
+        return list(out.values())
+
+class candidate_groups:
+
+    def __init__(self, candidates, radius=2.0, combine=False, prefer=source_preference):
+        '''
+        Deduplicates a candidate list so each physical object is fitted once. Candidates are grouped by shared names and by position where it is known before fetching. When light curves arrive, objects that turn out to lie within radius of one already released are dropped as well.
+
+        Parameters
+        ----------
+        candidates : list of tuple
+            (source, item) pairs, see prep.auto.get_candidates.
+        radius : float, optional
+            Cross-match radius in arcseconds. The default is 2.
+        combine : bool, optional
+            If True, every member of a group is fetched and their photometry is fitted together. Otherwise only the preferred member is fetched, and the next one in prefer order only if that fails, see next_fetch. The default is False.
+        prefer : list of str, optional
+            Source order used to pick the member whose fit is reported. The default is source_preference.
+        '''
+        self.candidates = candidates
+        self.combine = combine
+        self.index = identity_index(radius)
+        keys, ras, decs = [], [], []
+        for i, (source, item) in enumerate(candidates):
+            aliases, ra, dec = candidate_aliases(source,item)
+            self.index.add(i,aliases)
+            if ra is not None and dec is not None:
+                keys.append(i)
+                ras.append(ra)
+                decs.append(dec)
+        # one bulk all-pairs match for every position known before fetching
+        for a, b in sky_index(keys,ras,decs).pairs(radius):
+            self.index.link(a,b)
+        rank = lambda i: (prefer.index(candidates[i][0]) if candidates[i][0] in prefer else len(prefer), i)
+        self.groups = [sorted(g,key=rank) for g in self.index.groups()]
+        self._group = {i:g for g in self.groups for i in g}
+        self._arrived = {}
+        self._next = []
+        # fetched objects dropped because they lie within radius of one released earlier
+        self.skipped = []
+        # sky index of released objects, for matches only known after fetching
+        self._released = identity_index(radius)
+
+    def to_fetch(self):
+        '''
+        Returns
+        -------
+        indices : list of int
+            Indices of the candidates whose light curves are needed.
+        '''
+        if self.combine:
+            return sorted(self._group)
+        return sorted(g[0] for g in self.groups)
+
+    def next_fetch(self):
+        '''
+        Returns
+        -------
+        indices : list of int
+            Candidates needed since the last call because the member of their group fetched before them failed. Only without combine.
+        '''
+        out, self._next = self._next, []
+        return out
+
+    def members(self, i):
+        '''
+        Returns
+        -------
+        indices : list of int
+            Indices of every candidate in the group of candidate i, preferred first.
+        '''
+        return list(self._group[i])
+
+    def duplicates(self):
+        '''
+        Returns
+        -------
+        duplicates : dict
+            Index of the preferred member of each group with more than one member, mapped to the other members.
+        '''
+        return {g[0]:g[1:] for g in self.groups if len(g) > 1}
+
+    def arrived(self, i, obj):
+        '''
+        Records a fetched candidate and releases its group once it is ready to fit.
+
+        Parameters
+        ----------
+        i : int
+            Index of the candidate.
+        obj : prep.source object or None
+            The fetched object, None if fetching failed.
+
+        Returns
+        -------
+        ready : tuple or None
+            (i, obj, extra) with the index and object to fit and a list of light curves of the other members to merge, or None if the group is not ready, is a duplicate or its member failed.
+        '''
+        g = self._group[i]
+        self._arrived[i] = obj
+        if self.combine:
+            if any(j not in self._arrived for j in g):
+                return
+            objs = [(j,self._arrived[j]) for j in g if self._arrived[j] is not None]
+        elif obj is None:
+            # the group falls back to its next member, it is only lost once all of them failed
+            rest = [j for j in g if j not in self._arrived]
+            if rest:
+                self._next.append(rest[0])
+            return
+        else:
+            objs = [(i,obj)]
+        if not objs:
+            return
+        j, primary = objs[0]
+        if self._released.add(j,[],getattr(primary,'ra',None),getattr(primary,'dec',None)):
+            print(f'skipping {primary.name}, already fitted under another name')
+            self.skipped.append(j)
+            return
+        extra = []
+        for _, o in objs[1:]:
+            try:
+                extra.append(o.to_lightcurve())
+            except Exception as e:
+                print(f'could not combine {o.name}\n{e}')
+        return j, primary, extra
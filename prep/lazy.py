@@ -0,0 +1,50 @@
+import importlib
+
+def lazy_exports(package, submodules):
+    '''
+    Module __getattr__ and __dir__ for a package that re-exports the public names of its submodules but only imports a submodule when one of its names is first used. __all__ is computed on first access, so from package import * still imports every name.
+
+    Parameters
+    ----------
+    package : str
+        Name of the package, i.e. __name__ in its __init__.
+    submodules : list of str
+        Submodules whose public names the package exports, searched in this order.
+
+    Returns
+    -------
+    __getattr__, __dir__ : callable
+    '''
+    def public(sub):
+        # what from package.sub import * would import
+        mod = importlib.import_module(f'{package}.{sub}')
+        names = getattr(mod,'__all__',None)
+        return list(names) if names is not None else [n for n in vars(mod) if not n.startswith('_')]
+
+    def __getattr__(name):
+        if name == '__all__':
+            # looked up by from package import *, which imports every submodule anyway
+            names = list(submodules)
+            for sub in submodules:
+                names += [n for n in public(sub) if n not in names]
+            importlib.import_module(package).__all__ = names
+            return names
+        if name.startswith('__'):
+            raise AttributeError(f'module {package!r} has no attribute {name!r}')
+        if name in submodules:
+            return importlib.import_module(f'{package}.{name}')
+        if not name.startswith('_'):
+            for sub in submodules:
+                try:
+                    return getattr(importlib.import_module(f'{package}.{sub}'),name)
+                except AttributeError:
+                    continue
+        raise AttributeError(f'module {package!r} has no attribute {name!r}')
+
+    def __dir__():
+        names = set(vars(importlib.import_module(package)))
+        for sub in submodules:
+            names.update(public(sub))
+        return sorted(names)
+
+    return __getattr__, __dir__
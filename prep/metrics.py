@@ -0,0 +1,236 @@
+import json
+import time
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from prep.atomic import write_atomic
+import numpy as np
+
+# upper bounds in seconds of the latency histogram buckets
+latency_buckets = (0.05,0.1,0.25,0.5,1.,2.5,5.,10.,30.,60.,300.)
+
+class run_metrics:
+
+    def __init__(self):
+        '''
+        Collects the telemetry of one run: the latency and outcome of every stage call, failures by exception type, bytes downloaded per source and the iterations of each fit. Safe to use from several threads. Worker processes keep their own and send snapshot() back to be merged.
+        '''
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.latency = {}
+        self.ok = Counter()
+        self.failures = {}
+        self.counts = Counter()
+        self.bytes = Counter()
+        self.fit_calls = []
+
+    def observe(self, stage, seconds, error=None):
+        '''
+        Records one call of a stage.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage, e.g. 'fetch_yse' or 'fit'.
+        seconds : float
+            How long the call took.
+        error : Exception or str, optional
+            The exception, or its type name, if the call failed. The default is None.
+        '''
+        with self.lock:
+            self.latency.setdefault(stage,[]).append(float(seconds))
+            if error is None:
+                self.ok[stage] += 1
+            else:
+                name = error if isinstance(error,str) else type(error).__name__
+                self.failures.setdefault(stage,Counter())[name] += 1
+
+    @contextmanager
+    def timer(self, stage):
+        '''
+        Context manager that records the time spent in its block as a call of stage, failed if the block raises.
+        '''
+        t = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            self.observe(stage,time.monotonic()-t,e)
+            raise
+        self.observe(stage,time.monotonic()-t)
+
+    def count(self, name, n=1):
+        '''
+        Adds to a plain counter, e.g. of cached fits or skipped candidates.
+        '''
+        with self.lock:
+            self.counts[name] += n
+
+    def add_bytes(self, source, n):
+        '''
+        Adds n downloaded bytes to a source.
+        '''
+        with self.lock:
+            self.bytes[source] += int(n)
+
+    def fit_iterations(self, ncall):
+        '''
+        Records the number of model evaluations of a fit, result.ncall.
+        '''
+        with self.lock:
+            self.fit_calls.append(int(ncall))
+
+    def snapshot(self):
+        '''
+        Raw measurements as plain types that can be pickled and passed to merge.
+        '''
+        with self.lock:
+            return {'latency':{k:list(v) for k,v in self.latency.items()},'ok':dict(self.ok),
+                    'failures':{k:dict(v) for k,v in self.failures.items()},'counts':dict(self.counts),
+                    'bytes':dict(self.bytes),'fit_calls':list(self.fit_calls)}
+
+    def merge(self, snap):
+        '''
+        Adds the measurements of a snapshot, e.g. from a worker process.
+        '''
+        with self.lock:
+            for k,v in snap['latency'].items():
+                self.latency.setdefault(k,[]).extend(v)
+            self.ok.update(snap['ok'])
+            for k,v in snap['failures'].items():
+                self.failures.setdefault(k,Counter()).update(v)
+            self.counts.update(snap['counts'])
+            self.bytes.update(snap['bytes'])
+            self.fit_calls.extend(snap['fit_calls'])
+
+    def report(self):
+        '''
+        Summary of the run.
+
+        Returns
+        -------
+        report : dict
+            Per stage the number of successes, failures by exception type and latency percentiles in seconds, plus the counters, bytes per source and fit iterations.
+        '''
+        snap = self.snapshot()
+        stages = {}
+        for stage, lat in snap['latency'].items():
+            lat = np.array(lat)
+            stages[stage] = {'ok':snap['ok'].get(stage,0),'failed':snap['failures'].get(stage,{}),
+                             'latency':{'count':lat.size,'sum':float(lat.sum()),'mean':float(lat.mean()),
+                                        'p50':float(np.percentile(lat,50)),'p90':float(np.percentile(lat,90)),
+                                        'p99':float(np.percentile(lat,99)),'max':float(lat.max())}}
+        calls = np.array(snap['fit_calls'])
+        return {'started':self.started,'duration':time.time()-self.started,'stages':stages,
+                'counts':snap['counts'],'bytes':snap['bytes'],
+                'fit_iterations':{'fits':calls.size,'total':int(calls.sum()),
+                                  'mean':float(calls.mean()) if calls.size else None,
+                                  'max':int(calls.max()) if calls.size else None}}
+
+    def write_json(self, path):
+        '''
+        Writes report() to a JSON file.
+        '''
+        _write(path,json.dumps(self.report(),indent=1))
+
+    def write_prometheus(self, path, prefix='prep'):
+        '''
+        Writes the metrics in the Prometheus text format, for the textfile collector of node_exporter. Latencies are histograms with the bounds of latency_buckets.
+
+        Parameters
+        ----------
+        path : str
+            Output file, should end in .prom.
+        prefix : str, optional
+            Prefix of the metric names. The default is 'prep'.
+        '''
+        snap = self.snapshot()
+        out = []
+        def metric(name, kind, doc, rows):
+            out.append(f'# HELP {prefix}_{name} {doc}')
+            out.append(f'# TYPE {prefix}_{name} {kind}')
+            for labels, value in rows:
+                lab = ','.join(f'{k}="{v}"' for k,v in labels)
+                out.append(f'{prefix}_{name}{{{lab}}} {value}' if lab else f'{prefix}_{name} {value}')
+        hist = []
+        for stage, lat in sorted(snap['latency'].items()):
+            lat = np.array(lat)
+            for b in latency_buckets:
+                hist.append(f'{prefix}_stage_duration_seconds_bucket{{stage="{stage}",le="{b}"}} {int((lat <= b).sum())}')
+            hist.append(f'{prefix}_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {lat.size}')
+            hist.append(f'{prefix}_stage_duration_seconds_sum{{stage="{stage}"}} {lat.sum()}')
+            hist.append(f'{prefix}_stage_duration_seconds_count{{stage="{stage}"}} {lat.size}')
+        metric('stage_duration_seconds','histogram','Latency of each stage call.',[])
+        out += hist
+        metric('stage_success_total','counter','Successful stage calls.',[([('stage',k)],v) for k,v in sorted(snap['ok'].items())])
+        metric('stage_failure_total','counter','Failed stage calls by exception type.',
+               [([('stage',k),('exception',e)],n) for k,v in sorted(snap['failures'].items()) for e,n in sorted(v.items())])
+        metric('events_total','counter','Counted events such as cached fits or skipped candidates.',[([('event',k)],v) for k,v in sorted(snap['counts'].items())])
+        metric('fetched_bytes_total','counter','Bytes downloaded from each source.',[([('source',k)],v) for k,v in sorted(snap['bytes'].items())])
+        metric('fit_iterations_total','counter','Model evaluations of all fits.',[([],sum(snap['fit_calls']))])
+        metric('fits_total','counter','Fits that ran.',[([],len(snap['fit_calls']))])
+        metric('run_start_time_seconds','gauge','Unix time the run started.',[([],self.started)])
+        metric('run_duration_seconds','gauge','Length of the run so far.',[([],time.time()-self.started)])
+        _write(path,'\n'.join(out)+'\n')
+
+def _write(path, text):
+    # so a scraper never reads half of it
+    write_atomic(path,text)
+
+_metrics = run_metrics()
+
+def get_metrics():
+    '''
+    Returns the metrics of this process.
+    '''
+    return _metrics
+
+def reset_metrics():
+    '''
+    Starts new metrics for this process, e.g. at the start of a run.
+
+    Returns
+    -------
+    metrics : run_metrics
+    '''
+    global _metrics
+    _metrics = run_metrics()
+    return _metrics
+
+def count_bytes(client, source):
+    '''
+    Adds a response hook to a requests.Session or httpx.Client that counts the downloaded bytes of every response under source in the metrics current at that time. Streamed requests responses without a Content-Length are counted chunk by chunk as they are read.
+
+    Parameters
+    ----------
+    client : requests.Session or httpx.Client
+        HTTP client of a service.
+    source : str
+        Name the bytes are counted under.
+    '''
+    if getattr(client,'_prep_counted',False):
+        return
+    def requests_hook(r, *args, **kwargs):
+        n = r.headers.get('Content-Length')
+        if n is not None:
+            get_metrics().add_bytes(source,n)
+        elif not kwargs.get('stream'):
+            get_metrics().add_bytes(source,len(r.content))
+        else:
+            # a streamed body of unknown length, e.g. chunked, counts as it is read
+            inner = r.iter_content
+            def iter_content(*args, **kwargs):
+                for chunk in inner(*args,**kwargs):
+                    get_metrics().add_bytes(source,len(chunk if isinstance(chunk,bytes) else chunk.encode('utf-8')))
+                    yield chunk
+            r.iter_content = iter_content
+        return r
+    def httpx_hook(r):
+        n = r.headers.get('content-length')
+        if n is None:
+            n = len(r.read())
+        get_metrics().add_bytes(source,n)
+    if hasattr(client,'event_hooks'):
+        client.event_hooks['response'].append(httpx_hook)
+    else:
+        client.hooks['response'].append(requests_hook)
+    client._prep_counted = True
@@ -0,0 +1,263 @@
+import os
+import time
+import random
+import sqlite3
+import threading
+from .build_rec import get_slack_session, slack_token
+from .metrics import get_metrics
+from .source.store import default_cache_dir
+
+# Slack truncates messages past 40000 characters and recommends staying under 4000
+max_message_chars = 3500
+
+# errors of chat.postMessage worth trying again, see https://api.slack.com/methods/chat.postMessage#errors
+retry_errors = {'ratelimited','internal_error','fatal_error','service_unavailable','request_timeout'}
+# errors caused by the message itself, which is dropped so it does not hold up the rest
+drop_errors = {'no_text','msg_too_long','too_many_attachments','invalid_blocks'}
+
+def chunk_messages(lines,max_chars=max_message_chars):
+    '''
+    Packs lines into as few messages as possible, each at most max_chars long. Lines are kept whole unless a single line is longer than max_chars.
+
+    Parameters
+    ----------
+    lines : list of str
+        Lines to post. Lines that contain newlines are split first and empty lines are dropped.
+    max_chars : int, optional
+        Maximum length of a message. The default is max_message_chars.
+
+    Returns
+    -------
+    messages : list of str
+    '''
+    messages, cur = [], ''
+    for line in (l for item in lines for l in item.split('\n') if l.strip()):
+        while len(line) > max_chars:
+            if cur:
+                messages.append(cur)
+                cur = ''
+            messages.append(line[:max_chars])
+            line = line[max_chars:]
+        if cur and len(cur)+1+len(line) > max_chars:
+            messages.append(cur)
+            cur = ''
+        cur = f'{cur}\n{line}' if cur else line
+    if cur:
+        messages.append(cur)
+    return messages
+
+class slack_outbox:
+
+    def __init__(self,path=None,max_chars=max_message_chars,retries=5,backoff=1.,max_backoff=300.):
+        '''
+        Posts messages to Slack from a background thread. Messages are written to an SQLite outbox first and only removed once Slack accepted them, so messages left over when the process stopped are sent by the next outbox on the same file. Rate limits are waited out for as long as Slack asks in Retry-After, other temporary failures are retried with exponential backoff. Only one outbox should use a file at a time, get_outbox keeps one per process.
+
+        Parameters
+        ----------
+        path : str, optional
+            Path of the SQLite file. The default is None which uses outbox.sqlite in prep.source.store.default_cache_dir().
+        max_chars : int, optional
+            Maximum length of a message, see chunk_messages. The default is max_message_chars.
+        retries : int, optional
+            Attempts of a message after the first that fail without a Retry-After before the thread stops trying, leaving the outbox for the next start. The default is 5.
+        backoff : float, optional
+            Seconds waited after the first failure, doubled after each further one. The default is 1.
+        max_backoff : float, optional
+            Longest wait between two attempts in seconds. The default is 300.
+
+        Attributes
+        ----------
+        sent : int
+            Messages posted by this outbox.
+        dropped : int
+            Messages Slack rejected for their content, see drop_errors.
+        error : str or None
+            Why the thread stopped trying, None while it runs.
+        '''
+        if path is None:
+            os.makedirs(default_cache_dir(),exist_ok=True)
+            path = os.path.join(default_cache_dir(),'outbox.sqlite')
+        self.path = path
+        self.max_chars = max_chars
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.sent = 0
+        self.dropped = 0
+        self.error = None
+        self._done = False
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._stop = threading.Event()
+        self.con = sqlite3.connect(path,check_same_thread=False)
+        with self._lock, self.con:
+            self.con.execute('CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY AUTOINCREMENT, channel TEXT, text TEXT, created REAL)')
+        self._thread = threading.Thread(target=self._run,daemon=True)
+        self._thread.start()
+
+    def send(self,lines,channel):
+        '''
+        Queues lines for a channel, chunked into messages, and returns without waiting for Slack.
+
+        Parameters
+        ----------
+        lines : str or list of str
+            Text to post.
+        channel : str
+            Slack channel id.
+
+        Returns
+        -------
+        n : int
+            Number of messages queued.
+        '''
+        messages = chunk_messages([lines] if isinstance(lines,str) else lines,self.max_chars)
+        with self._changed:
+            with self.con:
+                self.con.executemany('INSERT INTO messages (channel, text, created) VALUES (?,?,?)',
+                                     [(channel,m,time.time()) for m in messages])
+            self._changed.notify_all()
+        return len(messages)
+
+    def pending(self):
+        '''
+        Number of messages not posted yet.
+        '''
+        with self._lock:
+            return self.con.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+
+    def flush(self,timeout=None):
+        '''
+        Waits until every queued message is posted, the thread stopped trying or timeout seconds passed.
+
+        Returns
+        -------
+        pending : int
+            Number of messages not posted yet. They stay in the outbox.
+        '''
+        end = None if timeout is None else time.monotonic()+timeout
+        with self._changed:
+            while True:
+                n = self.con.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+                if n == 0 or self._done:
+                    return n
+                left = None if end is None else end-time.monotonic()
+                if left is not None and left <= 0:
+                    return n
+                self._changed.wait(left)
+
+    def close(self,timeout=None):
+        '''
+        Flushes for up to timeout seconds, then stops the thread. Unsent messages stay in the outbox.
+
+        Returns
+        -------
+        pending : int
+        '''
+        n = self.flush(timeout)
+        self._stop.set()
+        with self._changed:
+            self._changed.notify_all()
+        self._thread.join()
+        with self._lock:
+            self.con.close()
+        return n
+
+    def _next(self):
+        # oldest message, waits for one if the outbox is empty
+        with self._changed:
+            while not self._stop.is_set():
+                row = self.con.execute('SELECT id, channel, text FROM messages ORDER BY id LIMIT 1').fetchone()
+                if row is not None:
+                    return row
+                self._changed.wait()
+
+    def _deliver(self,channel,text):
+        # one attempt, returns ('sent'|'retry'|'fail', seconds Slack asked to wait, error)
+        try:
+            r = get_slack_session().post('https://slack.com/api/chat.postMessage',
+                                         data={'channel':channel,'text':text,'mrkdwn':'true','parse':'none'},
+                                         headers={'Authorization':f'Bearer {slack_token()}'},timeout=30)
+        except RuntimeError as e:
+            return 'fail', None, str(e)
+        except OSError as e:
+            # requests.RequestException is an OSError
+            return 'retry', None, type(e).__name__
+        if r.status_code == 429 or r.status_code >= 500:
+            wait = r.headers.get('Retry-After')
+            return 'retry', float(wait) if wait and wait.replace('.','',1).isdigit() else None, f'HTTP {r.status_code}'
+        if r.status_code >= 400:
+            return 'fail', None, f'HTTP {r.status_code}'
+        try:
+            body = r.json()
+        except ValueError:
+            return 'retry', None, 'bad response'
+        if body.get('ok'):
+            return 'sent', None, None
+        error = body.get('error','unknown error')
+        return ('retry' if error in retry_errors else 'fail'), None, error
+
+    def _run(self):
+        try:
+            self._loop()
+        except Exception as e:
+            self.error = f'{type(e).__name__}: {e}'
+            print(f'Slack posting stopped ({self.error})')
+        finally:
+            with self._changed:
+                self._done = True
+                self._changed.notify_all()
+
+    def _loop(self):
+        failures = 0
+        while True:
+            row = self._next()
+            if row is None:
+                return
+            msg_id, channel, text = row
+            t = time.monotonic()
+            status, wait, error = self._deliver(channel,text)
+            get_metrics().observe('post',time.monotonic()-t,None if status == 'sent' else error.split(':')[0])
+            if status == 'sent' or error in drop_errors:
+                failures = 0
+                with self._changed:
+                    with self.con:
+                        self.con.execute('DELETE FROM messages WHERE id=?',(msg_id,))
+                    if status == 'sent':
+                        self.sent += 1
+                    else:
+                        self.dropped += 1
+                        print(f'Slack rejected a message ({error}), it was dropped')
+                    self._changed.notify_all()
+                continue
+            if status == 'retry' and wait is not None:
+                # a rate limit, Slack says how long it lasts
+                delay = wait
+            elif status == 'retry' and failures < self.retries:
+                failures += 1
+                delay = min(self.max_backoff,self.backoff*2**(failures-1))*random.uniform(0.5,1.)
+            else:
+                self.error = error
+                print(f'Slack posting stopped after {failures+1} attempts ({error}), {self.pending()} messages stay in the outbox')
+                return
+            if self._stop.wait(delay):
+                return
+
+_outbox = None
+
+def get_outbox():
+    '''
+    Returns the outbox of this process, creating it on first use. It sends messages left over by an earlier process right away.
+
+    Returns
+    -------
+    outbox : slack_outbox
+    '''
+    global _outbox
+    if _outbox is not None and _outbox._done:
+        # it gave up earlier, e.g. on a bad token, so try again with a fresh one
+        _outbox.close(0)
+        _outbox = None
+    if _outbox is None:
+        _outbox = slack_outbox()
+    return _outbox
@@ -0,0 +1,136 @@
+import os
+import json
+from prep.fetch import candidate_name, candidate_mjd
+from prep.source.store import default_cache_dir
+from prep.atomic import write_atomic
+
+class poll_state:
+
+    def __init__(self,path=None,overlap=1.,keep=30.,max_retries=3):
+        '''
+        Watermarks of continuous polling. For each source it keeps the latest detection MJD seen so far and the latest detection of every candidate already handed out, so a poll only asks the source for objects detected since the last one and only passes on candidates that are new or have new detections.
+
+        Parameters
+        ----------
+        path : str, optional
+            JSON file the state is kept in between processes. The default is None which uses poll.json in prep.source.store.default_cache_dir(). Pass False to keep it in memory only.
+        overlap : float, optional
+            Days before the watermark a poll goes back to, for detections that reach a broker after later ones. Candidates seen before are still skipped. The default is 1.
+        keep : float, optional
+            Days behind the watermark after which a candidate is forgotten. The default is 30.
+        max_retries : int, optional
+            Polls a candidate that was not dealt with, e.g. a failed download or fit, is tried again in before it is given up and counted as seen. Until then it holds its source's watermark back. The default is 3.
+
+        Attributes
+        ----------
+        watermarks : dict
+            Latest detection MJD seen per source.
+        seen : dict
+            Per source, latest detection MJD of each candidate handed out, None where the source did not report one.
+        failures : dict
+            Per source, number of polls in a row each candidate was not dealt with.
+        '''
+        if path is None:
+            os.makedirs(default_cache_dir(),exist_ok=True)
+            path = os.path.join(default_cache_dir(),'poll.json')
+        self.path = path
+        self.overlap = overlap
+        self.keep = keep
+        self.max_retries = max_retries
+        self.watermarks = {}
+        self.seen = {}
+        self.failures = {}
+        self._pending = None
+        if path and os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            self.watermarks, self.seen = state['watermarks'], state['seen']
+            self.failures = state.get('failures',{})
+
+    def since(self,sources):
+        '''
+        MJD each source should be queried from.
+
+        Returns
+        -------
+        since : dict
+            Per source, the watermark minus overlap, or None before the first poll of the source.
+        '''
+        return {s:None if self.watermarks.get(s) is None else self.watermarks[s]-self.overlap for s in sources}
+
+    def new(self,candidates):
+        '''
+        Drops the candidates handed out before without newer detections. The others are remembered once commit is called with them, so a poll that fails before that, or a candidate that failed, is repeated.
+
+        Parameters
+        ----------
+        candidates : list of tuple
+            (source, item) pairs from prep.auto.get_candidates.
+
+        Returns
+        -------
+        candidates : list of tuple
+            The new and updated candidates.
+        '''
+        out = []
+        pending = {}
+        for source, item in candidates:
+            name, mjd = candidate_name(source,item), candidate_mjd(source,item)
+            seen = self.seen.get(source,{})
+            if name in seen and (mjd is None or (seen[name] is not None and mjd <= seen[name])):
+                continue
+            pending[(source,name)] = mjd
+            out.append((source,item))
+        self._pending = pending
+        return out
+
+    def commit(self,done=None):
+        '''
+        Remembers the candidates of the last call of new that were dealt with, moves the watermarks and saves the state. A watermark does not move past the latest detection of a candidate that was left out, so the next poll asks its source for it again.
+
+        Parameters
+        ----------
+        done : list of tuple, optional
+            (source, item) pairs of the candidates that were fitted or deliberately dropped. The others, e.g. failed downloads or fits, stay new for the next poll until they failed in more than max_retries polls. The default is None which remembers all of them.
+        '''
+        pending = self._pending or {}
+        if done is not None:
+            done = {(source,candidate_name(source,item)) for source, item in done}
+        retry = {}
+        failures = {s:f for s,f in self.failures.items() if s not in {s for s,_ in pending}}
+        for (source, name), mjd in pending.items():
+            if done is not None and (source,name) not in done:
+                n = self.failures.get(source,{}).get(name,0)+1
+                if n <= self.max_retries:
+                    failures.setdefault(source,{})[name] = n
+                    if mjd is not None:
+                        retry[source] = min(mjd,retry.get(source,mjd))
+                    continue
+                print(f'giving up on {name} after {n} failed polls')
+            self.seen.setdefault(source,{})[name] = mjd
+        # counts of candidates that are not new any more, or were dealt with, are dropped
+        self.failures = failures
+        for source in {s for s,_ in pending}:
+            mjds = [v for v in self.seen.get(source,{}).values() if v is not None]
+            if not mjds:
+                continue
+            mjd = min(max(mjds),retry.get(source,max(mjds)))
+            if mjd > (self.watermarks.get(source) or -1):
+                self.watermarks[source] = mjd
+        self._pending = None
+        for source, seen in self.seen.items():
+            w = self.watermarks.get(source)
+            if w is not None:
+                self.seen[source] = {k:v for k,v in seen.items() if v is None or v >= w-self.keep}
+        if self.path:
+            write_atomic(self.path,json.dumps({'watermarks':self.watermarks,'seen':self.seen,'failures':self.failures}))
+
+    def report(self):
+        '''
+        Summary of the watermarks.
+
+        Returns
+        -------
+        report : str
+        '''
+        return 'watermarks: '+', '.join(f'{s} {w:.4f}' for s,w in self.watermarks.items())
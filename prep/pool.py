@@ -0,0 +1,209 @@
+import time
+import threading
+import multiprocessing as mp
+from multiprocessing.connection import wait
+from collections import deque
+
+def _worker(conn, initializer=None):
+    '''
+    Loop of a fit_pool worker process: runs the tasks received on conn until it gets None.
+    '''
+    if initializer is not None:
+        try:
+            initializer()
+        except Exception as e:
+            # only a warm-up, the tasks report the error if it matters
+            print(f'worker initializer failed\n{e}')
+    # tells the pool that the time limit of a task can start counting
+    conn.send(None)
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+        key, fn, args = task
+        try:
+            out = (key,'done',fn(*args))
+        except Exception as e:
+            out = (key,'error',f'{type(e).__name__}: {e}')
+        conn.send(out)
+    conn.close()
+
+class fit_pool:
+
+    def __init__(self, workers=1, time_limit=None, initializer=None, context='forkserver', preload=None):
+        '''
+        Process pool whose tasks can be cancelled. Every worker runs one task at a time, and a worker whose task takes longer than time_limit is killed and replaced, which a concurrent.futures pool cannot do. submit may be called from another thread while results is iterated.
+
+        Parameters
+        ----------
+        workers : int, optional
+            Number of worker processes. The default is 1.
+        time_limit : float, optional
+            Seconds a single task may run. The default is None for no limit.
+        initializer : callable, optional
+            Called once in every worker process when it starts, e.g. prep.source.salt.warm_cache. The default is None.
+        context : str, optional
+            multiprocessing start method. The default is 'forkserver'.
+        preload : list of str, optional
+            Modules the fork server imports once before it starts forking workers, so a worker that replaces a killed one starts quickly. Only used with 'forkserver' when the server is not running yet. The default is None.
+
+        Attributes
+        ----------
+        timed_out : list
+            Keys of the tasks that were killed.
+        skipped : list
+            Keys of the tasks that were not run because the deadline passed.
+        '''
+        self.ctx = mp.get_context(context)
+        if preload and context == 'forkserver':
+            self.ctx.set_forkserver_preload(preload)
+        self.time_limit = time_limit
+        self.initializer = initializer
+        self.workers = []
+        self.queue = deque()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.aborted = False
+        self.timed_out = []
+        self.skipped = []
+        for _ in range(max(1,workers)):
+            self.workers.append(self._spawn())
+
+    def _spawn(self):
+        parent, child = self.ctx.Pipe()
+        proc = self.ctx.Process(target=_worker,args=(child,self.initializer),daemon=True)
+        proc.start()
+        child.close()
+        return {'proc':proc,'conn':parent,'task':None,'ready':False}
+
+    def _replace(self, w):
+        # kills the worker of w and puts a fresh one in its place
+        w['proc'].kill()
+        w['proc'].join()
+        w['conn'].close()
+        w.update(self._spawn())
+
+    def _dispatch(self):
+        # called with the lock held
+        for w in self.workers:
+            if w['ready'] and w['task'] is None and self.queue:
+                key, fn, args = self.queue.popleft()
+                w['conn'].send((key,fn,args))
+                w['task'] = (key,time.monotonic())
+
+    def submit(self, key, fn, *args):
+        '''
+        Queues fn(*args). Its result is yielded by results under key. Tasks submitted after the deadline are counted as skipped.
+        '''
+        with self.lock:
+            if self.aborted:
+                self.skipped.append(key)
+                return
+            self.queue.append((key,fn,args))
+            self._dispatch()
+
+    def close(self):
+        '''
+        Signals that no more tasks will be submitted, so results ends once the queue is empty.
+        '''
+        with self.lock:
+            self.closed = True
+
+    def results(self, deadline=None):
+        '''
+        Runs the queued tasks and yields their outcomes as they finish, until close was called and every task is done.
+
+        Parameters
+        ----------
+        deadline : float, optional
+            time.monotonic() value at which running tasks are killed and queued ones skipped. The default is None.
+
+        Yields
+        ------
+        key
+            Key the task was submitted with.
+        status : str
+            'done', 'error' if fn raised, 'timeout' if it ran out of time_limit or 'skipped' if the deadline passed first.
+        value
+            Return value of fn for 'done', the error message for 'error', else None.
+        '''
+        while True:
+            with self.lock:
+                self._dispatch()
+                busy = [w for w in self.workers if w['task'] is not None]
+                starting = [w for w in self.workers if not w['ready']]
+                if not busy and not self.queue and self.closed:
+                    return
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                yield from self._abort()
+                return
+            # short enough to pick up tasks submitted from another thread
+            waits = [0.1]
+            if deadline is not None:
+                waits.append(deadline-now)
+            if self.time_limit is not None:
+                waits += [w['task'][1]+self.time_limit-now for w in busy]
+            if busy or starting:
+                ready = wait([w['conn'] for w in busy+starting],timeout=max(0.,min(waits)))
+            else:
+                ready = []
+                time.sleep(max(0.,min(waits)))
+            for w in starting:
+                if w['conn'] in ready:
+                    try:
+                        w['ready'] = w['conn'].recv() is None
+                    except (EOFError,OSError):
+                        # the worker died while starting
+                        self._replace(w)
+            for w in busy:
+                key = w['task'][0]
+                if w['conn'] in ready:
+                    try:
+                        out = w['conn'].recv()
+                    except (EOFError,OSError):
+                        self._replace(w)
+                        out = (key,'error','worker process died')
+                    w['task'] = None
+                    yield out
+                elif self.time_limit is not None and time.monotonic()-w['task'][1] > self.time_limit:
+                    self._replace(w)
+                    self.timed_out.append(key)
+                    yield key, 'timeout', None
+
+    def _abort(self):
+        with self.lock:
+            self.aborted = True
+            self.closed = True
+            keys = [w['task'][0] for w in self.workers if w['task'] is not None]+[t[0] for t in self.queue]
+            self.queue.clear()
+            # no replacements, the pool is done
+            for w in self.workers:
+                w['proc'].kill()
+                w['proc'].join()
+        self.skipped += keys
+        for key in keys:
+            yield key, 'skipped', None
+
+    def shutdown(self):
+        '''
+        Stops the workers, killing the ones that are still busy.
+        '''
+        for w in self.workers:
+            try:
+                if w['task'] is None and w['proc'].is_alive():
+                    w['conn'].send(None)
+            except (BrokenPipeError,OSError):
+                pass
+        for w in self.workers:
+            w['proc'].join(timeout=1)
+            if w['proc'].is_alive():
+                w['proc'].kill()
+                w['proc'].join()
+            w['conn'].close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
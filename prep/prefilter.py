@@ -0,0 +1,139 @@
+import numpy as np
+from astropy.time import Time
+from prep.source.photometry import combine_lightcurves
+
+# sncosmo bandpasses that count as g and r for the color cut
+g_bands = ['sdssg','cspg']
+r_bands = ['sdssr','cspr']
+
+# Default thresholds of candidate_filter, applied in this order. None switches a cut off.
+# They are not tuned against past recommendations, so the prefilter is off unless asked for.
+prefilter_cuts = {
+    'max_age':40.,        # days since the first detection
+    'min_rise':0.01,      # brightening from the first detection to the peak in mag/day
+    'max_color':1.0,      # g-r of the latest g and r points
+    'max_peak_mag':21.5,  # brightest magnitude
+}
+
+def lc_features(lc,now=None,color_window=1.5):
+    '''
+    Computes cheap features of a light curve.
+
+    Parameters
+    ----------
+    lc : prep.source.photometry.lightcurve
+        Light curve of the object.
+    now : float, optional
+        MJD the age is measured from. The default is None which uses the current time.
+    color_window : float, optional
+        Maximum time in days between the g and r points used for the color. The default is 1.5.
+
+    Returns
+    -------
+    features : dict
+        age (days since the first detection), rise (largest brightening rate from the first point to the peak of a band, in mag/day, 0 if every band only faded), color (g-r of the latest g and r points) and peak_mag. Features that cannot be measured, e.g. the rise of a light curve with one point per band, are NaN.
+    '''
+    if now is None:
+        now = Time.now().mjd
+    ok = (lc.flux > 0) & np.isfinite(lc.flux)
+    mjd, band = lc.mjd[ok], lc.band_name[ok]
+    mag = lc.zp[ok]-2.5*np.log10(lc.flux[ok])
+    f = dict.fromkeys(['age','rise','color','peak_mag'],np.nan)
+    if mjd.size == 0:
+        return f
+    f['age'] = now-mjd.min()
+    f['peak_mag'] = mag.min()
+    rises = []
+    for b in np.unique(band):
+        # a band that only faded has no rise, one with a single point can not tell
+        order = np.flatnonzero(band == b)[np.argsort(mjd[band == b],kind='stable')]
+        if order.size < 2:
+            continue
+        first, peak = order[0], order[np.argmin(mag[order])]
+        dt = mjd[peak]-mjd[first]
+        rises.append((mag[first]-mag[peak])/dt if dt > 0 else 0.)
+    if rises:
+        f['rise'] = max(rises)
+    # color of the latest g and r points
+    last = {}
+    for name,sel in [('g',g_bands),('r',r_bands)]:
+        m = np.isin(band,sel)
+        if m.any():
+            k = np.flatnonzero(m)[np.argmax(mjd[m])]
+            last[name] = mjd[k], mag[k]
+    if len(last) == 2 and abs(last['g'][0]-last['r'][0]) <= color_window:
+        f['color'] = last['g'][1]-last['r'][1]
+    return f
+
+class candidate_filter:
+
+    def __init__(self,cuts=None,now=None):
+        '''
+        Rejects candidates that are clearly not young SNe Ia before they are fitted, from the features of lc_features, one object at a time as their light curves arrive. A feature that cannot be measured passes its cut. Keeps count of the candidates dropped by each cut.
+
+        Parameters
+        ----------
+        cuts : dict, optional
+            Thresholds that replace the ones of prefilter_cuts, e.g. {'max_age':20}. A value of None switches a cut off. The default is None.
+        now : float, optional
+            MJD the age is measured from. The default is None which uses the current time.
+        '''
+        unknown = set(cuts or {})-set(prefilter_cuts)
+        if unknown:
+            raise ValueError(f'unknown prefilter cuts {sorted(unknown)}, choose from {list(prefilter_cuts)}')
+        self.cuts = dict(prefilter_cuts)
+        self.cuts.update(cuts or {})
+        self.now = Time.now().mjd if now is None else now
+        self.seen = 0
+        self.dropped = dict.fromkeys(self.cuts,0)
+
+    def keep(self,lc):
+        '''
+        Applies the cuts to a light curve.
+
+        Parameters
+        ----------
+        lc : prep.source.photometry.lightcurve
+            Light curve of the candidate.
+
+        Returns
+        -------
+        keep : bool
+            False if the candidate was rejected.
+        '''
+        f = lc_features(lc,self.now)
+        tests = {'max_age':lambda v: not f['age'] > v,'min_rise':lambda v: not f['rise'] < v,
+                 'max_color':lambda v: not f['color'] > v,'max_peak_mag':lambda v: not f['peak_mag'] > v}
+        self.seen += 1
+        for name,value in self.cuts.items():
+            if value is not None and not tests[name](value):
+                self.dropped[name] += 1
+                return False
+        return True
+
+    def keep_object(self,obj,extra=None):
+        '''
+        Applies the cuts to a fetched source object, together with the light curves of the same object from other sources if given. Objects whose light curve cannot be built are kept so the fit reports the failure.
+
+        Returns
+        -------
+        keep : bool
+        '''
+        try:
+            lc = obj.to_lightcurve()
+            if extra:
+                lc = combine_lightcurves([lc]+list(extra))
+        except Exception:
+            return True
+        return self.keep(lc)
+
+    def report(self):
+        '''
+        Summary of the candidates dropped by each cut.
+
+        Returns
+        -------
+        report : str
+        '''
+        total = sum(self.dropped.values())
+        return f'prefilter dropped {total} of {self.seen}: '+', '.join(f'{k} {v}' for k,v in self.dropped.items() if self.cuts[k] is not None)
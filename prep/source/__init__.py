@@ -1,4 +1,4 @@
-from .alerce_api import *
-from .antares import *
-from .yse import *
-from .bandpassdict import *
\ No newline at end of file
+from ..lazy import lazy_exports
+
+# the names of these modules are exported, each is imported the first time one of its names is used
+__getattr__, __dir__ = lazy_exports(__name__,['alerce_api','antares','yse','bandpassdict','salt','photometry','store','sky','table'])
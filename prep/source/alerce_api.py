@@ -1,22 +1,71 @@
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
 from astropy.time import Time
 import astropy.units as u
-from alerce.core import Alerce
 from .bandpassdict import *
-import sncosmo
-from astropy.table import Table
-from astro_ghost.ghostHelperFunctions import getTransientHosts
-from antares_client.search import get_by_ztf_object_id
-from . import antares
+from .salt import *
+from .photometry import *
+from . import antares,yse
 import tempfile
 from astropy.coordinates import SkyCoord
-alerce = Alerce()
+from concurrent.futures import ThreadPoolExecutor
+from ..metrics import count_bytes
+from ..transport import install
+_alerce = None
+
+def get_alerce():
+    '''
+    Returns the ALeRCE client of this process, creating it on first use so that importing this module does not.
+
+    Returns
+    -------
+    client : alerce.core.Alerce
+    '''
+    global _alerce
+    if _alerce is None:
+        from alerce.core import Alerce
+        _alerce = Alerce()
+        # the client holds a session for each API it talks to
+        for c in [_alerce]+list(vars(_alerce).values()):
+            if hasattr(c,'session'):
+                count_bytes(c.session,'alerce')
+                install(c.session,'alerce')
+    return _alerce
+
+def __getattr__(name):
+    # alerce used to be a module level client
+    if name == 'alerce':
+        return get_alerce()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+def default_query(days=7,since=None):
+    '''
+    The default ALeRCE query: objects first detected in the last days that lc_classifier calls SNIa.
+
+    Parameters
+    ----------
+    days : float, optional
+        Length of the time window. The default is 7.
+    since : float, optional
+        If given, only objects with a detection at or after this MJD are returned. The default is None.
+
+    Returns
+    -------
+    query : dict
+        Parameters of alerce.query_objects, without paging.
+    '''
+    query = {
+        "classifier": "lc_classifier",
+        "class_name": "SNIa",
+        'firstmjd': [(Time.now()-days*u.day).mjd,Time.now().mjd],
+        }
+    if since is not None:
+        query['lastmjd'] = [since,Time.now().mjd]
+    return query
 
 def query_alerce(query=None):
     '''
-    Queries ALeRCE for SNe Ia, Ib/c, and II in the last 7 days. Uses lc_classifier to find new objects.
+    Queries ALeRCE for SNe Ia, Ib/c, and II in the last 7 days. Uses lc_classifier to find new objects. Only returns one page, use iter_alerce to get all of them.
 
     Parameters
     ----------
@@ -30,15 +79,130 @@ def query_alerce(query=None):
     '''
     sne =['SNIa','SNIbc','SNII']
     if query is None:
-        query = {
-        "classifier": "lc_classifier",
-        "class_name": "SNIa",
-        'firstmjd': [(Time.now()-7*u.day).mjd,Time.now().mjd], # and last 3 days
-        'page_size':50
-        }
-    objects = alerce.query_objects(**query)
+        query = dict(default_query(),page_size=50)
+    objects = get_alerce().query_objects(**query)
     return objects
 
+def iter_alerce(query=None,page_size=50,max_pages=None,prefetch=True):
+    '''
+    Streams the results of an ALeRCE query page by page. The next page is requested in the background while the current one is processed, and only those two pages are held in memory. Stop iterating, or close the generator, to end the query early.
+
+    Parameters
+    ----------
+    query : dict, optional
+        Parameters of alerce.query_objects. page and page_size are set by this function. The default is None which uses default_query().
+    page_size : int, optional
+        Number of objects per page. The default is 50.
+    max_pages : int, optional
+        Maximum number of pages. The default is None which reads every page.
+    prefetch : bool, optional
+        If True, requests the next page while the caller works on the current one. The default is True.
+
+    Yields
+    ------
+    page : pd.DataFrame
+        The objects of one page.
+    '''
+    query = dict(default_query() if query is None else query)
+    query.pop('page',None)
+    query['page_size'] = page_size
+    client = get_alerce()
+    get = lambda n: client.query_objects(page=n,**query)
+    ex = ThreadPoolExecutor(max_workers=1)
+    try:
+        page, n = get(1), 1
+        while len(page):
+            last = len(page) < page_size or (max_pages is not None and n >= max_pages)
+            nxt = ex.submit(get,n+1) if not last and prefetch else None
+            yield page
+            if last:
+                return
+            page = nxt.result() if prefetch else get(n+1)
+            n += 1
+    finally:
+        # on early termination a prefetch still in flight is left to finish in the background, not waited for
+        ex.shutdown(wait=False,cancel_futures=True)
+
+# Top class and probability of each oid, filled by prefetch_probabilities and page_probabilities.
+_top_class = {}
+
+def prefetch_probabilities(oids,classifier='lc_classifier',chunk=50):
+    '''
+    Fetches the top class of many objects with one query_objects request per chunk instead of one query_probabilities request per object. The result is cached for get_top_class and the class gate of get_lc and salt3.
+
+    Parameters
+    ----------
+    oids : list of str
+        ZTF object ids.
+    classifier : str, optional
+        ALeRCE classifier. The default is 'lc_classifier'.
+    chunk : int, optional
+        Number of objects per request. The default is 50.
+
+    Returns
+    -------
+    top : pd.DataFrame
+        class_name and probability of each oid, indexed by oid. Objects without a classification have class_name 'Not_classified'.
+    '''
+    oids = list(dict.fromkeys(oids))
+    todo = [o for o in oids if (classifier,o) not in _top_class]
+    for i in range(0,len(todo),chunk):
+        part = todo[i:i+chunk]
+        res = get_alerce().query_objects(oid=part,classifier=classifier,ranking=1,page_size=len(part),format='pandas')
+        res = res.rename(columns={'class':'class_name'})
+        for o in part:
+            _top_class[(classifier,o)] = ('Not_classified',None)
+        for o,c,p in zip(res.oid,res.class_name,res.probability):
+            _top_class[(classifier,o)] = (c,p)
+    return pd.DataFrame([_top_class[(classifier,o)] for o in oids],index=pd.Index(oids,name='oid'),columns=['class_name','probability'])
+
+def page_probabilities(page,query,classifier='lc_classifier'):
+    '''
+    Top class of the objects of a query page. A query filtered by classifier and class_name already returns the probability of that class at ranking 1, the default, so it is read from the page and cached like prefetch_probabilities does. Pages of other queries are passed on to prefetch_probabilities.
+
+    Parameters
+    ----------
+    page : pd.DataFrame
+        A page of iter_alerce.
+    query : dict
+        The query of the page.
+    classifier : str, optional
+        ALeRCE classifier. The default is 'lc_classifier'.
+
+    Returns
+    -------
+    top : pd.DataFrame
+        class_name and probability of each oid, indexed by oid.
+    '''
+    filtered = query.get('classifier') == classifier and query.get('class_name') is not None and query.get('ranking',1) == 1
+    if not filtered or 'probability' not in page:
+        return prefetch_probabilities(page['oid'].values,classifier,chunk=len(page))
+    names = page['class'] if 'class' in page else [query['class_name']]*len(page)
+    for o,c,p in zip(page['oid'],names,page['probability']):
+        _top_class[(classifier,o)] = (c,None if p != p else p)
+    oids = list(dict.fromkeys(page['oid']))
+    return pd.DataFrame([_top_class[(classifier,o)] for o in oids],index=pd.Index(oids,name='oid'),columns=['class_name','probability'])
+
+def class_gate(top_class,min_prob,class_name='SNIa'):
+    '''
+    Whether a top class passes the class gate.
+
+    Parameters
+    ----------
+    top_class : tuple
+        (class_name, probability) as returned by alerce_object.get_top_class.
+    min_prob : float
+        Minimum probability of the top class.
+    class_name : str, optional
+        Required top class. The default is 'SNIa'.
+
+    Returns
+    -------
+    passes : bool
+    '''
+    c, p = top_class
+    return c == class_name and p is not None and p >= min_prob
+
 class alerce_object:
 
     def __init__(self,aobject):
@@ -62,11 +226,17 @@ class alerce_object:
             The mean declination of the object.
         url : str
             The url of the object in alerce.
+        lastmjd : float or None
+            MJD of the last detection reported by the query, used to decide if a stored light curve is up to date.
+        top_class : tuple or None
+            lc_classifier top class and probability if fetched with prefetch_probabilities. Kept on the object so it travels to worker processes.
         '''
         self.oid =aobject.oid
         self.name = self.oid
         self.ra, self.dec= aobject.meanra,aobject.meandec
         self.url = f"https://alerce.online/object/{self.oid}"
+        self.lastmjd = getattr(aobject,'lastmjd',None)
+        self.top_class = _top_class.get(('lc_classifier',self.oid))
 
 
     def check_antares(self,verbose=False):
@@ -83,6 +253,8 @@ class alerce_object:
         antares_object : prep.source.antares.antares_object or None
             Returns the antares_object if found in Antares, else None.
         '''
+        from antares_client.search import get_by_ztf_object_id
+        antares.connect()
         cat = get_by_ztf_object_id(self.oid)
         if cat is None:
             return 
@@ -91,7 +263,7 @@ class alerce_object:
                 print('Found in Antares')
             return antares.antares_object(cat)
         
-    def check_yse(self,verbose=False):
+    def check_yse(self,verbose=False,index=None,radius=2.0):
         '''
         Cross-checks if the object is in YSE. Uses Antares object to query YSE. Very hacky but alerce does not provide TNS names.
 
@@ -99,12 +271,18 @@ class alerce_object:
         ----------
         verbose : bool, optional
             If True, prints if the object is found in YSE. The default is False.
+        index : prep.source.sky.sky_index, optional
+            Local index of known YSE objects, e.g. lc_store().sky_index('yse'). If given, the object is matched by position in the index instead of through the network. The default is None.
+        radius : float, optional
+            Match radius in arcseconds when index is given. The default is 2.
 
         Returns
         -------
         yse_object : prep.source.yse.yse_object or None
             Returns the yse_object if found in YSE, else None.
         '''
+        if index is not None:
+            return yse.match_yse(self.ra,self.dec,index,radius=radius,verbose=verbose)
         return self.check_antares(verbose=verbose).check_yse(verbose=verbose)
     
     def get_probabilities(self):
@@ -116,7 +294,7 @@ class alerce_object:
         probs : json dict
             The probabilities for each classifier from alerce.
         '''
-        self.probs = alerce.query_probabilities(self.oid,format="json")
+        self.probs = get_alerce().query_probabilities(self.oid,format="json")
         return self.probs
     
     def get_top_class(self): 
@@ -126,8 +304,10 @@ class alerce_object:
         Returns
         -------
         top_class : tuple
-            The top class and probability.
+            The top class and probability. Taken from prefetch_probabilities if it has the object.
         '''
+        if getattr(self,'top_class',None) is not None:
+            return self.top_class
         # From Patrick Aleo
         try:
             output = self.probs
@@ -150,22 +330,53 @@ class alerce_object:
         # print(top_class['class_name'],top_class['probability'])
         return (top_class['class_name'],top_class['probability']) if top_class is not None else ("Not_classified",None)
         
-    def get_lc(self):
+    def check_class(self,min_prob=None):
+        '''
+        Class gate of get_lc and salt3. Raises if ALeRCE's top class of the object is not SNIa with at least min_prob.
+
+        Parameters
+        ----------
+        min_prob : float, optional
+            Minimum SNIa probability. The default is None which lets every object through.
+        '''
+        if min_prob is None:
+            return
+        top = self.get_top_class()
+        if not class_gate(top,min_prob):
+            raise ValueError(f'{self.oid} top class is {top[0]} (p={top[1]}), below the class gate of SNIa p>={min_prob}')
+
+    def get_lc(self,store=None,min_prob=None):
         '''
         Gets the light curve from alerce.
 
+        Parameters
+        ----------
+        store : prep.source.store.lc_store, optional
+            Light curve store. If it holds the object up to lastmjd the download is skipped, otherwise the downloaded light curve is stored. ALeRCE only serves full detection histories so an outdated entry is refreshed in full. The default is None.
+        min_prob : float, optional
+            If given, raises instead of downloading when the object fails the class gate, see check_class. The default is None.
+
         Returns
         -------
         lc : pd.DataFrame
             The light curve from alerce. Real detections only.
         '''
-        self.lc = alerce.query_detections(self.oid,format="pandas").query('has_stamp==True')
+        self.check_class(min_prob)
+        if store is not None:
+            lc = store.get('alerce',self.oid,self.lastmjd)
+            if lc is not None:
+                self.lc = lc
+                return self.lc
+        self.lc = get_alerce().query_detections(self.oid,format="pandas").query('has_stamp==True')
+        if store is not None and len(self.lc):
+            store.put('alerce',self.oid,self.lc,self.lc['mjd'].max())
         return self.lc
     
     def plot_lc(self):
         '''
         Plot the light curve from alerce.
         '''
+        import matplotlib.pyplot as plt
         try:
             self.lc
         except:
@@ -177,7 +388,26 @@ class alerce_object:
         plt.title(self.oid)
         plt.show()
     
-    def salt3(self,plot=False):
+    def to_lightcurve(self):
+        '''
+        Converts the light curve from alerce to the columnar lightcurve used for fitting. Need to run get_lc first.
+
+        Returns
+        -------
+        lcurve : prep.source.photometry.lightcurve
+            Detections in the ZTF g and r bands.
+        '''
+        try:
+            self.lc
+        except:
+            raise ValueError('Need to run get_lc first')
+        self.lcm = self.lc[~self.lc[['mjd','magpsf','sigmapsf']].isna().any(axis=1)]
+        # ztf  - g and r, mapped through bandpassdict like for yse
+        self.lcurve = lightcurve.from_mag(self.lcm['mjd'].values,self.lcm['magpsf'].values,self.lcm['sigmapsf'].values,
+                                          self.lcm['fid'].map(ztf_fid).values)
+        return self.lcurve
+
+    def salt3(self,plot=False,cache=None,warm=False,extra=None,method='minuit',min_prob=None):
         '''
         Run salt3 on the light curve from alerce. Need to run get_lc first.
 
@@ -185,63 +415,31 @@ class alerce_object:
         ----------
         plot : bool, optional
             If True, plots the light curve and the salt3 fit. The default is False.
+        cache : prep.source.store.fit_store, optional
+            Fit cache. If the photometry and fit configuration are unchanged since a stored fit, the fit is skipped and only the phase is recomputed. The default is None.
+        warm : bool, optional
+            If True, starts the fit from the last cached fit of this object and falls back to a cold fit if that goes wrong. Needs cache. The default is False.
+        extra : list of prep.source.photometry.lightcurve, optional
+            Photometry of the same object from other surveys, merged into the fit with combine_lightcurves. The default is None.
+        method : str, optional
+            'minuit' fits with sncosmo.fit_lc over the full bounds, 'grid' searches a redshift, color and t0 grid first and polishes the best cell, 'table' does that with precomputed bandfluxes. The default is 'minuit'.
+        min_prob : float, optional
+            If given, raises instead of fitting when the object fails the class gate, see check_class. The default is None.
 
         Returns
         -------
         salt_params : dict
             The salt3 parameters and errors.
         '''
-        try:
-            self.lc
-        except:
-            raise ValueError('Need to run get_lc first')
-        self.lcm = self.lc[~self.lc[['mjd','magpsf','sigmapsf']].isna().any(axis=1)]
-        # Need to figure out ztf passbands
-        # ztf  - g and r
-        # doing the same thing as for yse
-        salt2band = []
-        zpsys =[]
-        mask = []
-        for i in range(len(self.lcm.mjd.values)):
-            if self.lcm.fid.values[i] == 1:
-                salt2band.append(bandpassdict['Band: ZTF-Cam - g-ZTF'])
-                mask.append(True)
-            elif self.lcm.fid.values[i] == 2:
-                salt2band.append(bandpassdict['Band: ZTF-Cam - r-ZTF'])
-                mask.append(True)
-            else:
-                salt2band.append('None')
-                mask.append(False)
-            zpsys.append('AB')
-        
-        model = sncosmo.Model(source='salt3')
-        fitparams = ['z', 't0', 'x0', 'x1', 'c']
-        mask = mask
-        salt2mjd = self.lcm['mjd'][mask].values
-        mag = self.lcm['magpsf'][mask].values
-        flux = 10**(-0.4*(mag-27.5))
-        # flux = pdata['FLUXCAL'][mask].values
-        mag_err=self.lcm['sigmapsf'][mask].values
-        # mag_err[(mag_err < 0.01)|(mag_err ==None)]=0.01
-        fluxerr = flux*mag_err*0.4*np.log(10)
-        # fluxerr = pdata['FLUXCALERR'][mask].values
-        zp = np.array([27.5]*len(salt2band))[mask]
-        zpsys = np.array(zpsys)
-        salt2band = np.array(salt2band)
-        zpsys = zpsys[mask]
-        salt2band = salt2band[mask]
-
-        data = Table([salt2mjd,salt2band,flux,fluxerr,zp,zpsys],names=['mjd','band','flux','fluxerr','zp','zpsys'],meta={'t0':salt2mjd[flux == np.max(flux)]})
-        result, fitted_model = sncosmo.fit_lc(
-                    data, model, fitparams,
-                    bounds={'t0':(salt2mjd[flux == np.max(flux)]-10, salt2mjd[flux == np.max(flux)]+10),
-                            'z':(0.0,0.7),'x1':(-3,3),'c':(-0.3,0.3)})  # bounds on parameters (if any)
-        print('points fitted =',len(salt2mjd))
+        self.check_class(min_prob)
+        self.to_lightcurve()
+        if extra:
+            self.lcurve = combine_lightcurves([self.lcurve]+list(extra))
+        self.salt_params, result, fitted_model = fit_salt3(self.lcurve,cache=cache,name=self.name,warm=warm,method=method)
+        print('points fitted =',len(self.lcurve))
         print('chisq =',result['chisq'])
-        today = Time.now().mjd
-        lcphase = today-result['parameters'][1]
-        lcp =lcphase
         if plot:
+            lcphase = self.salt_params['phase']
             if lcphase > 0: lcphase = '+%.1f'%(lcphase)
             else: lcphase = '%.1f'%(lcphase)
             print("phase = %s days"%(lcphase))
@@ -250,24 +448,9 @@ class alerce_object:
             print('ms = %.2f'%(10.635-2.5*np.log10(result['parameters'][2])))
             print('x1 = %.2f'%(result['parameters'][3]))
             print('c = %.2f'%(result['parameters'][4]))
-            # for i in range(len(result['param_names'])):
-            #     if i==2:
-            #         print('ms =',10.635-2.5*np.log10(result.parameters[i]))
-            #     else:
-            #         rp=result['parameters'][i]
-            #         print(result['param_names'][i],'=',f'%i'%(rp))
-        
-        params = np.array([result['chisq'],lcp, result['parameters'][0],
-                                      result['parameters'][1],
-                                      10.635-2.5*np.log10(result['parameters'][2]),
-                                      result['parameters'][3],
-                                      result['parameters'][4],
-                                      len(salt2mjd)]+list(result['errors'].values()))
-        pnames = ['chisq','phase','z','t0','ms','x1','c','npoints']+list(key+'_err' for key in result['errors'].keys())
-
-        self.salt_params = dict(zip(pnames,params))
         
         if plot:
+            import matplotlib.pyplot as plt
             plt.figure(figsize=(11,8))
             plt.title(f"{self.name} (ALeRCE)")
             plt.xlabel('MJD')
@@ -277,9 +460,9 @@ class alerce_object:
             p2 = self.lcm.query('fid == 2')
             plt.scatter(p2.mjd,p2.magpsf,label='ZTF - r',color='r')
             plotmjd = np.arange(result['parameters'][1]-20,result['parameters'][1]+50,0.5)
-            for band in np.unique(salt2band):
-                salt2flux = fitted_model.bandflux(band, plotmjd, zp=27.5,zpsys=zpsys[band == salt2band][0])
-                plt.plot(plotmjd,-2.5*np.log10(salt2flux)+27.5,label=band)
+            for code in np.unique(self.lcurve.band):
+                salt2flux = fitted_model.bandflux(band_names[code], plotmjd, zp=27.5,zpsys=band_zpsys[code])
+                plt.plot(plotmjd,-2.5*np.log10(salt2flux)+27.5,label=band_names[code])
             plt.gca().invert_yaxis()
             plt.grid()
             plt.legend(loc=0)
@@ -297,6 +480,7 @@ class alerce_object:
             Dataframe with the information of the potential host galaxies.
         '''
         snCoord = SkyCoord(self.ra,self.dec,unit='deg',frame='icrs')
+        from astro_ghost.ghostHelperFunctions import getTransientHosts
         with tempfile.TemporaryDirectory() as tmp:
             ghost_info = getTransientHosts(snCoord=[snCoord], verbose=0,starcut='normal',savepath=tmp,ascentMatch=True)
         return ghost_info
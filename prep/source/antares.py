@@ -1,20 +1,32 @@
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
 from astropy.time import Time
 import astropy.units as u
-from antares_client.search import search
-from elasticsearch_dsl import Search
 from .bandpassdict import *
-import sncosmo
-from astropy.table import Table
-from astro_ghost.ghostHelperFunctions import getTransientHosts
+from .salt import *
+from .photometry import *
 # from yse import yse_object
 from . import alerce_api,yse
 import tempfile
+import copy
+import time
 from astropy.coordinates import SkyCoord
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from ..metrics import get_metrics, count_bytes
+from ..transport import install
 
-def query_antares(query=None):
+# lightcurve columns used for fitting and plotting, the rest is dropped by antares_object.release
+lc_columns = ['ant_mjd','ant_mag','ant_magerr','ant_passband']
+
+def connect():
+    '''
+    Prepares the HTTP client that antares_client shares between all its calls: its bytes are counted and it is put under the transport of prep.transport. Safe to call more than once.
+    '''
+    from antares_client.search import api_client
+    count_bytes(api_client.client,'antares')
+    install(api_client.client,'antares')
+
+def query_antares(query=None,page_size=10):
     '''
     Queries ANTARES for new objects. See https://nsf-noirlab.gitlab.io/csdc/antares/client/tutorial/searching.html#advanced-searches for information on how to construct a query.
 
@@ -22,14 +34,19 @@ def query_antares(query=None):
     ----------
     query : elasticsearch_dsl.search.Search, optional
         The query to be sent to ANTARES. The default is None, which will return all objects with at least 4 detections and at least one detection in the last 7 days.
+    page_size : int, optional
+        Number of loci requested from ANTARES at a time. The default is 10.
 
     Returns
     -------
     s : Iterator
         An iterator over the result loci of the query.
     '''
+    from antares_client.search import search
+    connect()
     today = Time.now()
     if query ==None:
+        from elasticsearch_dsl import Search
         query = (
         Search()
         .filter("range", **{"properties.num_mag_values": {"gte": 4, "lte": 100}})
@@ -38,7 +55,7 @@ def query_antares(query=None):
         # .filter("term", tags="high_amplitude_transient_candidate")
         .to_dict()
         )
-    s = search(query)
+    s = search(query,limit=page_size)
     return s
 
 class antares_object:
@@ -67,14 +84,38 @@ class antares_object:
             The declination of the object.
         url : str
             The URL of the object in the antares database.
+        locus_id : str
+            The ANTARES locus id.
+        tns_names : list of str
+            Names of the TNS objects matched to the locus.
         '''
         self.locus =locus
         self.lc = self.locus.lightcurve
         self.name =self.locus.properties['ztf_object_id']
         self.ra,self.dec = locus.ra, locus.dec
+        self.locus_id = locus.locus_id
         self.url = f"https://antares.noirlab.edu/loci/{self.locus.locus_id}"
-    
-    def check_yse(self,verbose=True):
+        self.tns_names = []
+        if 'tns_public_objects' in self.locus.catalogs:
+            self.tns_names = [t['name'] for t in self.locus.catalog_objects['tns_public_objects'] if 'name' in t]
+
+    def release(self):
+        '''
+        Drops the locus, with its alerts and catalog matches, and the lightcurve columns that are not used for fitting. Everything else the object needs was read from the locus when it was created.
+        '''
+        self.locus = None
+        self.lc = self.lc[[c for c in lc_columns if c in self.lc.columns]].copy()
+
+    def __getstate__(self):
+        # the locus keeps a reference to the antares_client search module, which
+        # cannot be pickled when the object is sent to a worker process
+        state = self.__dict__.copy()
+        if self.locus is not None:
+            state['locus'] = copy.copy(self.locus)
+            state['locus']._search_module = None
+        return state
+
+    def check_yse(self,verbose=True,index=None,radius=2.0):
         '''
         Cross-checks to see if object exists in YSE. Checks if the object is in the TNS public catalog, and if so, checks if it is in the YSE database.
 
@@ -82,14 +123,20 @@ class antares_object:
         ----------
         verbose : bool, optional
             Whether to print out whether the object was found in YSE. The default is True.
+        index : prep.source.sky.sky_index, optional
+            Local index of known YSE objects, e.g. lc_store().sky_index('yse'). If given, the object is matched by position in the index instead of through the network. The default is None.
+        radius : float, optional
+            Match radius in arcseconds when index is given. The default is 2.
         
         Returns
         -------
         yse_object : prep.source.yse.yse_object
             The YSE object if it exists, or None if it does not.
         '''
-        if 'tns_public_objects' in self.locus.catalogs:
-            name = self.locus.catalog_objects['tns_public_objects'][0]['name']
+        if index is not None:
+            return yse.match_yse(self.ra,self.dec,index,radius=radius,verbose=verbose)
+        if self.tns_names:
+            name = self.tns_names[0]
             try:
                 yo=yse.yse_object(name)
                 if verbose:
@@ -128,18 +175,40 @@ class antares_object:
                 print('Found in ALeRCE')
             return alerce_api.alerce_object(q1.iloc[0])
     
-    def get_lc(self):
+    def get_lc(self,store=None):
         '''
         Gets the lightcurve of the object. Redundant with the lc attribute. Made for consistency with other object classes.
 
+        Parameters
+        ----------
+        store : prep.source.store.lc_store, optional
+            Light curve store. ANTARES delivers the lightcurve with the locus so nothing is downloaded, it is only recorded in the store. The default is None.
+
         Returns
         -------
         lc : DataFrame
             The lightcurve of the object.
         '''
+        if store is not None and len(self.lc):
+            store.put('antares',self.name,self.lc,self.lc['ant_mjd'].max())
         return self.lc
     
-    def salt3(self,plot=False):
+    def to_lightcurve(self):
+        '''
+        Converts the lightcurve of the object to the columnar lightcurve used for fitting.
+
+        Returns
+        -------
+        lcurve : prep.source.photometry.lightcurve
+            Detections in the ZTF g and R bands.
+        '''
+        self.lcm = self.lc[~self.lc[['ant_mjd','ant_mag','ant_magerr']].isna().any(axis=1)]
+        # ztf  - g and r, mapped through bandpassdict like for yse
+        self.lcurve = lightcurve.from_mag(self.lcm['ant_mjd'].values,self.lcm['ant_mag'].values,self.lcm['ant_magerr'].values,
+                                          self.lcm['ant_passband'].map(ztf_passband).values)
+        return self.lcurve
+
+    def salt3(self,plot=False,cache=None,warm=False,extra=None,method='minuit'):
         '''
         Fits a SALT3 model to the lightcurve of the object. Uses the sncosmo package.
 
@@ -147,60 +216,28 @@ class antares_object:
         ----------
         plot : bool, optional
             Whether to plot the lightcurve and the fit. The default is False.
+        cache : prep.source.store.fit_store, optional
+            Fit cache. If the photometry and fit configuration are unchanged since a stored fit, the fit is skipped and only the phase is recomputed. The default is None.
+        warm : bool, optional
+            If True, starts the fit from the last cached fit of this object and falls back to a cold fit if that goes wrong. Needs cache. The default is False.
+        extra : list of prep.source.photometry.lightcurve, optional
+            Photometry of the same object from other surveys, merged into the fit with combine_lightcurves. The default is None.
+        method : str, optional
+            'minuit' fits with sncosmo.fit_lc over the full bounds, 'grid' searches a redshift, color and t0 grid first and polishes the best cell, 'table' does that with precomputed bandfluxes. The default is 'minuit'.
         
         Attributes Generated
         --------------------
         salt_params : dict
             The parameters of the fit and errors.
         '''
-        self.lcm = self.lc[~self.lc[['ant_mjd','ant_mag','ant_magerr']].isna().any(axis=1)]
-        # Need to figure out ztf passbands
-        # ztf  - g and r
-        # doing the same thing as for yse
-        salt2band = []
-        zpsys =[]
-        mask = []
-        for i in range(len(self.lcm.ant_mjd.values)):
-            if self.lcm.ant_passband.values[i] == 'g':
-                salt2band.append(bandpassdict['Band: ZTF-Cam - g-ZTF'])
-                mask.append(True)
-            elif self.lcm.ant_passband.values[i] == 'R':
-                salt2band.append(bandpassdict['Band: ZTF-Cam - r-ZTF'])
-                mask.append(True)
-            else:
-                salt2band.append('None')
-                mask.append(False)
-            zpsys.append('AB')
-        
-        model = sncosmo.Model(source='salt3')
-        fitparams = ['z', 't0', 'x0', 'x1', 'c']
-        mask = mask #& (self.pdata['FLUXCAL']<1e10) #& (pdata['MJD'].values>60052)
-        # model.set(z=sn['Host Redshift'])
-        salt2mjd = self.lcm['ant_mjd'][mask].values
-        mag = self.lcm['ant_mag'][mask].values
-        flux = 10**(-0.4*(mag-27.5))
-        # flux = pdata['FLUXCAL'][mask].values
-        mag_err=self.lcm['ant_magerr'][mask].values
-        # mag_err[(mag_err < 0.01)|(mag_err ==None)]=0.01
-        fluxerr = flux*mag_err*0.4*np.log(10)
-        # fluxerr = pdata['FLUXCALERR'][mask].values
-        zp = np.array([27.5]*len(salt2band))[mask]
-        zpsys = np.array(zpsys)
-        salt2band = np.array(salt2band)
-        zpsys = zpsys[mask]
-        salt2band = salt2band[mask]
-
-        data = Table([salt2mjd,salt2band,flux,fluxerr,zp,zpsys],names=['mjd','band','flux','fluxerr','zp','zpsys'],meta={'t0':salt2mjd[flux == np.max(flux)]})
-        result, fitted_model = sncosmo.fit_lc(
-                    data, model, fitparams,
-                    bounds={'t0':(salt2mjd[flux == np.max(flux)]-10, salt2mjd[flux == np.max(flux)]+10),
-                            'z':(0.0,0.7),'x1':(-3,3),'c':(-0.3,0.3)})  # bounds on parameters (if any)
-        print('points fitted =',len(salt2mjd))
+        self.to_lightcurve()
+        if extra:
+            self.lcurve = combine_lightcurves([self.lcurve]+list(extra))
+        self.salt_params, result, fitted_model = fit_salt3(self.lcurve,cache=cache,name=self.name,warm=warm,method=method)
+        print('points fitted =',len(self.lcurve))
         print('chisq =',result['chisq'])
-        today = Time.now().mjd
-        lcphase = today-result['parameters'][1]
-        lcp =lcphase
         if plot:
+            lcphase = self.salt_params['phase']
             if lcphase > 0: lcphase = '+%.1f'%(lcphase)
             else: lcphase = '%.1f'%(lcphase)
             print("phase = %s days"%(lcphase))
@@ -209,23 +246,9 @@ class antares_object:
             print('ms = %.2f'%(10.635-2.5*np.log10(result['parameters'][2])))
             print('x1 = %.2f'%(result['parameters'][3]))
             print('c = %.2f'%(result['parameters'][4]))
-            # for i in range(len(result['param_names'])):
-            #     if i==2:
-            #         print('ms =',10.635-2.5*np.log10(result.parameters[i]))
-            #     else:
-            #         rp=result['parameters'][i]
-            #         print(result['param_names'][i],'=',f'%i'%(rp))
         
-        params = np.array([result['chisq'],lcp, result['parameters'][0],
-                                      result['parameters'][1],
-                                      10.635-2.5*np.log10(result['parameters'][2]),
-                                      result['parameters'][3],
-                                      result['parameters'][4],
-                                      len(salt2mjd)]+list(result['errors'].values()))
-        pnames = ['chisq','phase','z','t0','ms','x1','c','npoints']+list(key+'_err' for key in result['errors'].keys())
-
-        self.salt_params = dict(zip(pnames,params))
         if plot:
+            import matplotlib.pyplot as plt
             plt.figure(figsize=(11,8))
             plt.title(f"{self.name} (ANTARES)")
             plt.xlabel('MJD')
@@ -235,9 +258,9 @@ class antares_object:
             p2 = self.lcm.query('ant_passband == "R"')
             plt.scatter(p2.ant_mjd,p2.ant_mag,label='ZTF - r',color='r')
             plotmjd = np.arange(result['parameters'][1]-20,result['parameters'][1]+50,0.5)
-            for band in np.unique(salt2band):
-                salt2flux = fitted_model.bandflux(band, plotmjd, zp=27.5,zpsys=zpsys[band == salt2band][0])
-                plt.plot(plotmjd,-2.5*np.log10(salt2flux)+27.5,label=band)
+            for code in np.unique(self.lcurve.band):
+                salt2flux = fitted_model.bandflux(band_names[code], plotmjd, zp=27.5,zpsys=band_zpsys[code])
+                plt.plot(plotmjd,-2.5*np.log10(salt2flux)+27.5,label=band_names[code])
             plt.gca().invert_yaxis()
             plt.grid()
             plt.legend(loc=0)
@@ -250,6 +273,7 @@ class antares_object:
         '''
         Plots the light curve data.
         '''
+        import matplotlib.pyplot as plt
         plt.title(self.name)
         plt.xlabel('MJD')
         plt.ylabel('Magnitude')
@@ -266,7 +290,115 @@ class antares_object:
             DataFrame containing the host galaxy information.
         '''
         snCoord = SkyCoord(self.ra,self.dec,unit='deg',frame='icrs')
+        from astro_ghost.ghostHelperFunctions import getTransientHosts
         with tempfile.TemporaryDirectory() as tmp:
             ghost_info = getTransientHosts(snCoord=[snCoord], verbose=0,starcut='normal',savepath=tmp,ascentMatch=True)
         return ghost_info
-    
\ No newline at end of file
+    
+class antares_stream:
+
+    def __init__(self,query=None,max_candidates=50,max_time=None,max_inflight=4,page_size=100):
+        '''
+        Consumes the loci of an ANTARES query within a budget. Loci are requested in pages, their lightcurves are downloaded on up to max_inflight threads and each one is converted to a released antares_object, so no Locus is held after its conversion. Iterating stops at the first limit reached, see stopped.
+
+        Parameters
+        ----------
+        query : dict, optional
+            The query to be sent to ANTARES. The default is None which uses the query of query_antares.
+        max_candidates : int, optional
+            Number of objects converted successfully before stopping. Failures do not count. The default is 50, None for no limit.
+        max_time : float, optional
+            Wall-clock limit in seconds from the start of the iteration. Downloads still running then are abandoned. The default is None.
+        max_inflight : int, optional
+            Maximum number of loci downloaded at the same time. The default is 4.
+        page_size : int, optional
+            Number of loci requested from ANTARES at a time. The default is 100.
+
+        Attributes
+        ----------
+        succeeded, failed : int
+            Number of loci converted and failed.
+        stopped : str
+            Why the iteration ended, 'max_candidates', 'max_time', 'exhausted' or 'error' if the query failed. None while running.
+        '''
+        self.query = query
+        self.max_candidates = max_candidates
+        self.max_time = max_time
+        self.max_inflight = max(1,max_inflight)
+        self.page_size = page_size
+        self.succeeded = self.failed = 0
+        self.stopped = None
+
+    def convert(self,locus):
+        '''
+        Builds the released antares_object of a locus, or None if that fails.
+        '''
+        try:
+            # the lightcurve is downloaded when the object is created
+            with get_metrics().timer('fetch_antares'):
+                obj = antares_object(locus)
+            obj.release()
+            return obj
+        except Exception as e:
+            print(f'failed on {getattr(locus,"locus_id",locus)}\n{e}')
+            return
+
+    def __iter__(self):
+        '''
+        Yields
+        ------
+        obj : antares_object
+            Released object with its lightcurve, in the order the downloads finish.
+        '''
+        deadline = None if self.max_time is None else time.monotonic()+self.max_time
+        full = lambda n: self.max_candidates is not None and n >= self.max_candidates
+        loci = query_antares(self.query,page_size=self.page_size)
+        ex = ThreadPoolExecutor(max_workers=self.max_inflight)
+        pending = set()
+        try:
+            while True:
+                # only as many loci are taken as could still be needed
+                while self.stopped is None and len(pending) < self.max_inflight and not full(self.succeeded+len(pending)):
+                    try:
+                        locus = next(loci,None)
+                    except Exception as e:
+                        print(f'ANTARES query failed\n{e}')
+                        self.stopped = 'error'
+                        break
+                    if locus is None:
+                        self.stopped = 'exhausted'
+                        break
+                    pending.add(ex.submit(self.convert,locus))
+                    del locus
+                if not pending:
+                    self.stopped = self.stopped or 'max_candidates'
+                    break
+                timeout = None if deadline is None else max(0.,deadline-time.monotonic())
+                done, pending = wait(pending,timeout=timeout,return_when=FIRST_COMPLETED)
+                for f in done:
+                    obj = f.result()
+                    if obj is None:
+                        self.failed += 1
+                        continue
+                    self.succeeded += 1
+                    yield obj
+                if full(self.succeeded):
+                    self.stopped = 'max_candidates'
+                    break
+                if deadline is not None and time.monotonic() >= deadline:
+                    self.stopped = 'max_time'
+                    break
+        finally:
+            # abandons downloads that are still running
+            ex.shutdown(wait=False,cancel_futures=True)
+            loci.close()
+
+    def report(self):
+        '''
+        Summary of the stream.
+
+        Returns
+        -------
+        report : str
+        '''
+        return f'ANTARES: {self.succeeded} loci converted, {self.failed} failed, stopped on {self.stopped}'
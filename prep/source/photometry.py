@@ -0,0 +1,135 @@
+import numpy as np
+import pandas as pd
+from astropy.table import Table
+from .bandpassdict import *
+from .salt import *
+
+# Categorical band lookup, compiled once from bandpassdict. A band code is the
+# index of the sncosmo bandpass name in band_names, -1 means unknown band.
+band_keys = np.array(list(bandpassdict.keys()))
+band_names = np.unique(list(bandpassdict.values()))
+band_zpsys = np.where(np.char.find(band_names,'bessell')>=0,'Vega','AB')
+_key_codes = np.searchsorted(band_names,[bandpassdict[k] for k in band_keys])
+
+# ZTF filter ids as used by ALeRCE (fid) and ANTARES (ant_passband)
+ztf_fid = {1:'Band: ZTF-Cam - g-ZTF', 2:'Band: ZTF-Cam - r-ZTF'}
+ztf_passband = {'g':'Band: ZTF-Cam - g-ZTF', 'R':'Band: ZTF-Cam - r-ZTF'}
+
+def band_codes(keys):
+    '''
+    Maps bandpassdict keys ("Band: INSTRUMENT - FILTER") to band codes in one vectorized pass.
+
+    Parameters
+    ----------
+    keys : array_like of str
+        bandpassdict keys. Missing values and keys not in bandpassdict are allowed.
+
+    Returns
+    -------
+    codes : np.ndarray
+        Index into band_names for each key, -1 where the band is unknown.
+    '''
+    idx = pd.Categorical(np.asarray(keys,dtype=object),categories=band_keys).codes
+    return np.where(idx>=0,_key_codes[idx],-1)
+
+class lightcurve:
+
+    def __init__(self,mjd,flux,fluxerr,band,zp=27.5,zpsys=None):
+        '''
+        Columnar photometry shared by all sources and used as the input of the SALT3 fit.
+
+        Parameters
+        ----------
+        mjd, flux, fluxerr : array_like
+            Time and flux of each point.
+        band : array_like of int
+            Band codes, see band_codes.
+        zp : float or array_like, optional
+            Zero point of the flux. The default is 27.5.
+        zpsys : array_like of str, optional
+            Magnitude system of each point. The default is None which uses the system of each band in band_zpsys.
+        '''
+        self.mjd = np.asarray(mjd,dtype=float)
+        self.flux = np.asarray(flux,dtype=float)
+        self.fluxerr = np.asarray(fluxerr,dtype=float)
+        self.band = np.asarray(band,dtype=int)
+        self.zp = np.broadcast_to(np.asarray(zp,dtype=float),self.mjd.shape).copy()
+        self.zpsys = band_zpsys[self.band] if zpsys is None else np.asarray(zpsys)
+
+    @classmethod
+    def from_mag(cls,mjd,mag,magerr,keys,zp=27.5):
+        '''
+        Builds a light curve from magnitudes and bandpassdict keys. Points in unknown bands are dropped.
+
+        Parameters
+        ----------
+        mjd, mag, magerr : array_like
+            Time, magnitude and magnitude error of each point.
+        keys : array_like of str
+            bandpassdict key of each point.
+        zp : float, optional
+            Zero point used to convert magnitudes to flux. The default is 27.5.
+
+        Returns
+        -------
+        lc : lightcurve
+        '''
+        codes = band_codes(keys)
+        m = codes>=0
+        mag = np.asarray(mag,dtype=float)[m]
+        flux = 10**(-0.4*(mag-zp))
+        fluxerr = flux*np.asarray(magerr,dtype=float)[m]*0.4*np.log(10)
+        return cls(np.asarray(mjd,dtype=float)[m],flux,fluxerr,codes[m],zp)
+
+    def __len__(self):
+        return self.mjd.size
+
+    def __getitem__(self,key):
+        return lightcurve(self.mjd[key],self.flux[key],self.fluxerr[key],self.band[key],self.zp[key],self.zpsys[key])
+
+    @property
+    def band_name(self):
+        '''
+        sncosmo bandpass name of each point.
+        '''
+        return band_names[self.band]
+
+    def to_table(self):
+        '''
+        Builds the astropy Table passed to sncosmo, with cached bandpass objects as the band column.
+
+        Returns
+        -------
+        data : astropy.table.Table
+        '''
+        return Table([self.mjd,get_bandpasses(self.band_name),self.flux,self.fluxerr,self.zp,self.zpsys],
+                     names=['mjd','band','flux','fluxerr','zp','zpsys'],
+                     meta={'t0':self.mjd[self.flux == np.max(self.flux)]})
+
+def combine_lightcurves(lcs,tol=1e-3):
+    '''
+    Merges light curves of the same object from several surveys. A point that appears in more than one of them (same band, MJD within tol) is kept once, from the first light curve that has it.
+
+    Parameters
+    ----------
+    lcs : list of lightcurve
+        Light curves in order of preference.
+    tol : float, optional
+        MJD tolerance in days for duplicate points. The default is 1e-3.
+
+    Returns
+    -------
+    lc : lightcurve
+        The merged light curve sorted by MJD.
+    '''
+    mjd = np.concatenate([lc.mjd for lc in lcs])
+    band = np.concatenate([lc.band for lc in lcs])
+    rank = np.concatenate([np.full(len(lc),i) for i,lc in enumerate(lcs)])
+    # sort by band, then time, then preference so duplicates are adjacent
+    order = np.lexsort((rank,mjd,band))
+    keep = np.ones(order.size,dtype=bool)
+    keep[1:] = (band[order][1:] != band[order][:-1]) | (np.diff(mjd[order]) > tol)
+    idx = order[keep]
+    idx = idx[np.argsort(mjd[idx],kind='stable')]
+    cat = lambda a: np.concatenate([getattr(lc,a) for lc in lcs])[idx]
+    return lightcurve(cat('mjd'),cat('flux'),cat('fluxerr'),cat('band'),cat('zp'),cat('zpsys'))
@@ -0,0 +1,515 @@
+import copy
+import hashlib
+import numpy as np
+import sncosmo
+from sncosmo.constants import HC_ERG_AA, MODEL_BANDFLUX_SPACING
+from sncosmo.utils import integration_grid
+from astropy.time import Time
+from .bandpassdict import *
+from ..metrics import get_metrics
+
+# Process-local caches. Each worker process fills its own copy, see warm_cache.
+_models = {}
+_bandpasses = {}
+
+def get_model(source='salt3'):
+    '''
+    Returns a model with default parameters. The model is copied from a cached prototype instead of being built from scratch on every fit.
+
+    Parameters
+    ----------
+    source : str, optional
+        Name of the sncosmo source. The default is 'salt3'.
+
+    Returns
+    -------
+    model : sncosmo.Model
+        A copy of the cached model that is safe to modify.
+    '''
+    if source not in _models:
+        _models[source] = sncosmo.Model(source=source)
+    # copy.copy gives a new parameter array but shares the source data
+    return copy.copy(_models[source])
+
+def get_bandpass(name):
+    '''
+    Returns the resolved sncosmo bandpass for a name, cached per process.
+
+    Parameters
+    ----------
+    name : str
+        Name of a bandpass in the sncosmo registry, i.e. a value of bandpassdict.
+
+    Returns
+    -------
+    bandpass : sncosmo.Bandpass
+        The resolved bandpass.
+    '''
+    try:
+        return _bandpasses[name]
+    except KeyError:
+        _bandpasses[name] = sncosmo.get_bandpass(name)
+        return _bandpasses[name]
+
+def get_bandpasses(names):
+    '''
+    Resolves an array of bandpass names, looking up each unique name only once.
+
+    Parameters
+    ----------
+    names : array_like of str
+        Bandpass names.
+
+    Returns
+    -------
+    bandpasses : np.ndarray
+        Object array of sncosmo.Bandpass that can be used as the band column of the fit data.
+    '''
+    un, inv = np.unique(np.asarray(names), return_inverse=True)
+    bps = np.empty(len(un), dtype=object)
+    for i, n in enumerate(un):
+        bps[i] = get_bandpass(n)
+    return bps[inv.reshape(-1)]
+
+def warm_cache(source='salt3'):
+    '''
+    Loads the model and every bandpass named in bandpassdict into the process-local cache. Used as the initializer of worker processes so the first fit in a worker does not pay the setup cost.
+
+    Parameters
+    ----------
+    source : str, optional
+        Name of the sncosmo source. The default is 'salt3'.
+    '''
+    get_model(source)
+    for name in set(bandpassdict.values()):
+        try:
+            get_bandpass(name)
+        except Exception:
+            # not every name in bandpassdict is in the sncosmo registry
+            continue
+    for ms in ['ab','vega']:
+        sncosmo.get_magsystem(ms)
+    return 0
+
+def fit_key(lc,model,fitparams,bounds,method='minuit'):
+    '''
+    Content hash of everything that determines a fit: the photometry, the model and its fixed parameters, the fitted parameters, their bounds and the fitting method.
+
+    Returns
+    -------
+    key : str
+        Hex digest identifying the fit.
+    '''
+    h = hashlib.sha1()
+    for a in [lc.mjd,lc.flux,lc.fluxerr,lc.zp]:
+        h.update(np.ascontiguousarray(a,dtype=float).tobytes())
+    h.update('|'.join(lc.band_name).encode())
+    h.update('|'.join(lc.zpsys).encode())
+    h.update(repr((model.source.name,model.source.version,list(model.param_names),model.parameters.tolist())).encode())
+    h.update(repr(list(fitparams)).encode())
+    h.update(repr(sorted((k,np.asarray(v,dtype=float).ravel().tolist()) for k,v in bounds.items())).encode())
+    if method != 'minuit':
+        # keeps the keys of existing minuit fits valid
+        h.update(method.encode())
+    return h.hexdigest()
+
+# half widths of the bounds around a previous solution used by warm starts
+warm_widths = {'t0':3.,'z':0.05,'x1':1.,'c':0.1}
+
+def warm_bounds(prev,bounds,widths=warm_widths):
+    '''
+    Narrows fit bounds around a previous solution, staying inside the original bounds.
+
+    Parameters
+    ----------
+    prev : sncosmo.utils.Result
+        The previous fit result.
+    bounds : dict
+        The bounds of a cold fit.
+    widths : dict, optional
+        Half width of the narrowed bounds per parameter. The default is warm_widths.
+
+    Returns
+    -------
+    bounds : dict
+        The narrowed bounds.
+    '''
+    out = {}
+    for k,(lo,hi) in bounds.items():
+        if k in widths and k in prev['param_names']:
+            v = prev['parameters'][list(prev['param_names']).index(k)]
+            out[k] = (max(lo,v-widths[k]),min(hi,v+widths[k]))
+        else:
+            out[k] = (lo,hi)
+    return out
+
+def _warm_fit(data,model,fitparams,bounds,prev):
+    '''
+    Fit seeded with a previous solution. Returns None if the fit is degenerate or worse than the previous one, in which case a cold fit is needed.
+    '''
+    wb = warm_bounds(prev,bounds)
+    if not all(lo < hi for lo,hi in wb.values()):
+        # the previous solution is outside of the current bounds
+        return
+    model = copy.copy(model)
+    for p in fitparams:
+        if p in prev['param_names']:
+            model.set(**{p:prev['parameters'][list(prev['param_names']).index(p)]})
+    try:
+        result, fitted_model = sncosmo.fit_lc(data, model, fitparams, bounds=wb,
+                                              guess_amplitude=False, guess_t0=False, guess_z=False)
+    except Exception:
+        return
+    if not result['success'] or not np.all(np.isfinite(result['parameters'])):
+        return
+    # a parameter stuck on a narrowed edge means the solution moved, refit cold
+    for k,(lo,hi) in wb.items():
+        v = result['parameters'][list(result['param_names']).index(k)]
+        tol = 1e-3*(hi-lo)
+        if (lo > bounds[k][0] and v-lo < tol) or (hi < bounds[k][1] and hi-v < tol):
+            return
+    if result['chisq']/max(result['ndof'],1) > prev['chisq']/max(prev['ndof'],1):
+        return
+    return result, fitted_model
+
+def fit_bounds(lc,fitparams,bounds=None):
+    '''
+    Bounds of the fitted parameters.
+
+    Parameters
+    ----------
+    lc : prep.source.photometry.lightcurve
+        The photometry to fit.
+    fitparams : list of str
+        Parameters to vary.
+    bounds : dict, optional
+        Bounds on the parameters. The default is None which bounds t0 to 10 days around the brightest point, z to (0, 0.7), x1 to (-3, 3) and c to (-0.3, 0.3).
+
+    Returns
+    -------
+    bounds : dict
+        The bounds of the parameters in fitparams.
+    '''
+    if bounds is None:
+        t0 = lc.mjd[np.argmax(lc.flux)]
+        bounds = {'t0':(t0-10,t0+10),'z':(0.0,0.7),'x1':(-3,3),'c':(-0.3,0.3)}
+    # only bound what is fitted, a fixed z may lie outside the z bounds
+    return {k:v for k,v in bounds.items() if k in fitparams}
+
+# grids searched by grid_search: redshift, color, and t0 offsets from the center of the t0 bounds
+z_grid = np.round(np.arange(0.01,0.7,0.01),3)
+c_grid = np.round(np.arange(-0.3,0.31,0.05),3)
+t0_grid = np.arange(-10.,10.25,0.5)
+# step in days of the model light curves that points are interpolated from
+grid_step = 0.5
+
+def _stack(lcs):
+    '''
+    Concatenates the columns of a batch of light curves.
+    '''
+    n = np.array([len(lc) for lc in lcs])
+    cat = lambda a: np.concatenate([getattr(lc,a) for lc in lcs])
+    return {'owner':np.repeat(np.arange(len(lcs)),n),'start':np.cumsum(n)-n,
+            'mjd':cat('mjd'),'band':cat('band_name'),'zpnorm':10**(0.4*cat('zp')),'zpsys':cat('zpsys'),
+            'flux':cat('flux'),'w':1/cat('fluxerr')**2}
+
+def band_lightcurves(model,bp,time,cs):
+    '''
+    Light curves of a SALT model in one band for several colors, per unit x0 and split in the x1=0 part and its derivative in x1. The spectra are computed once and the color law is applied to them for every color, which is much cheaper than a bandflux call per color.
+
+    Parameters
+    ----------
+    model : sncosmo.Model
+        SALT model. Its z and t0 are used, x0, x1 and c are ignored.
+    bp : sncosmo.Bandpass
+        The band. Must lie within the model wavelength range.
+    time : np.ndarray
+        Observer frame times.
+    cs : np.ndarray
+        Colors.
+
+    Returns
+    -------
+    f0, f1 : np.ndarray
+        Bandflux in photons/s/cm^2 like sncosmo's bandflux without zero point, shape (len(time), len(cs)).
+    '''
+    model = copy.copy(model)
+    # same integral as sncosmo's bandflux, with the color law pulled out
+    wave, dwave = integration_grid(bp.minwave(),bp.maxwave(),MODEL_BANDFLUX_SPACING)
+    weight = wave*bp(wave)*dwave/HC_ERG_AA
+    model.set(x0=1.,x1=0.,c=0.)
+    s0 = model.flux(time,wave)*weight
+    model.set(x1=1.)
+    s1 = model.flux(time,wave)*weight-s0
+    cl = 10**(-0.4*np.outer(cs,model.source.colorlaw(wave/(1+model['z']))))
+    return s0@cl.T, s1@cl.T
+
+def _grid_templates(model,st,T,cs,table=None):
+    '''
+    Model light curves of each band of a batch at the current redshift on a regular time grid, see band_lightcurves. They are read from table if one is given.
+
+    Returns
+    -------
+    templates : list of tuple
+        (idx, t, tt, f0, f1, norm) of each band and magnitude system: the points, their times relative to the t0 grid, the time grid and the light curves of shape (len(tt), len(cs)), and the zero point scaling of the points.
+    bad : np.ndarray
+        True for light curves with a band the model does not cover at this redshift.
+    '''
+    owner, mjd, band, zpsys = st['owner'], st['mjd'], st['band'], st['zpsys']
+    templates = []
+    bad = np.zeros(T.shape[0],dtype=bool)
+    for b in np.unique(band):
+        bp = get_bandpass(b)
+        mb = band == b
+        if table is None and (bp.minwave() < model.minwave() or bp.maxwave() > model.maxwave()):
+            # band outside of the model wavelength range at this redshift
+            bad[owner[mb]] = True
+            continue
+        t = mjd[mb,None]-T[owner[mb]]
+        # only the part of the model light curve covered by the points
+        lo, hi = max(model.mintime(),t.min()), min(model.maxtime(),t.max())
+        if lo > hi:
+            continue
+        tt = np.arange(lo,hi+grid_step,grid_step)
+        if table is None:
+            f0, f1 = band_lightcurves(model,bp,tt,cs)
+        else:
+            f0, f1 = table.lightcurves(b,model['z'],tt,cs)
+            if np.isnan(f0).any():
+                bad[owner[mb]] = True
+                continue
+        for ms in np.unique(zpsys[mb]):
+            m = zpsys[mb] == ms
+            norm = (st['zpnorm'][mb][m]/sncosmo.get_magsystem(ms).zpbandflux(bp))[:,None]
+            templates.append((np.flatnonzero(mb)[m],t[m],tt,f0,f1,norm))
+    return templates, bad
+
+def _grid_points(templates,j,shape):
+    '''
+    Interpolates the model flux of every point over the t0 grid from the templates of color j.
+    '''
+    G0, G1 = np.zeros(shape), np.zeros(shape)
+    for idx,t,tt,f0,f1,norm in templates:
+        G0[idx] = norm*np.interp(t,tt,f0[:,j],left=0.,right=0.)
+        G1[idx] = norm*np.interp(t,tt,f1[:,j],left=0.,right=0.)
+    return G0, G1
+
+def _grid_chisq(G0,G1,st,x1lo,x1hi):
+    '''
+    Chi-square over the t0 grid with x0 and x1 solved analytically, as the flux is linear in x0 and x0*x1. x1 is clipped to its bounds and x0 to positive values.
+
+    Returns
+    -------
+    chisq, x0, x1 : np.ndarray
+        Arrays of shape (nlc, nt0).
+    '''
+    w, f = st['w'][:,None], st['flux'][:,None]
+    s = lambda a: np.add.reduceat(a,st['start'])
+    S00, S01, S11 = s(w*G0*G0), s(w*G0*G1), s(w*G1*G1)
+    b0, b1 = s(w*f*G0), s(w*f*G1)
+    C = s(w*f**2)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        det = S00*S11-S01**2
+        a = (b0*S11-b1*S01)/det
+        x1 = np.nan_to_num((b1*S00-b0*S01)/det/a)
+    x1 = np.clip(x1,x1lo[:,None],x1hi[:,None])
+    A = S00+2*x1*S01+x1**2*S11
+    B = b0+x1*b1
+    x0 = np.where((B > 0) & (A > 0),B/np.where(A > 0,A,1),0.)
+    return C-2*x0*B+x0**2*A, x0, x1
+
+def grid_search(lcs,models,fitparams,bounds,zgrid=z_grid,cgrid=c_grid,t0grid=t0_grid,table=None):
+    '''
+    Brute force chi-square search over redshift, color and t0 for a batch of light curves, vectorized over the light curves and the t0 grid, with x0 and x1 solved analytically in every cell. Parameters that are not fitted are only evaluated at their model value.
+
+    Parameters
+    ----------
+    lcs : list of prep.source.photometry.lightcurve
+        Non-empty light curves.
+    models, fitparams, bounds : list
+        Model, fitted parameters and bounds of each light curve, see fit_bounds.
+    zgrid, cgrid : array_like, optional
+        Redshifts and colors to evaluate. The defaults are z_grid and c_grid.
+    t0grid : array_like, optional
+        t0 offsets from the center of the t0 bounds. The default is t0_grid.
+    table : prep.source.table.bandflux_table, optional
+        Precomputed bandfluxes used instead of integrating the model spectra. The default is None.
+
+    Returns
+    -------
+    best : dict
+        Arrays z, t0, x0, x1, c and chisq of the best cell of each light curve.
+    '''
+    nlc = len(lcs)
+    t0grid = np.asarray(t0grid,dtype=float)
+    T = np.empty((nlc,t0grid.size))
+    for i in range(nlc):
+        if 't0' in fitparams[i]:
+            lo, hi = bounds[i]['t0']
+            T[i] = np.clip((lo+hi)/2+t0grid,lo,hi)
+        else:
+            T[i] = models[i]['t0']
+    fixed = lambda i,k: None if k in fitparams[i] else models[i][k]
+    lim = lambda i,k: bounds[i][k] if k in fitparams[i] else (models[i][k],)*2
+    # light curves evaluated together share a source and any fixed z or c
+    groups = {}
+    for i in range(nlc):
+        src = models[i].source
+        groups.setdefault(((src.name,src.version),fixed(i,'z'),fixed(i,'c')),[]).append(i)
+    best = {k:np.full(nlc,np.nan) for k in ['z','t0','x0','x1','c']}
+    best['chisq'] = np.full(nlc,np.inf)
+    for (src,zfix,cfix),rows in groups.items():
+        rows = np.array(rows)
+        r = np.arange(rows.size)
+        st = _stack([lcs[i] for i in rows])
+        model = copy.copy(models[rows[0]])
+        zlo, zhi = np.array([lim(i,'z') for i in rows]).T
+        clo, chi = np.array([lim(i,'c') for i in rows]).T
+        x1lo, x1hi = np.array([lim(i,'x1') for i in rows]).T
+        zs = np.asarray(zgrid,dtype=float) if zfix is None else np.array([zfix])
+        cs = np.asarray(cgrid,dtype=float) if cfix is None else np.array([cfix])
+        for z in zs:
+            model.set(z=z,t0=0.,x0=1.)
+            templates, bad = _grid_templates(model,st,T[rows],cs,table)
+            for j,c in enumerate(cs):
+                G0, G1 = _grid_points(templates,j,(st['mjd'].size,t0grid.size))
+                chisq, x0, x1 = _grid_chisq(G0,G1,st,x1lo,x1hi)
+                chisq[bad | (z < zlo) | (z > zhi) | (c < clo) | (c > chi)] = np.inf
+                k = np.argmin(chisq,axis=1)
+                better = chisq[r,k] < best['chisq'][rows]
+                sel, k = rows[better], k[better]
+                best['chisq'][sel] = chisq[better,k]
+                best['z'][sel] = z
+                best['c'][sel] = c
+                best['t0'][sel] = T[sel,k]
+                best['x0'][sel] = x0[better,k]
+                best['x1'][sel] = x1[better,k]
+    return best
+
+# half widths of the polish bounds in grid steps
+polish_steps = 3
+
+def _grid_steps(zgrid,t0grid):
+    '''
+    Half widths of the polish bounds in z and t0.
+    '''
+    dz = np.max(np.diff(zgrid)) if len(zgrid) > 1 else 0.05
+    dt = np.max(np.diff(t0grid)) if len(t0grid) > 1 else 3.
+    return polish_steps*dz, polish_steps*dt
+
+def _polish(lc,model,fitparams,bounds,cell,dz,dt,maxcall=1000):
+    '''
+    Short bounded minimization started from a grid cell, with z and t0 limited to polish_steps grid steps around it.
+    '''
+    model = copy.copy(model)
+    start = {k:cell[k] for k in ['z','t0','x0','x1','c'] if k in fitparams and np.isfinite(cell[k])}
+    if start.get('x0',0) <= 0:
+        start.pop('x0',None)
+    model.set(**start)
+    step = {'z':dz,'t0':dt}
+    b = {k:((max(lo,model[k]-step[k]),min(hi,model[k]+step[k])) if k in step else (lo,hi)) for k,(lo,hi) in bounds.items()}
+    return sncosmo.fit_lc(lc.to_table(),model,fitparams,bounds=b,guess_amplitude='x0' not in start,
+                          guess_t0=False,guess_z=False,maxcall=maxcall)
+
+def _refine(lc,model,fitparams,bounds,cell,steps,table=None,maxcall=1000):
+    '''
+    Final minimization from a grid cell: _polish, or prep.source.table.fit_table over the full bounds if a table is given.
+    '''
+    if table is None:
+        return _polish(lc,model,fitparams,bounds,cell,*steps,maxcall)
+    # imported here, prep.source.table builds on this module
+    from .table import fit_table
+    return fit_table(lc,model,fitparams,bounds,table,cell,maxcall)
+
+def fit_salt3(lc,model=None,fitparams=['z', 't0', 'x0', 'x1', 'c'],bounds=None,cache=None,name=None,warm=False,method='minuit'):
+    '''
+    Fitting core shared by all sources. Runs sncosmo.fit_lc on a light curve and builds the salt_params dict used by build_rec.
+
+    Parameters
+    ----------
+    lc : prep.source.photometry.lightcurve
+        The photometry to fit.
+    model : sncosmo.Model, optional
+        Model to fit, e.g. with a fixed redshift. The default is None which uses get_model().
+    fitparams : list of str, optional
+        Parameters to vary. The default is ['z', 't0', 'x0', 'x1', 'c'].
+    bounds : dict, optional
+        Bounds on the parameters. The default is None which bounds t0 to 10 days around the brightest point, z to (0, 0.7), x1 to (-3, 3) and c to (-0.3, 0.3).
+    cache : prep.source.store.fit_store, optional
+        Fit cache. If it holds a fit with the same fit_key, sncosmo.fit_lc is skipped and only the phase is recomputed. The default is None.
+    name : str, optional
+        Name of the object, stored with the fit. The default is None.
+    warm : bool, optional
+        If True and cache holds an earlier fit of the object, the fit starts from that solution with bounds narrowed by warm_bounds. It falls back to a cold fit if the warm fit is degenerate or its reduced chisq is worse than before. Needs cache and name. The default is False.
+    method : str, optional
+        How the cold fit is done. 'minuit' runs sncosmo.fit_lc over the full bounds, 'grid' searches a redshift, color and t0 grid first with grid_search and polishes the best cell with a short bounded fit. 'table' does the same with the model read from a precomputed prep.source.table.bandflux_table, which is built on first use. The default is 'minuit'.
+
+    Returns
+    -------
+    salt_params : dict
+        The salt3 parameters and errors.
+    result : sncosmo.utils.Result
+        The result of sncosmo.fit_lc.
+    fitted_model : sncosmo.Model
+        The model with the best fit parameters.
+    '''
+    if len(lc) == 0:
+        raise ValueError('No points to fit')
+    if model is None:
+        model = get_model()
+    bounds = fit_bounds(lc,fitparams,bounds)
+    key = None
+    if cache is not None:
+        key = fit_key(lc,model,fitparams,bounds,method)
+        result = cache.get(key)
+        if result is not None:
+            get_metrics().count('fit_cached')
+            fitted_model = copy.copy(model)
+            fitted_model.parameters = result['parameters']
+            return salt_params(result,len(lc)), result, fitted_model
+    data = lc.to_table()
+    fit = None
+    if warm and cache is not None and name is not None:
+        prev = cache.last(name)
+        if prev is not None and prev['success']:
+            fit = _warm_fit(data,model,fitparams,bounds,prev)
+    if fit is None and method in ['grid','table']:
+        table = None
+        if method == 'table':
+            from .table import get_bandflux_table
+            table = get_bandflux_table(model.source.name)
+        best = grid_search([lc],[model],[fitparams],[bounds],table=table)
+        fit = _refine(lc,model,fitparams,bounds,{k:v[0] for k,v in best.items()},_grid_steps(z_grid,t0_grid),table)
+    elif fit is None:
+        fit = sncosmo.fit_lc(data, model, fitparams, bounds=bounds)
+    result, fitted_model = fit
+    get_metrics().fit_iterations(result.ncall)
+    if cache is not None:
+        cache.put(key,name,result)
+    return salt_params(result,len(lc)), result, fitted_model
+
+def salt_params(result,npoints):
+    '''
+    Builds the salt_params dict from a sncosmo fit result. The phase is relative to now.
+
+    Parameters
+    ----------
+    result : sncosmo.utils.Result
+        The result of sncosmo.fit_lc.
+    npoints : int
+        Number of points fitted.
+
+    Returns
+    -------
+    salt_params : dict
+        The salt3 parameters and errors.
+    '''
+    lcphase = Time.now().mjd-result['parameters'][1]
+    params = np.array([result['chisq'],lcphase, result['parameters'][0],
+                                  result['parameters'][1],
+                                  10.635-2.5*np.log10(result['parameters'][2]),
+                                  result['parameters'][3],
+                                  result['parameters'][4],
+                                  npoints]+list(result['errors'].values()))
+    pnames = ['chisq','phase','z','t0','ms','x1','c','npoints']+list(key+'_err' for key in result['errors'].keys())
+    return dict(zip(pnames,params))
@@ -0,0 +1,106 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+def radec_to_xyz(ra, dec):
+    '''
+    Converts positions in degrees to unit vectors.
+
+    Returns
+    -------
+    xyz : np.ndarray
+        Array of shape (n, 3).
+    '''
+    ra = np.radians(np.atleast_1d(np.asarray(ra,dtype=float)))
+    dec = np.radians(np.atleast_1d(np.asarray(dec,dtype=float)))
+    return np.column_stack([np.cos(dec)*np.cos(ra),np.cos(dec)*np.sin(ra),np.sin(dec)])
+
+def chord(radius):
+    '''
+    Chord length on the unit sphere for an angular radius in arcseconds.
+    '''
+    return 2*np.sin(np.radians(radius/3600.)/2)
+
+class sky_index:
+
+    def __init__(self, keys=(), ra=(), dec=(), rebuild=64):
+        '''
+        Spatial index of sky positions, a KD-tree on unit vectors. Radius queries are answered locally instead of with a cross-match request to a service.
+
+        Parameters
+        ----------
+        keys : list, optional
+            Identifier of each position, e.g. an object name. The default is ().
+        ra, dec : array_like, optional
+            Positions in degrees. The default is ().
+        rebuild : int, optional
+            Positions added one at a time are searched linearly until this many are pending, then the tree is rebuilt. The default is 64.
+        '''
+        self.keys = list(keys)
+        self._xyz = radec_to_xyz(ra,dec) if len(self.keys) else np.empty((0,3))
+        self._pending = []
+        self._rebuild = rebuild
+        self._tree = cKDTree(self._xyz)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _flush(self):
+        if self._pending:
+            self._xyz = np.vstack([self._xyz]+self._pending)
+            self._pending = []
+            self._tree = cKDTree(self._xyz)
+
+    def add(self, key, ra, dec):
+        '''
+        Adds one position.
+        '''
+        self.keys.append(key)
+        self._pending.append(radec_to_xyz(ra,dec))
+        if len(self._pending) >= self._rebuild:
+            self._flush()
+
+    def query(self, ra, dec, radius):
+        '''
+        Finds every indexed position within radius of a position.
+
+        Parameters
+        ----------
+        ra, dec : float
+            Position in degrees.
+        radius : float
+            Radius in arcseconds.
+
+        Returns
+        -------
+        keys : list
+            Keys of the matches, nearest first.
+        '''
+        xyz = radec_to_xyz(ra,dec)[0]
+        r = chord(radius)
+        idx = self._tree.query_ball_point(xyz,r) if self._tree.n else []
+        if self._pending:
+            n = self._tree.n
+            d = np.linalg.norm(np.vstack(self._pending)-xyz,axis=1)
+            idx = list(idx)+list(n+np.flatnonzero(d <= r))
+        if len(idx) > 1:
+            # nearest first
+            pos = np.vstack([self._xyz]+self._pending)
+            idx = np.array(idx)[np.argsort(np.linalg.norm(pos[idx]-xyz,axis=1),kind='stable')]
+        return [self.keys[i] for i in idx]
+
+    def pairs(self, radius):
+        '''
+        All-pairs match of the indexed positions.
+
+        Parameters
+        ----------
+        radius : float
+            Radius in arcseconds.
+
+        Returns
+        -------
+        pairs : list of tuple
+            (key, key) for every pair of positions within radius of each other.
+        '''
+        self._flush()
+        return [(self.keys[i],self.keys[j]) for i,j in self._tree.query_pairs(chord(radius))]
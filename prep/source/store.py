@@ -0,0 +1,255 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from .sky import sky_index
+
+def default_cache_dir():
+    '''
+    Directory of the on-disk caches. Set the PREP_CACHE_DIR environment variable to change it.
+
+    Returns
+    -------
+    path : str
+        The default is ~/.cache/prep.
+    '''
+    return os.environ.get('PREP_CACHE_DIR',os.path.join(os.path.expanduser('~'),'.cache','prep'))
+
+class lc_store:
+
+    def __init__(self,path=None):
+        '''
+        SQLite store of downloaded light curves keyed by source and object id (ZTF oid, YSE name). Each entry records the MJD of the newest detection it holds, so a source only downloads again when the upstream reports something newer.
+
+        Parameters
+        ----------
+        path : str, optional
+            Path of the SQLite file. The default is None which uses prep.sqlite in default_cache_dir().
+        '''
+        if path is None:
+            os.makedirs(default_cache_dir(),exist_ok=True)
+            path = os.path.join(default_cache_dir(),'prep.sqlite')
+        self.path = path
+        # light curves are fetched from several threads, see prep.fetch
+        self._lock = threading.Lock()
+        self.con = sqlite3.connect(path,check_same_thread=False)
+        with self._lock, self.con:
+            self.con.execute('CREATE TABLE IF NOT EXISTS lightcurves (source TEXT, oid TEXT, last_mjd REAL, updated REAL, data BLOB, PRIMARY KEY (source, oid))')
+            self.con.execute('CREATE TABLE IF NOT EXISTS objects (source TEXT, oid TEXT, ra REAL, dec REAL, seen REAL, PRIMARY KEY (source, oid))')
+
+    def get(self,source,oid,last_mjd=None):
+        '''
+        Returns the stored light curve if it is up to date.
+
+        Parameters
+        ----------
+        source : str
+            Name of the source, e.g. 'alerce' or 'yse'.
+        oid : str
+            Object id within the source.
+        last_mjd : float, optional
+            MJD of the newest detection reported by the source. The default is None which means the source cannot tell, so the stored entry is never considered up to date.
+
+        Returns
+        -------
+        data : object or None
+            The stored data, or None if nothing is stored or the source has newer detections.
+        '''
+        if last_mjd is None or last_mjd != last_mjd:
+            return
+        with self._lock:
+            if self.con is None:
+                return
+            row = self.con.execute('SELECT last_mjd, data FROM lightcurves WHERE source=? AND oid=?',(source,oid)).fetchone()
+        if row is None or row[0] is None or row[0] < last_mjd:
+            return
+        return pickle.loads(row[1])
+
+    def last_mjd(self,source,oid):
+        '''
+        MJD of the newest stored detection of an object.
+
+        Returns
+        -------
+        last_mjd : float or None
+            None if the object is not stored.
+        '''
+        with self._lock:
+            if self.con is None:
+                return
+            row = self.con.execute('SELECT last_mjd FROM lightcurves WHERE source=? AND oid=?',(source,oid)).fetchone()
+        return None if row is None else row[0]
+
+    def put(self,source,oid,data,last_mjd):
+        '''
+        Stores the light curve of an object, replacing any older entry.
+
+        Parameters
+        ----------
+        source : str
+            Name of the source, e.g. 'alerce' or 'yse'.
+        oid : str
+            Object id within the source.
+        data : object
+            Anything picklable, usually the light curve DataFrame.
+        last_mjd : float
+            MJD of the newest detection in data.
+        '''
+        blob = pickle.dumps(data,protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            if self.con is None:
+                return
+            with self.con:
+                self.con.execute('INSERT OR REPLACE INTO lightcurves VALUES (?,?,?,?,?)',(source,oid,float(last_mjd),time.time(),blob))
+
+    def record(self,source,oid,ra,dec):
+        '''
+        Records the position of an object so later runs can cross-match against it locally, see sky_index.
+
+        Parameters
+        ----------
+        source : str
+            Name of the source, e.g. 'alerce' or 'yse'.
+        oid : str
+            Object id within the source.
+        ra, dec : float
+            Position in degrees.
+        '''
+        with self._lock:
+            if self.con is None:
+                return
+            with self.con:
+                self.con.execute('INSERT OR REPLACE INTO objects VALUES (?,?,?,?,?)',(source,oid,float(ra),float(dec),time.time()))
+
+    def sky_index(self,source=None):
+        '''
+        Builds a spatial index of every recorded object.
+
+        Parameters
+        ----------
+        source : str, optional
+            Only index objects from this source. The default is None which indexes all of them.
+
+        Returns
+        -------
+        index : prep.source.sky.sky_index
+            Keyed by (source, oid).
+        '''
+        with self._lock:
+            if self.con is None:
+                rows = []
+            elif source is None:
+                rows = self.con.execute('SELECT source, oid, ra, dec FROM objects').fetchall()
+            else:
+                rows = self.con.execute('SELECT source, oid, ra, dec FROM objects WHERE source=?',(source,)).fetchall()
+        return sky_index([(r[0],r[1]) for r in rows],[r[2] for r in rows],[r[3] for r in rows])
+
+    def close(self):
+        '''
+        Closes the store. Downloads abandoned at a deadline may still finish afterwards, so later calls do nothing instead of touching the closed connection: reads find nothing and writes are dropped.
+        '''
+        with self._lock:
+            if self.con is not None:
+                self.con.close()
+                self.con = None
+
+class fit_store:
+
+    def __init__(self,path=None):
+        '''
+        SQLite cache of SALT3 fit results keyed by a content hash of the fit inputs, see prep.source.salt.fit_key. Shares its file with lc_store.
+
+        Parameters
+        ----------
+        path : str, optional
+            Path of the SQLite file. The default is None which uses prep.sqlite in default_cache_dir().
+        '''
+        if path is None:
+            os.makedirs(default_cache_dir(),exist_ok=True)
+            path = os.path.join(default_cache_dir(),'prep.sqlite')
+        self.path = path
+        self._lock = threading.Lock()
+        # fits are written from several worker processes
+        self.con = sqlite3.connect(path,timeout=30,check_same_thread=False)
+        with self._lock, self.con:
+            self.con.execute('CREATE TABLE IF NOT EXISTS fits (key TEXT PRIMARY KEY, name TEXT, updated REAL, result BLOB)')
+            self.con.execute('CREATE INDEX IF NOT EXISTS fits_name ON fits (name, updated)')
+
+    def get(self,key):
+        '''
+        Returns the stored fit result for a key.
+
+        Parameters
+        ----------
+        key : str
+            Content hash of the fit inputs.
+
+        Returns
+        -------
+        result : sncosmo.utils.Result or None
+            The stored result of sncosmo.fit_lc, or None if there is none.
+        '''
+        with self._lock:
+            row = self.con.execute('SELECT result FROM fits WHERE key=?',(key,)).fetchone()
+        return None if row is None else pickle.loads(row[0])
+
+    def put(self,key,name,result):
+        '''
+        Stores a fit result.
+
+        Parameters
+        ----------
+        key : str
+            Content hash of the fit inputs.
+        name : str
+            Name of the fitted object.
+        result : sncosmo.utils.Result
+            The result of sncosmo.fit_lc.
+        '''
+        blob = pickle.dumps(result,protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock, self.con:
+            self.con.execute('INSERT OR REPLACE INTO fits VALUES (?,?,?,?)',(key,name,time.time(),blob))
+
+    def last(self,name):
+        '''
+        Returns the most recent fit of an object, used to warm start the next fit.
+
+        Parameters
+        ----------
+        name : str
+            Name of the fitted object.
+
+        Returns
+        -------
+        result : sncosmo.utils.Result or None
+            The most recently stored result for the object, or None if there is none.
+        '''
+        with self._lock:
+            row = self.con.execute('SELECT result FROM fits WHERE name=? ORDER BY updated DESC LIMIT 1',(name,)).fetchone()
+        return None if row is None else pickle.loads(row[0])
+
+    def close(self):
+        self.con.close()
+
+_fit_store = None
+
+def get_fit_store():
+    '''
+    Returns the fit_store of this process at the default path, opening it on first use.
+
+    Returns
+    -------
+    store : fit_store
+    '''
+    global _fit_store
+    if _fit_store is None:
+        _fit_store = fit_store()
+    return _fit_store
+
+def _reset_fit_store():
+    global _fit_store
+    _fit_store = None
+
+# a forked worker must not share the parent's SQLite connection
+os.register_at_fork(after_in_child=_reset_fit_store)
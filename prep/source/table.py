@@ -0,0 +1,286 @@
+import copy
+import json
+import os
+from collections import OrderedDict
+import numpy as np
+import sncosmo
+from sncosmo.utils import Result
+from .bandpassdict import *
+from .salt import get_model, get_bandpass, band_lightcurves
+from .store import default_cache_dir
+from ..atomic import write_atomic
+
+# grid of the bandflux tables, the phase step is in rest frame days
+table_z = np.round(np.arange(0.,0.801,0.01),3)
+table_c = np.round(np.arange(-0.4,0.401,0.05),3)
+table_phase_step = 0.5
+
+# Process-local cache of loaded tables, see get_bandflux_table.
+_tables = {}
+
+def _locate(grid,v):
+    '''
+    Index of the cell of a uniform grid holding v and the interpolation weight of its upper node.
+    '''
+    x = (np.asarray(v,dtype=float)-grid[0])/(grid[1]-grid[0])
+    i = np.clip(np.floor(x).astype(int),0,grid.size-2)
+    return i, x-i
+
+class bandflux_table:
+
+    def __init__(self,path,mmap=True):
+        '''
+        Precomputed SALT bandfluxes on a (band, z, c, phase) grid, per unit x0 and split in the x1=0 part and its derivative in x1 so x1 needs no grid. Values in between are linearly interpolated. The array is memory-mapped read-only, so worker processes share one copy through the page cache.
+
+        Parameters
+        ----------
+        path : str
+            Path of the table without extension, see build_bandflux_table.
+        mmap : bool, optional
+            If False, the table is read into memory. The default is True.
+        '''
+        self.path = path
+        with open(path+'.json') as f:
+            self.meta = json.load(f)
+        self.bands = {b:i for i,b in enumerate(self.meta['bands'])}
+        self.z = np.array(self.meta['z'])
+        self.c = np.array(self.meta['c'])
+        self.phase = np.array(self.meta['phase'])
+        # shape (2, band, z, c, phase)
+        self.flux = np.load(path+'.npy',mmap_mode='r' if mmap else None)
+
+    def covers(self,z=None,c=None):
+        '''
+        Whether a redshift and color lie inside the table.
+        '''
+        return (z is None or self.z[0] <= z <= self.z[-1]) and (c is None or self.c[0] <= c <= self.c[-1])
+
+    def lightcurves(self,band,z,time,cs):
+        '''
+        Light curves in one band for several colors, like prep.source.salt.band_lightcurves.
+
+        Parameters
+        ----------
+        band : str
+            Bandpass name.
+        z : float
+            Redshift.
+        time : np.ndarray
+            Observer frame times relative to t0.
+        cs : np.ndarray
+            Colors.
+
+        Returns
+        -------
+        f0, f1 : np.ndarray
+            Bandflux of shape (len(time), len(cs)). NaN if the band, redshift or a color is not in the table.
+        '''
+        cs = np.asarray(cs,dtype=float)
+        if band not in self.bands or not self.covers(z,cs.min()) or not self.covers(c=cs.max()):
+            nan = np.full((len(time),cs.size),np.nan)
+            return nan, nan
+        iz, wz = _locate(self.z,z)
+        slab = (1-wz)*self.flux[:,self.bands[band],iz]+wz*self.flux[:,self.bands[band],iz+1]
+        ic, wc = _locate(self.c,cs)
+        slab = (1-wc)[None,:,None]*slab[:,ic]+wc[None,:,None]*slab[:,ic+1]
+        phase = np.asarray(time,dtype=float)/(1+z)
+        out = np.stack([np.array([np.interp(phase,self.phase,s,left=0.,right=0.) for s in comp]).T for comp in slab])
+        return out[0], out[1]
+
+    def points(self,band,phase,z,c):
+        '''
+        Bandflux components of individual points at one redshift and color.
+
+        Parameters
+        ----------
+        band : np.ndarray of int
+            Table index of the band of each point, see bands.
+        phase : np.ndarray
+            Rest frame phase of each point.
+        z, c : float
+            Redshift and color, inside the table.
+
+        Returns
+        -------
+        f0, f1 : np.ndarray
+            Bandflux per unit x0 at x1=0 and its derivative in x1. Zero outside of the phase range of the model.
+        '''
+        iz, wz = _locate(self.z,z)
+        ic, wc = _locate(self.c,c)
+        ip, wp = _locate(self.phase,phase)
+        out = 0.
+        for dz,fz in ((0,1-wz),(1,wz)):
+            for dc,fc in ((0,1-wc),(1,wc)):
+                for dp,fp in ((0,1-wp),(1,wp)):
+                    out = out+fz*fc*fp*self.flux[:,band,iz+dz,ic+dc,ip+dp]
+        out[:,(phase < self.phase[0]) | (phase > self.phase[-1])] = 0.
+        return out[0], out[1]
+
+def default_table_path(source='salt3'):
+    '''
+    Path of the bandflux table of a model in default_cache_dir(), without extension.
+    '''
+    src = get_model(source).source
+    return os.path.join(default_cache_dir(),f'{src.name}_{src.version}_bandflux')
+
+def build_bandflux_table(path=None,source='salt3',bands=None,z=table_z,c=table_c,phase_step=table_phase_step):
+    '''
+    Integrates the model through every band on the table grid and saves it as a .npy array with a .json description.
+
+    Parameters
+    ----------
+    path : str, optional
+        Path of the table without extension. The default is None which uses default_table_path(source).
+    source : str, optional
+        Name of the sncosmo source. The default is 'salt3'.
+    bands : list of str, optional
+        Bandpass names. The default is None which uses every value of bandpassdict that is in the sncosmo registry.
+    z, c : array_like, optional
+        Uniform redshift and color grids. The defaults are table_z and table_c.
+    phase_step : float, optional
+        Step of the rest frame phase grid in days. The default is table_phase_step.
+
+    Returns
+    -------
+    table : bandflux_table
+        The new table.
+    '''
+    if path is None:
+        path = default_table_path(source)
+    if bands is None:
+        bands = []
+        for name in sorted(set(bandpassdict.values())):
+            try:
+                get_bandpass(name)
+                bands.append(name)
+            except Exception:
+                continue
+    model = get_model(source)
+    z, c = np.asarray(z,dtype=float), np.asarray(c,dtype=float)
+    phase = np.arange(model.source.minphase(),model.source.maxphase()+phase_step/2,phase_step)
+    flux = np.full((2,len(bands),z.size,c.size,phase.size),np.nan)
+    for j,name in enumerate(bands):
+        bp = get_bandpass(name)
+        for i,zi in enumerate(z):
+            model.set(z=zi,t0=0.)
+            # left NaN where the band is outside of the model at this redshift
+            if bp.minwave() < model.minwave() or bp.maxwave() > model.maxwave():
+                continue
+            f0, f1 = band_lightcurves(model,bp,phase*(1+zi),c)
+            flux[0,j,i], flux[1,j,i] = f0.T, f1.T
+    os.makedirs(os.path.dirname(os.path.abspath(path)),exist_ok=True)
+    meta = {'source':model.source.name,'version':model.source.version,'bands':list(bands),
+            'z':z.tolist(),'c':c.tolist(),'phase':phase.tolist()}
+    # readers never see a partial table
+    write_atomic(path+'.npy',lambda f: np.save(f,flux),'wb')
+    write_atomic(path+'.json',json.dumps(meta))
+    return bandflux_table(path)
+
+def get_bandflux_table(source='salt3',path=None):
+    '''
+    Returns the bandflux table of a model, cached per process. It is built with build_bandflux_table the first time.
+
+    Parameters
+    ----------
+    source : str, optional
+        Name of the sncosmo source. The default is 'salt3'.
+    path : str, optional
+        Path of the table without extension. The default is None which uses default_table_path(source).
+
+    Returns
+    -------
+    table : bandflux_table
+    '''
+    if path is None:
+        path = default_table_path(source)
+    if path not in _tables:
+        if os.path.exists(path+'.npy') and os.path.exists(path+'.json'):
+            _tables[path] = bandflux_table(path)
+        else:
+            _tables[path] = build_bandflux_table(path,source)
+    return _tables[path]
+
+def fit_table(lc,model,fitparams,bounds,table,start=None,maxcall=1000):
+    '''
+    Minimizes the chi-square of a light curve with iminuit like sncosmo.fit_lc, but evaluates the model from a bandflux_table instead of integrating its spectra.
+
+    Parameters
+    ----------
+    lc : prep.source.photometry.lightcurve
+        The photometry to fit.
+    model : sncosmo.Model
+        SALT model holding the values of the fixed parameters.
+    fitparams : list of str
+        Parameters to vary.
+    bounds : dict
+        Bounds of the varied parameters, see prep.source.salt.fit_bounds. z and c are also limited to the table.
+    table : bandflux_table
+        The table of the model.
+    start : dict, optional
+        Starting values, e.g. a cell of prep.source.salt.grid_search. The default is None which starts from the model.
+    maxcall : int, optional
+        Maximum number of chi-square evaluations. The default is 1000.
+
+    Returns
+    -------
+    result : sncosmo.utils.Result
+        Fit result with the same fields as the one of sncosmo.fit_lc.
+    fitted_model : sncosmo.Model
+        The model with the best fit parameters.
+    '''
+    import iminuit
+    model = copy.copy(model)
+    if start:
+        model.set(**{k:v for k,v in start.items() if k in fitparams and np.isfinite(v) and (k != 'x0' or v > 0)})
+    names = list(model.param_names)
+    missing = set(lc.band_name)-set(table.bands)
+    if missing:
+        raise ValueError(f'bands not in the bandflux table: {sorted(missing)}')
+    band = np.array([table.bands[b] for b in lc.band_name])
+    norm = 10**(0.4*lc.zp)
+    for b in np.unique(lc.band_name):
+        for ms in np.unique(lc.zpsys[lc.band_name == b]):
+            m = (lc.band_name == b) & (lc.zpsys == ms)
+            norm[m] /= sncosmo.get_magsystem(ms).zpbandflux(get_bandpass(b))
+    limits = dict(bounds)
+    for k,grid in (('z',table.z),('c',table.c)):
+        if k in fitparams:
+            lo, hi = limits.get(k,(grid[0],grid[-1]))
+            limits[k] = (max(lo,grid[0]),min(hi,grid[-1]))
+        elif not grid[0] <= model[k] <= grid[-1]:
+            raise ValueError(f'fixed {k} outside of the bandflux table')
+
+    def chisq(p):
+        z, t0, x0, x1, c = p
+        f0, f1 = table.points(band,(lc.mjd-t0)/(1+z),z,c)
+        r = (lc.flux-x0*norm*(f0+x1*f1))/lc.fluxerr
+        v = np.dot(r,r)
+        # NaN where a band is outside of the model at this redshift
+        return v if np.isfinite(v) else 1e30
+
+    start_values = model.parameters.copy()
+    for i,k in enumerate(names):
+        if k in ('z','c') and k in fitparams:
+            start_values[i] = np.clip(start_values[i],*limits[k])
+    m = iminuit.Minuit(chisq,start_values,name=names)
+    m.errordef = iminuit.Minuit.LEAST_SQUARES
+    for k in names:
+        if k not in fitparams:
+            m.fixed[k] = True
+            continue
+        if k in limits:
+            m.limits[k] = limits[k]
+            m.errors[k] = 0.02*(limits[k][1]-limits[k][0])
+        else:
+            m.errors[k] = 0.1*abs(model[k]) or 1.
+    m.migrad(ncall=maxcall)
+    vparam_names = [k for k in names if k in fitparams]
+    parameters = np.array(m.values)
+    model.parameters = parameters
+    covariance = None if m.covariance is None else np.array([[m.covariance[(a,b)] for a in vparam_names] for b in vparam_names])
+    result = Result(success=m.valid,
+                    message='Minimization exited successfully.' if m.valid else 'Minimization failed.',
+                    ncall=m.nfcn,chisq=m.fval,ndof=len(lc)-len(vparam_names),
+                    param_names=names,parameters=parameters,vparam_names=vparam_names,
+                    covariance=covariance,errors=OrderedDict((k,m.errors[k]) for k in vparam_names),nfit=1)
+    return result, model
@@ -2,63 +2,264 @@ import requests as req
 import pandas as pd
 import os
 from requests.auth import HTTPBasicAuth
-from ..auth import *
-from io import StringIO
-import matplotlib.pyplot as plt
-import sncosmo
+from requests.adapters import HTTPAdapter
+from ..credentials import get_credential
+from ..metrics import count_bytes
+from ..transport import install
+from io import StringIO, BytesIO
 from .bandpassdict import *
-from astropy.table import Table
+from .salt import *
+from .photometry import *
 import numpy as np
 from astropy.time import Time
-import re
 # from tns_search_download_csv import search_tns
-from astro_ghost.ghostHelperFunctions import getTransientHosts
 import tempfile
 from astropy.coordinates import SkyCoord
 
 # today = Time.now()
 
+class yse_client:
+
+    def __init__(self,login=None,password=None,pool_size=10):
+        '''
+        Client for YSE-PZ that keeps a pool of keep-alive connections and memoizes transient lookups.
+
+        Parameters
+        ----------
+        login : str, optional
+            YSE-PZ login. The default is None.
+        password : str, optional
+            YSE-PZ password. The default is None.
+        pool_size : int, optional
+            Maximum number of connections kept open. The default is 10.
+
+        Attributes
+        ----------
+        session : requests.Session
+            Session shared by every request to YSE-PZ.
+        '''
+        self.url = 'https://ziggy.ucolick.org/yse'
+        self.session = req.Session()
+        self.session.auth = HTTPBasicAuth(login, password)
+        self.session.mount('https://',HTTPAdapter(pool_connections=1,pool_maxsize=pool_size))
+        count_bytes(self.session,'yse')
+        install(self.session,'yse')
+        self._transients = {}
+
+    def get(self,path,**kwargs):
+        '''
+        GET request to YSE-PZ over the pooled session.
+
+        Parameters
+        ----------
+        path : str
+            Path relative to the YSE-PZ root, e.g. 'explorer/254/download'.
+        **kwargs
+            Passed to requests.Session.get.
+
+        Returns
+        -------
+        r : requests.Response
+        '''
+        r = self.session.get(f'{self.url}/{path}',**kwargs)
+        r.raise_for_status()
+        return r
+
+    def transient(self,name):
+        '''
+        Looks up a transient in the YSE-PZ API. Results are memoized until clear is called.
+
+        Parameters
+        ----------
+        name : str
+            Transient name without the SN prefix.
+
+        Returns
+        -------
+        results : list of dict
+            JSON entries for the transient, empty if it is not on YSE-PZ.
+        '''
+        if name not in self._transients:
+            self._transients[name] = self.get(f'api/transients/?name={name}').json()['results']
+        return self._transients[name]
+
+    def clear(self):
+        '''
+        Forgets memoized transient lookups.
+        '''
+        self._transients.clear()
+
+_client = None
+
+def get_yse_client():
+    '''
+    Returns the YSE-PZ client of this process, creating it on first use.
+
+    Returns
+    -------
+    client : yse_client
+    '''
+    global _client
+    if _client is None:
+        _client = yse_client(get_credential('login'),get_credential('password'))
+    return _client
+
+def reset_yse_client():
+    '''
+    Drops the client of this process. The next get_yse_client call opens a new session with empty lookups.
+    '''
+    global _client
+    _client = None
+
+# a forked worker must not share the parent's sockets
+os.register_at_fork(after_in_child=reset_yse_client)
+
+# column names of the "young and fast" explorer query
+young_and_fast_columns = ['name','classification','first_detection','latest_detection','number_of_detection','group_name']
+
+def explorer_query(query_id,names=None,path=None,prefix='YSE'):
+    '''
+    Downloads the result of a YSE-PZ explorer query.
+
+    Parameters
+    ----------
+    query_id : int
+        Number of the explorer query.
+    names : list of str, optional
+        Column names that replace the header row of the download. The default is None which keeps the header.
+    path : str, optional
+        Directory to also write the csv file to, named {prefix}_{time}.csv. The default is None which writes nothing.
+    prefix : str, optional
+        Start of the file name. The default is 'YSE'.
+
+    Returns
+    -------
+    df : pd.DataFrame
+        One row per result.
+    '''
+    r = get_yse_client().get(f'explorer/{query_id}/download')
+    # utf-8-sig drops the byte order mark YSE-PZ starts the file with
+    df = pd.read_csv(BytesIO(r.content),encoding='utf-8-sig',**({} if names is None else {'skiprows':1,'names':names}))
+    if path is not None:
+        time = Time.now().to_value('datetime').strftime('%Y%m%d_%H%M%S')
+        df.to_csv(os.path.join(path,f'{prefix}_{time}.csv'),index=False)
+    return df
+
 def young_and_fast(path=None):
     '''
-    Queries YSE "young and fast" SQL query and writes the results to a csv file
+    Queries YSE "young and fast" SQL query.
 
     Parameters
     ----------
     path : str, optional
-        Path to write csv file to. The default is None which will write to current working directory.
+        Directory to also write the results to as a csv file. The default is None.
+
+    Returns
+    -------
+    df : pd.DataFrame
+        Columns of young_and_fast_columns.
     '''
-    today = Time.now()
-    q1=req.get('https://ziggy.ucolick.org/yse/explorer/254/download',auth=HTTPBasicAuth(login, password))
-    q1.raise_for_status()
-    qt1=q1.text
-    qt1=qt1.strip('ï»¿')
-    time =today.to_value('datetime').strftime('%Y%m%d_%H%M%S')
-    if path is None:
-        path = os.getcwd()
-    p1 = os.path.join(path,f'YSE_{time}.csv')
-    with open(p1,'w') as f:
-        f.write(qt1)
-        f.close()
-    return 0
+    return explorer_query(254,young_and_fast_columns,path)
 
 def possible_hst(path=None):
-    today = Time.now()
-    q1=req.get('https://ziggy.ucolick.org/yse/explorer/364/download',auth=HTTPBasicAuth(login, password))
-    q1.raise_for_status()
-    qt1=q1.text
-    qt1=qt1.strip('ï»¿')
-    time =today.to_value('datetime').strftime('%Y%m%d_%H%M%S')
-    if path is None:
-        path = os.getcwd()
-    p1 = os.path.join(path,f'YSE_HST_DUST_{time}.csv')
-    with open(p1,'w') as f:
-        f.write(qt1)
-        f.close()
-    return 0
+    '''
+    Queries the YSE explorer query of possible HST targets in low dust regions.
+
+    Parameters
+    ----------
+    path : str, optional
+        Directory to also write the results to as a csv file. The default is None.
+
+    Returns
+    -------
+    df : pd.DataFrame
+    '''
+    return explorer_query(364,path=path,prefix='YSE_HST_DUST')
+
+def parse_photometry(lines):
+    '''
+    Parses a YSE-PZ photometry file from its lines, e.g. straight from a streamed response. The header is parsed as the lines come in, the data rows are collected and parsed by a single pd.read_csv at the end, which is much faster than parsing them row by row. The rows are held in memory once, without the temporary file of earlier versions.
+
+    Parameters
+    ----------
+    lines : iterable of str or bytes
+        Lines of the file. "#KEY: value" lines are header entries, the first other line names the columns and the rest are whitespace separated rows.
+
+    Returns
+    -------
+    header : dict
+        Header entries as strings.
+    data : pd.DataFrame
+        The rows, typed like pd.read_csv does.
+    '''
+    header = {}
+    body = []
+    for line in lines:
+        if isinstance(line,bytes):
+            line = line.decode('utf-8','replace')
+        if line.startswith('#'):
+            key, sep, value = line[1:].partition(':')
+            if sep:
+                header[key.strip()] = value.strip()
+        elif line.strip():
+            body.append(line)
+    if not body:
+        return header, pd.DataFrame()
+    return header, pd.read_csv(StringIO('\n'.join(body)),sep=r'\s+',comment='#')
+
+def match_yse(ra,dec,index,radius=2.0,verbose=False):
+    '''
+    Cross-matches a position against a local index of known YSE objects.
+
+    Parameters
+    ----------
+    ra, dec : float
+        Position in degrees.
+    index : prep.source.sky.sky_index
+        Index of YSE objects keyed by name or (source, name), e.g. lc_store().sky_index('yse').
+    radius : float, optional
+        Match radius in arcseconds. The default is 2.
+    verbose : bool, optional
+        If True, prints if the object is found. The default is False.
+
+    Returns
+    -------
+    yse_object : yse_object or None
+        The nearest indexed YSE object within radius, None if there is none.
+    '''
+    matches = index.query(ra,dec,radius)
+    if not matches:
+        if verbose:
+            print('Not found in YSE')
+        return
+    # matches are sorted by separation
+    name = matches[0][-1] if isinstance(matches[0],tuple) else matches[0]
+    if verbose:
+        print('Found in YSE')
+    return yse_object(name)
+
+def quality_cuts(lc_data,max_magerr=3):
+    '''
+    Drops photometry in unknown filters, with a magnitude error of max_magerr or more, or with any missing value.
+
+    Parameters
+    ----------
+    lc_data : pd.DataFrame
+        Photometry from parse_photometry.
+    max_magerr : float, optional
+        The default is 3.
+
+    Returns
+    -------
+    pdata : pd.DataFrame
+    '''
+    if lc_data.empty:
+        return lc_data
+    return lc_data[(lc_data['FLT'] != 'Unknown') & (lc_data['MAGERR'] < max_magerr)].dropna()
 
 class yse_object:
 
-    def __init__(self,name,data=None):
+    def __init__(self,name,data=None,last_mjd=None):
         '''
         yse object class. Meant to read in YSE SN Object name and return a class with the following attributes:
         name: YSE SN Object name
@@ -70,6 +271,8 @@ class yse_object:
         ----------
         name : str, required
             YSE SN Object name in the format "20xxabc" but can have SN in front
+        last_mjd : float, optional
+            MJD of the latest detection as reported by a YSE-PZ explorer query, used to decide if a stored light curve is up to date.
         '''
         # Name format should be "20xxabc" but can have SN in front
         self.name =name
@@ -78,6 +281,7 @@ class yse_object:
         else:
                 self.ns = self.name
         self.data = data
+        self.last_mjd = last_mjd
         if self.check_pz()==False:
             print(f'{self.name} not found on YSE-PZ')
             raise ValueError('Not found on YSE-PZ')
@@ -95,7 +299,7 @@ class yse_object:
         r1 : dict
             JSON entry for object from YSE
         '''
-        r1 = req.get(f'https://ziggy.ucolick.org/yse/api/transients/?name={self.ns}',auth=HTTPBasicAuth(login, password)).json()['results']
+        r1 = get_yse_client().transient(self.ns)
         
         return r1
 
@@ -108,7 +312,7 @@ class yse_object:
         -------
         bool: True if object is on YSE Servers, False if not
         '''
-        r1 = req.get(f'https://ziggy.ucolick.org/yse/api/transients/?name={self.ns}',auth=HTTPBasicAuth(login, password)).json()['results']
+        r1 = self.query_yse_object()
         if r1 == []:
             return False
         else:
@@ -123,7 +327,7 @@ class yse_object:
         url = f'https://ziggy.ucolick.org/yse/transient_detail/{self.ns}'
         return url
     
-    def get_lc(self):
+    def get_lc(self,store=None):
         '''
         Gets Light Curve Data from YSE-PZ "download photometry" button. 
         
@@ -131,31 +335,43 @@ class yse_object:
         header: Header information from YSE-PZ
         lc_data: Pandas DataFrame of all data from YSE-PZ
         pdata: Pandas DataFrame of all data from YSE-PZ with quality cuts applied
+
+        Parameters
+        ----------
+        store : prep.source.store.lc_store, optional
+            Light curve store. If it holds the object up to last_mjd the download is skipped, otherwise the downloaded photometry is stored. YSE-PZ only serves full photometry files so an outdated entry is refreshed in full. The default is None.
         '''
-        r=req.get(f'https://ziggy.ucolick.org/yse/download_photometry/{self.ns}/',auth=HTTPBasicAuth(login, password))
-        r.raise_for_status()
-        li=r.text.split('\n')
-        key1=[]
-        val1=[]
-        for i in range(len(li)):
-            if li[i].startswith('#'):
-                vs=li[i].removeprefix('#')
-                key1.append(vs.split(':')[0].strip())
-                val1.append(vs.split(re.findall('[A-Z]: ',vs)[0])[-1])
-        header = dict(zip(key1,val1))
-        self.header = header
-        # DISC_DATE=Time(header['DISC_DATE']).mjd
-        # self.dd = DISC_DATE
-        # NON_DETECT_LIMIT=header['NON_DETECT_LIMIT']
-        # NON_DETECT_BAND=header['NON_DETECT_BAND']
-        # NON_DETECT_FLT=NON_DETECT_BAND.split(' - ')[-1].strip()
-        # qstring = f'DQ!="Bad" & FLT != "Unknown" & MAG<{NON_DETECT_LIMIT} & MJD>{NON_DETECT_MJD} & FLT != "{NON_DETECT_FLT}"'
-        snr_cut = 3
-        qstring = f' FLT != "Unknown"  & MAGERR<{snr_cut}'
-        self.lc_data=pd.read_csv(StringIO('\n'.join(li)),sep='\s+',comment='#')
-        self.pdata=pd.read_csv(StringIO('\n'.join(li)),sep='\s+',comment='#').query(qstring).dropna()
+        cached = None if store is None else store.get('yse',self.ns,self.last_mjd)
+        if cached is not None:
+            self.header, self.lc_data = cached
+        else:
+            r = get_yse_client().get(f'download_photometry/{self.ns}/',stream=True)
+            with r:
+                self.header, self.lc_data = parse_photometry(r.iter_lines(chunk_size=65536))
+            if store is not None and len(self.lc_data):
+                store.put('yse',self.ns,(self.header,self.lc_data),self.lc_data['MJD'].max())
+        self.pdata = quality_cuts(self.lc_data)
     
-    def salt3(self,plot=False):
+    def to_lightcurve(self):
+        '''
+        Converts the photometry with quality cuts to the columnar lightcurve used for fitting. Requires get_lc to be run first.
+
+        Returns
+        -------
+        lcurve : prep.source.photometry.lightcurve
+            Points in bands listed in bandpassdict.
+        '''
+        try:
+            self.pdata
+        except:
+            raise ValueError('Need to run get_lc first')
+        # vectorized "Band: INSTRUMENT - FILTER" keys, HKO photometry is ACAM1
+        ins = self.pdata['INSTRUMENT'].astype(str).replace('HKO','ACAM1')
+        keys = ('Band: '+ins+' - '+self.pdata['FLT'].astype(str)).where(self.pdata['FLUXCAL']<1e10)
+        self.lcurve = lightcurve.from_mag(self.pdata['MJD'].values,self.pdata['MAG'].values,self.pdata['MAGERR'].values,keys.values)
+        return self.lcurve
+
+    def salt3(self,plot=False,cache=None,warm=False,extra=None,method='minuit'):
         '''
         Conducts a SALT3 fit to the light curve data. Uses the sncosmo package. Requires get_lc to be run first.
 
@@ -166,76 +382,32 @@ class yse_object:
         ----------
         plot : bool, optional
             If True, plots the SALT3 fit with photometry data. The default is False.
+        cache : prep.source.store.fit_store, optional
+            Fit cache. If the photometry and fit configuration are unchanged since a stored fit, the fit is skipped and only the phase is recomputed. The default is None.
+        warm : bool, optional
+            If True, starts the fit from the last cached fit of this object and falls back to a cold fit if that goes wrong. Needs cache. The default is False.
+        extra : list of prep.source.photometry.lightcurve, optional
+            Photometry of the same object from other surveys, merged into the fit with combine_lightcurves. The default is None.
+        method : str, optional
+            'minuit' fits with sncosmo.fit_lc over the full bounds, 'grid' searches a redshift, color and t0 grid first and polishes the best cell, 'table' does that with precomputed bandfluxes. The default is 'minuit'.
         '''
+        self.to_lightcurve()
+        if extra:
+            self.lcurve = combine_lightcurves([self.lcurve]+list(extra))
+        model = get_model('salt3')
+        fitparams = ['z', 't0', 'x0', 'x1', 'c']
+        # fix the redshift if YSE-PZ has one
         try:
-            self.pdata
-        except:
-            raise ValueError('Need to run get_lc first')
-        salt2band = np.array([])
-        zpsys = np.array([])
-        mask  = []
-        # bs =[]
-        for ins,flt in zip(self.pdata['INSTRUMENT'],self.pdata['FLT']):
-            if ins == 'HKO':
-                ins = 'ACAM1'
-            # bs.append()
-            if f"Band: {ins} - {flt}" not in bandpassdict.keys():
-                
-                mask.append(False)
-                salt2band = np.append(salt2band,str(np.nan))
-                zpsys = np.append(zpsys,str(np.nan))
-            else:
-                
-                mask.append(True)
-                salt2band = np.append(salt2band,bandpassdict[f"Band: {ins} - {flt}"])
-                if 'bessell' in salt2band[-1]:
-                    zpsys = np.append(zpsys,'Vega')
-                else:
-                    zpsys = np.append(zpsys,'AB')
-        model = sncosmo.Model(source='salt3')
-
-        # if sn.Redshift:
-        #     model.set(z=sn.Redshift); fitparams = ['t0', 'x0', 'x1', 'c']
-        try:
-            if self.header['REDSHIFT']!='' or self.header['REDSHIFT']==None:
-                model.set(z=float(self.header['REDSHIFT']))
-                fitparams = [ 't0', 'x0', 'x1', 'c']
-            else:
-                pass
-        except:
-            fitparams = ['z', 't0', 'x0', 'x1', 'c']
-        mask = mask & (self.pdata['FLUXCAL']<1e10) #& (pdata['MJD'].values>60052)
-        # model.set(z=sn['Host Redshift'])
-        salt2mjd = self.pdata['MJD'][mask].values
-        mag = self.pdata['MAG'][mask].values
-        flux = 10**(-0.4*(mag-27.5))
-        # flux = pdata['FLUXCAL'][mask].values
-        mag_err=self.pdata['MAGERR'][mask].values
-        # mag_err[(mag_err < 0.01)|(mag_err ==None)]=0.01
-        fluxerr = flux*mag_err*0.4*np.log(10)
-        # fluxerr = pdata['FLUXCALERR'][mask].values
-        zp = np.array([27.5]*len(salt2band))[mask]
-        zpsys = zpsys[mask]
-        salt2band = salt2band[mask]
-
-        data = Table([salt2mjd,salt2band,flux,fluxerr,zp,zpsys],names=['mjd','band','flux','fluxerr','zp','zpsys'],meta={'t0':salt2mjd[flux == np.max(flux)]})
-
-        # pkguess = np.atleast_1d(salt2mjd[flux/fluxerr > 3][flux[flux/fluxerr >3] == np.max(flux[flux/fluxerr >3])])
-        # if len(pkguess):
-        #     pkguess = pkguess[0]
-        #     data = data[(salt2mjd > pkguess-20) & (salt2mjd < pkguess+40)]
-        # print(salt2mjd)
-        result, fitted_model = sncosmo.fit_lc(
-                    data, model, fitparams,
-                    bounds={'t0':(salt2mjd[flux == np.max(flux)]-10, salt2mjd[flux == np.max(flux)]+10),
-                            'z':(0.0,0.7),'x1':(-3,3),'c':(-0.3,0.3)})  # bounds on parameters (if any)
+            model.set(z=float(self.header['REDSHIFT']))
+            fitparams = [ 't0', 'x0', 'x1', 'c']
+        except (KeyError,TypeError,ValueError):
+            pass
+        self.salt_params, result, fitted_model = fit_salt3(self.lcurve,model=model,fitparams=fitparams,cache=cache,name=self.name,warm=warm,method=method)
         
-        today = Time.now().mjd
-        lcphase = today-result['parameters'][1]
-        lcp =lcphase
         if plot:
-            print('points fitted =',len(salt2mjd))
+            print('points fitted =',len(self.lcurve))
             print('chisq =',result['chisq'])
+            lcphase = self.salt_params['phase']
             if lcphase > 0: lcphase = '+%.1f'%(lcphase)
             else: lcphase = '%.1f'%(lcphase)
             print("phase = %s days"%(lcphase))
@@ -244,24 +416,9 @@ class yse_object:
             print('ms = %.2f'%(10.635-2.5*np.log10(result['parameters'][2])))
             print('x1 = %.2f'%(result['parameters'][3]))
             print('c = %.2f'%(result['parameters'][4]))
-        # for i in range(len(result['param_names'])):
-        #     if i==2:
-        #         print('ms =',10.635-2.5*np.log10(result.parameters[i]))
-        #     else:
-        #         rp=result['parameters'][i]
-        #         print(result['param_names'][i],'=',f'%i'%(rp))
-        
-        params = np.array([result['chisq'],lcp, result['parameters'][0],
-                                      result['parameters'][1],
-                                      10.635-2.5*np.log10(result['parameters'][2]),
-                                      result['parameters'][3],
-                                      result['parameters'][4],
-                                      len(salt2mjd)]+list(result['errors'].values()))
-        pnames = ['chisq','phase','z','t0','ms','x1','c','npoints']+list(key+'_err' for key in result['errors'].keys())
-
-        self.salt_params = dict(zip(pnames,params))
 
         if plot:
+            import matplotlib.pyplot as plt
             plt.figure(figsize=(11,8))
             plt.title(f"{self.ns} (YSE-PZ)")
             plt.xlabel('MJD')
@@ -279,10 +436,10 @@ class yse_object:
                 j+=1
             # plt.plot(result)
             plotmjd = np.arange(result['parameters'][1]-20,result['parameters'][1]+50,0.5)
-            for band in np.unique(salt2band):
-                salt2flux = fitted_model.bandflux(band, plotmjd, zp=27.5,zpsys=zpsys[band == salt2band][0])
+            for code in np.unique(self.lcurve.band):
+                salt2flux = fitted_model.bandflux(band_names[code], plotmjd, zp=27.5,zpsys=band_zpsys[code])
                 
-                plt.plot(plotmjd,-2.5*np.log10(salt2flux)+27.5,label=band)
+                plt.plot(plotmjd,-2.5*np.log10(salt2flux)+27.5,label=band_names[code])
             plt.gca().invert_yaxis()
             plt.grid()
             plt.legend(loc=0)
@@ -298,6 +455,7 @@ class yse_object:
             Info of potential host galaxy.
         '''
         snCoord = SkyCoord(self.ra,self.dec,unit='deg',frame='icrs')
+        from astro_ghost.ghostHelperFunctions import getTransientHosts
         with tempfile.TemporaryDirectory() as tmp:
             ghost_info = getTransientHosts(snCoord=[snCoord], verbose=0,starcut='normal',savepath=tmp,ascentMatch=True)
         return ghost_info
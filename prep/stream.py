@@ -0,0 +1,454 @@
+import os
+import json
+import time
+import queue
+from collections import OrderedDict
+import pandas as pd
+from prep.fetch import object_from_photometry
+from prep.metrics import get_metrics
+from prep.atomic import write_atomic
+
+# light curve columns of the source objects built from alerts, see prep.fetch.object_from_photometry
+alert_columns = {'alerce':['mjd','magpsf','sigmapsf','fid'],'antares':['ant_mjd','ant_mag','ant_magerr','ant_passband']}
+
+class memory_topic:
+
+    def __init__(self):
+        '''
+        In-process stand-in for a Kafka topic, for tests and for feeding alerts from another thread.
+        '''
+        self.queue = queue.Queue()
+
+    def publish(self, alert):
+        '''
+        Adds an alert to the topic.
+        '''
+        self.queue.put(alert)
+
+    def poll(self, timeout=1.):
+        '''
+        Next alert, or None if none arrived within timeout seconds.
+        '''
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return
+
+    def mark(self):
+        return {}
+
+    def position(self):
+        return {}
+
+    def commit(self, offsets=None):
+        pass
+
+    def close(self):
+        pass
+
+class file_topic:
+
+    def __init__(self, path, start='committed'):
+        '''
+        File-backed stand-in for a Kafka topic: one JSON alert per line, read as it grows like tail -f. The byte offset of the last committed alert is kept next to the file, so a consumer started again continues where the previous one committed.
+
+        Parameters
+        ----------
+        path : str
+            The topic file. It is created if it does not exist.
+        start : str, optional
+            'committed' to continue from the committed offset, 'beginning' to read the whole file. The default is 'committed'.
+        '''
+        self.path = path
+        self.offset_path = f'{path}.offset'
+        open(path,'a').close()
+        self.offset = 0
+        if start == 'committed' and os.path.exists(self.offset_path):
+            with open(self.offset_path) as f:
+                self.offset = int(f.read().strip() or 0)
+        self.committed = self.offset
+        self.start = self.offset
+        self.file = open(path,'rb')
+        self.file.seek(self.offset)
+        self.partial = b''
+
+    def publish(self, alert):
+        '''
+        Appends an alert to the topic file.
+        '''
+        with open(self.path,'a') as f:
+            f.write(json.dumps(alert)+'\n')
+
+    def poll(self, timeout=1.):
+        '''
+        Next alert, or None if none was written within timeout seconds.
+        '''
+        end = time.monotonic()+timeout
+        while True:
+            line = self.file.readline()
+            if line.endswith(b'\n'):
+                line, self.partial = self.partial+line, b''
+                start, self.offset = self.offset, self.file.tell()
+                if line.strip():
+                    self.start = start
+                    return json.loads(line)
+                continue
+            # a line still being written
+            self.partial += line
+            if time.monotonic() >= end:
+                return
+            time.sleep(min(0.05,max(0.,end-time.monotonic())))
+
+    def mark(self):
+        '''
+        Offset the last alert returned by poll starts at.
+        '''
+        return {self.path:self.start}
+
+    def position(self):
+        '''
+        Offset after the last alert returned by poll.
+        '''
+        return {self.path:self.offset}
+
+    def commit(self, offsets=None):
+        '''
+        Stores an offset a restarted consumer continues from.
+
+        Parameters
+        ----------
+        offsets : dict, optional
+            Offset by file like position returns. The default is None which commits everything returned by poll.
+        '''
+        offset = self.offset if offsets is None else offsets[self.path]
+        if offset != self.committed:
+            write_atomic(self.offset_path,str(offset))
+            self.committed = offset
+
+    def close(self):
+        self.file.close()
+
+class kafka_topic:
+
+    def __init__(self, topic, servers, group='prep', decode=json.loads, **config):
+        '''
+        Consumer of a Kafka topic, through confluent_kafka which is only needed when this class is used. Offsets are committed by the alert_consumer once the refits of the alerts before them are done.
+
+        Parameters
+        ----------
+        topic : str or list of str
+            Topics to subscribe to.
+        servers : str
+            bootstrap.servers of the cluster, e.g. 'localhost:9092'.
+        group : str, optional
+            Consumer group id. The default is 'prep'.
+        decode : callable, optional
+            Turns the bytes of a message into an alert dict. Alerts in Avro, as ZTF publishes them, need a decoder such as fastavro.schemaless_reader. The default is json.loads.
+        **config
+            Further confluent_kafka settings with dots replaced by underscores, e.g. security_protocol='SASL_SSL'.
+        '''
+        try:
+            from confluent_kafka import Consumer, TopicPartition
+        except ImportError as e:
+            raise ImportError('kafka_topic needs confluent_kafka, pip install confluent-kafka') from e
+        conf = {'bootstrap.servers':servers,'group.id':group,'enable.auto.commit':False,'auto.offset.reset':'earliest'}
+        conf.update({k.replace('_','.'):v for k,v in config.items()})
+        self.consumer = Consumer(conf)
+        self.consumer.subscribe([topic] if isinstance(topic,str) else list(topic))
+        self.decode = decode
+        self.TopicPartition = TopicPartition
+        # next offset of every partition polled so far and the offset of the last message
+        self.offsets = {}
+        self.last = {}
+        self.committed = {}
+
+    def poll(self, timeout=1.):
+        '''
+        Next alert, or None if none arrived within timeout seconds. Broker errors are printed and skipped.
+        '''
+        msg = self.consumer.poll(timeout)
+        if msg is None:
+            return
+        if msg.error():
+            print(f'kafka: {msg.error()}')
+            return
+        key = (msg.topic(),msg.partition())
+        self.offsets[key] = msg.offset()+1
+        self.last = {key:msg.offset()}
+        return self.decode(msg.value())
+
+    def mark(self):
+        '''
+        Partition and offset of the last message returned by poll.
+        '''
+        return dict(self.last)
+
+    def position(self):
+        '''
+        Offsets after the last message of every partition returned by poll.
+        '''
+        return dict(self.offsets)
+
+    def commit(self, offsets=None):
+        '''
+        Commits the offsets a restarted consumer of the group continues from.
+
+        Parameters
+        ----------
+        offsets : dict, optional
+            Offset by (topic, partition) like position returns. The default is None which commits everything returned by poll.
+        '''
+        offsets = dict(self.offsets if offsets is None else offsets)
+        if offsets and offsets != self.committed:
+            self.consumer.commit(offsets=[self.TopicPartition(t,p,o) for (t,p),o in offsets.items()],asynchronous=True)
+            self.committed = offsets
+
+    def close(self):
+        self.consumer.close()
+
+def parse_alert(alert):
+    '''
+    Reads the object and detections of an alert. Three layouts are understood:
+
+    - prep's own, {'source', 'name', 'ra', 'dec', 'detections': [{'mjd', 'band', 'mag', 'magerr'}, ...]}, with the bands of the source (fid for 'alerce', ant_passband for 'antares').
+    - ZTF alerts as relayed by ALeRCE, with objectId, candidate and prv_candidates. Times are Julian dates and non-detections are skipped.
+    - ANTARES loci, with locus_id, ra, dec, properties['ztf_object_id'] and new_alert, or a list of alerts under alerts, whose properties hold ant_mjd, ant_mag, ant_magerr and ant_passband.
+
+    Returns
+    -------
+    source, name : str
+    ra, dec : float
+    rows : list of tuple
+        (mjd, band, mag, magerr) of every detection.
+    extra : dict
+        Other keys of the alert that are kept, e.g. the ANTARES locus_id.
+    '''
+    if 'detections' in alert:
+        if alert['source'] not in alert_columns:
+            raise ValueError(f"alerts of source {alert['source']!r} are not supported, choose from {list(alert_columns)}")
+        rows = [(d['mjd'],d['band'],d['mag'],d['magerr']) for d in alert['detections']]
+        return alert['source'], alert['name'], alert.get('ra',0.), alert.get('dec',0.), rows, {}
+    if 'objectId' in alert:
+        cands = [alert['candidate']]+list(alert.get('prv_candidates') or [])
+        rows = [(c['jd']-2400000.5,c['fid'],c['magpsf'],c['sigmapsf']) for c in cands if c.get('magpsf') is not None]
+        c = alert['candidate']
+        return 'alerce', alert['objectId'], c.get('ra',0.), c.get('dec',0.), rows, {}
+    if 'locus_id' in alert:
+        alerts = alert.get('alerts') or [alert['new_alert']]
+        props = [a.get('properties',a) for a in alerts]
+        rows = [(p['ant_mjd'],p['ant_passband'],p['ant_mag'],p['ant_magerr']) for p in props if p.get('ant_mag') is not None]
+        return 'antares', alert['properties']['ztf_object_id'], alert.get('ra',0.), alert.get('dec',0.), rows, {'locus_id':alert['locus_id']}
+    raise ValueError(f'unknown alert layout with keys {sorted(alert)}')
+
+class alert_consumer:
+
+    def __init__(self, topic, debounce=5., max_wait=60., min_points=4, max_objects=10000, cache=False, warm=True, method='minuit', post=False, channel='D041VTL9LRY', on_recommendation=None):
+        '''
+        Reacts to alerts as they arrive. Every alert updates the light curve kept for its object and schedules a refit. The refit waits until the object has been quiet for debounce seconds, so a burst of alerts leads to one fit, but never longer than max_wait after the first alert it covers. Fits run in the consuming thread with prep.auto.fit_object and each successful fit is emitted as a recommendation. The light curves are only kept in memory, so the offset of an alert is only committed once the refit it scheduled is done. A consumer restarted after a crash gets the alerts of pending refits again. Detections of objects below min_points are not held back this way, alerts that repeat the earlier detections like the ZTF and ANTARES ones restore them.
+
+        Parameters
+        ----------
+        topic : memory_topic, file_topic or kafka_topic
+            Where alerts come from.
+        debounce : float, optional
+            Seconds without a new alert of an object before it is refitted. The default is 5.
+        max_wait : float, optional
+            Longest delay of a refit in seconds, for objects that keep getting alerts. The default is 60.
+        min_points : int, optional
+            Detections an object needs before it is fitted. The default is 4.
+        max_objects : int, optional
+            Objects kept in memory, the ones without alerts for the longest are forgotten first. The default is 10000.
+        cache : bool, optional
+            Reuse stored fits of unchanged photometry, see prep.auto.fit_object. The default is False.
+        warm : bool, optional
+            Start each refit from the object's previous solution. Needs cache. The default is True.
+        method : str, optional
+            Fitting method, see prep.source.salt.fit_salt3. The default is 'minuit'.
+        post : bool, optional
+            If True, recommendations are sent to Slack through prep.outbox. The default is False.
+        channel : str, optional
+            Slack channel of the recommendations. The default is 'D041VTL9LRY'.
+        on_recommendation : callable, optional
+            Called as on_recommendation(obj, string) for every recommendation. The default is None.
+
+        Attributes
+        ----------
+        objects : OrderedDict
+            State per (source, name): position, detections by (mjd, band), refit schedule and the topic offset of the first alert the refit covers.
+        recommendations : list of tuple
+            (source, name, string) of every recommendation so far.
+        '''
+        self.topic = topic
+        self.debounce = debounce
+        self.max_wait = max_wait
+        self.min_points = min_points
+        self.max_objects = max_objects
+        self.cache = cache
+        self.warm = warm and cache
+        self.method = method
+        self.post = post
+        self.channel = channel
+        self.on_recommendation = on_recommendation
+        self.objects = OrderedDict()
+        self.recommendations = []
+        self.alerts = 0
+
+    def handle(self, alert):
+        '''
+        Adds the detections of an alert to its object and schedules a refit if anything was new.
+
+        Returns
+        -------
+        key : tuple
+            (source, name) of the object.
+        '''
+        source, name, ra, dec, rows, extra = parse_alert(alert)
+        now = time.monotonic()
+        key = (source,name)
+        state = self.objects.pop(key,None)
+        if state is None:
+            state = {'ra':ra,'dec':dec,'rows':{},'first':None,'due':None,'received':None,'mark':None}
+        state.update(extra)
+        self.objects[key] = state
+        new = 0
+        for mjd, band, mag, magerr in rows:
+            if (mjd,band) not in state['rows']:
+                state['rows'][(mjd,band)] = (mag,magerr)
+                new += 1
+        self.alerts += 1
+        get_metrics().count('alerts')
+        if new:
+            if state['first'] is None:
+                state['first'] = now
+                state['received'] = time.time()
+                state['mark'] = self.topic.mark()
+            state['due'] = min(now+self.debounce,state['first']+self.max_wait)
+        while len(self.objects) > self.max_objects:
+            oldest = next(iter(self.objects))
+            if self.objects[oldest]['due'] is not None:
+                # its alerts are only committed once it was fitted
+                self._refit(oldest)
+            self.objects.popitem(last=False)
+        return key
+
+    def lightcurve(self, key):
+        '''
+        Detections of an object in the columns of its source.
+
+        Returns
+        -------
+        lc : pd.DataFrame
+        '''
+        rows = [(mjd,mag,magerr,band) for (mjd,band),(mag,magerr) in self.objects[key]['rows'].items()]
+        return pd.DataFrame(rows,columns=alert_columns[key[0]]).sort_values(alert_columns[key[0]][0]).reset_index(drop=True)
+
+    def refit(self, key):
+        '''
+        Fits an object now and emits its recommendation if the fit succeeded.
+
+        Returns
+        -------
+        string : str or None
+            The recommendation, None if the object has too few detections or the fit failed.
+        '''
+        from prep.auto import fit_object
+        state = self.objects[key]
+        received = state['received']
+        state['first'] = state['due'] = state['received'] = None
+        if len(state['rows']) < self.min_points:
+            state['mark'] = None
+            return
+        obj = object_from_photometry(key[0],key[1],self.lightcurve(key),state['ra'],state['dec'],state.get('locus_id'))
+        string = fit_object(obj,self.cache,self.warm,None,self.method)
+        # a failed fit is not retried either, so its alerts are done with
+        state['mark'] = None
+        if string is None:
+            return
+        # from the arrival of the first alert the fit covers to the recommendation
+        get_metrics().observe('alert_to_recommendation',time.time()-received)
+        self.recommendations.append((key[0],key[1],string))
+        if self.on_recommendation is not None:
+            self.on_recommendation(obj,string)
+        if self.post:
+            from prep.outbox import get_outbox
+            get_outbox().send(string,self.channel)
+        return string
+
+    def commit(self):
+        '''
+        Commits the topic up to the first alert whose refit is still pending, or everything polled if none is.
+        '''
+        offsets = self.topic.position()
+        for s in self.objects.values():
+            for k, o in (s['mark'] or {}).items():
+                offsets[k] = min(o,offsets.get(k,o))
+        self.topic.commit(offsets)
+
+    def _refit(self, key):
+        # a refit that raises is given up, so its alerts do not stop the consumer after every restart
+        try:
+            return self.refit(key)
+        except Exception as e:
+            print(f'refit of {key[1]} failed: {type(e).__name__}: {e}')
+            state = self.objects[key]
+            state['first'] = state['due'] = state['received'] = state['mark'] = None
+
+    def due(self, now=None):
+        '''
+        Keys of the objects whose refit is due.
+        '''
+        now = time.monotonic() if now is None else now
+        return [k for k,s in self.objects.items() if s['due'] is not None and s['due'] <= now]
+
+    def run(self, max_alerts=None, idle=None, duration=None):
+        '''
+        Consumes alerts until one of the limits is reached, forever if none is given.
+
+        Parameters
+        ----------
+        max_alerts : int, optional
+            Stop after this many alerts. The default is None.
+        idle : float, optional
+            Stop once no alert arrived for this many seconds and no refit is pending. The default is None.
+        duration : float, optional
+            Stop after this many seconds. The default is None.
+
+        Refits that are still pending when a limit is reached run before returning. A refit that raises is printed and skipped.
+
+        Returns
+        -------
+        n : int
+            Number of recommendations emitted.
+        '''
+        start = time.monotonic()
+        last = start
+        n = len(self.recommendations)
+        handled = 0
+        try:
+            while True:
+                now = time.monotonic()
+                if duration is not None and now-start >= duration:
+                    break
+                if max_alerts is not None and handled >= max_alerts:
+                    break
+                pending = [s['due'] for s in self.objects.values() if s['due'] is not None]
+                if idle is not None and not pending and now-last >= idle:
+                    break
+                # wakes up in time for the next refit
+                timeout = min([1.]+[max(0.,d-now) for d in pending])
+                alert = self.topic.poll(timeout)
+                if alert is not None:
+                    last = time.monotonic()
+                    handled += 1
+                    try:
+                        self.handle(alert)
+                    except (KeyError,TypeError,ValueError) as e:
+                        print(f'skipped alert: {type(e).__name__}: {e}')
+                for key in self.due():
+                    self._refit(key)
+                self.commit()
+            for key in [k for k,s in self.objects.items() if s['due'] is not None]:
+                self._refit(key)
+        finally:
+            self.commit()
+        return len(self.recommendations)-n
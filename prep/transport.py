@@ -0,0 +1,261 @@
+import io
+import json
+import gzip
+import time
+import base64
+import hashlib
+import threading
+from functools import lru_cache
+from collections import deque
+
+# response headers that describe the encoding on the wire, not the stored body
+_wire_headers = {'content-encoding','content-length','transfer-encoding','connection','keep-alive'}
+
+class transport:
+
+    def __init__(self, mode='live', path=None, latency=None):
+        '''
+        Decides where the HTTP requests to ALeRCE, ANTARES, YSE-PZ and Slack go. Every client prep uses is put under the transport with install, which wraps the connection layer of its session, so the query, download and post code is the same in every mode.
+
+        Parameters
+        ----------
+        mode : str, optional
+            'live' sends requests as usual. 'record' also writes every response to the archive at path. 'replay' answers every request from that archive without any network access. The default is 'live'.
+        path : str, optional
+            Archive, a gzipped file with one JSON response per line. Needed for 'record' and 'replay'. Recording appends to an existing archive.
+        latency : float or str, optional
+            Only for 'replay'. Seconds to wait before every response, or 'recorded' to wait as long as the original request took. The default is None which replays at full speed.
+
+        Attributes
+        ----------
+        stats : dict
+            Number of responses recorded, replayed by exact request, replayed by order within their service and path and requests that had no recorded response.
+        '''
+        if mode not in ['live','record','replay']:
+            raise ValueError(f"unknown transport mode {mode!r}, choose from 'live', 'record', 'replay'")
+        if mode != 'live' and path is None:
+            raise ValueError(f'transport mode {mode!r} needs an archive path')
+        self.mode = mode
+        self.path = path
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.stats = dict.fromkeys(['recorded','exact','ordered','missing'],0)
+        self._file = None
+        if mode == 'record':
+            self._file = gzip.open(path,'at')
+        elif mode == 'replay':
+            self._load()
+
+    def _load(self):
+        with gzip.open(self.path,'rt') as f:
+            self.records = [json.loads(line) for line in f if line.strip()]
+        self.used = [False]*len(self.records)
+        self.by_key, self.by_endpoint = {}, {}
+        for i, r in enumerate(self.records):
+            self.by_key.setdefault(request_key(r['service'],r['method'],r['url'],r['body']),deque()).append(i)
+            self.by_endpoint.setdefault(endpoint_key(r['service'],r['method'],r['url']),deque()).append(i)
+
+    def record(self, service, method, url, body, status, reason, headers, content, elapsed):
+        '''
+        Appends a response to the archive.
+        '''
+        rec = {'service':service,'method':method,'url':url,'body':body_hash(body),'status':status,'reason':reason,
+               'headers':{k:v for k,v in headers.items() if k.lower() not in _wire_headers},'elapsed':elapsed}
+        try:
+            rec['text'] = content.decode('utf-8')
+        except UnicodeDecodeError:
+            rec['data'] = base64.b64encode(content).decode('ascii')
+        with self.lock:
+            self._file.write(json.dumps(rec)+'\n')
+            self.stats['recorded'] += 1
+
+    def replay(self, service, method, url, body):
+        '''
+        Finds the recorded response of a request. A request is answered by the first unused response to the same method, URL and body. Requests whose query string or body changed since recording, e.g. a query with a time window that ends now, get the first unused response to the same path of their service instead, so a night replays in the order it was recorded.
+
+        Returns
+        -------
+        record : dict or None
+            Status, reason, headers, content and elapsed time of the response, None if the archive has none left.
+        '''
+        with self.lock:
+            i = self._take(self.by_key.get(request_key(service,method,url,body_hash(body))))
+            how = 'exact'
+            if i is None:
+                i = self._take(self.by_endpoint.get(endpoint_key(service,method,url)))
+                how = 'ordered'
+            if i is None:
+                self.stats['missing'] += 1
+                return
+            self.stats[how] += 1
+        r = dict(self.records[i])
+        r['content'] = r['text'].encode('utf-8') if 'text' in r else base64.b64decode(r['data'])
+        delay = r['elapsed'] if self.latency == 'recorded' else self.latency
+        if delay:
+            time.sleep(delay)
+        return r
+
+    def _take(self, queue):
+        # called with the lock held
+        while queue:
+            i = queue.popleft()
+            if not self.used[i]:
+                self.used[i] = True
+                return i
+
+    def close(self):
+        '''
+        Flushes and closes the archive.
+        '''
+        with self.lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def body_hash(body):
+    '''
+    Short digest of a request body, None for requests without one.
+    '''
+    if body is None or body == b'' or body == '':
+        return None
+    if isinstance(body,str):
+        body = body.encode('utf-8')
+    return hashlib.sha1(body).hexdigest()
+
+def request_key(service, method, url, body):
+    return (service,method.upper(),url,body)
+
+def endpoint_key(service, method, url):
+    return (service,method.upper(),url.split('?')[0])
+
+_transport = transport()
+
+def get_transport():
+    '''
+    Returns the transport of this process, 'live' unless set_transport was called.
+    '''
+    return _transport
+
+def set_transport(mode='live', path=None, latency=None):
+    '''
+    Switches every installed client to a new transport, closing the previous one. See transport for the parameters.
+
+    Returns
+    -------
+    transport : transport
+    '''
+    global _transport
+    _transport.close()
+    _transport = transport(mode,path,latency)
+    return _transport
+
+@lru_cache(None)
+def _requests_adapter():
+    from requests.adapters import BaseAdapter
+    from requests.models import Response
+    from requests.structures import CaseInsensitiveDict
+    from requests.utils import get_encoding_from_headers
+    from requests.exceptions import ConnectionError
+
+    class replay_adapter(BaseAdapter):
+        # wraps the adapter a session had mounted
+
+        def __init__(self, inner, service):
+            super().__init__()
+            self.inner = inner
+            self.service = service
+
+        def send(self, request, **kwargs):
+            t = get_transport()
+            if t.mode == 'replay':
+                rec = t.replay(self.service,request.method,request.url,request.body)
+                if rec is None:
+                    raise ConnectionError(f'no recorded {self.service} response for {request.method} {request.url}',request=request)
+                r = Response()
+                r.status_code = rec['status']
+                r.reason = rec['reason']
+                r.headers = CaseInsensitiveDict(rec['headers'])
+                r.headers['Content-Length'] = str(len(rec['content']))
+                r._content = rec['content']
+                # the body is already read, so iter_content, iter_lines and close work on streamed requests too
+                r._content_consumed = True
+                r.raw = io.BytesIO(rec['content'])
+                r.encoding = get_encoding_from_headers(r.headers)
+                r.url = request.url
+                r.request = request
+                r.connection = self
+                return r
+            start = time.monotonic()
+            r = self.inner.send(request,**kwargs)
+            if t.mode == 'record':
+                # reads streamed bodies too, they stay available through r.content
+                t.record(self.service,request.method,request.url,request.body,r.status_code,r.reason,
+                         r.headers,r.content,time.monotonic()-start)
+            return r
+
+        def close(self):
+            self.inner.close()
+
+    return replay_adapter
+
+@lru_cache(None)
+def _httpx_transport():
+    import httpx
+
+    class replay_transport(httpx.BaseTransport):
+        # wraps the transport of an httpx.Client
+
+        def __init__(self, inner, service):
+            self.inner = inner
+            self.service = service
+
+        def handle_request(self, request):
+            t = get_transport()
+            body = request.read()
+            if t.mode == 'replay':
+                rec = t.replay(self.service,request.method,str(request.url),body)
+                if rec is None:
+                    raise httpx.ConnectError(f'no recorded {self.service} response for {request.method} {request.url}',request=request)
+                return httpx.Response(rec['status'],headers=rec['headers'],content=rec['content'],request=request)
+            start = time.monotonic()
+            r = self.inner.handle_request(request)
+            if t.mode == 'record':
+                r.read()
+                t.record(self.service,request.method,str(request.url),body,r.status_code,r.reason_phrase,
+                         dict(r.headers),r.content,time.monotonic()-start)
+                # the body was decoded by read, so it goes back without its wire encoding
+                headers = [(k,v) for k,v in r.headers.items() if k.lower() not in _wire_headers]
+                return httpx.Response(r.status_code,headers=headers,content=r.content,request=request,extensions=r.extensions)
+            return r
+
+        def close(self):
+            self.inner.close()
+
+    return replay_transport
+
+def install(client, service):
+    '''
+    Puts a requests.Session or httpx.Client under the transport of the process, whichever transport is set later. Installing a client twice does nothing.
+
+    Parameters
+    ----------
+    client : requests.Session or httpx.Client
+        HTTP client of a service.
+    service : str
+        Name the responses are archived under, e.g. 'alerce'.
+    '''
+    if getattr(client,'_prep_transport',False):
+        return
+    if hasattr(client,'_transport'):
+        client._transport = _httpx_transport()(client._transport,service)
+    else:
+        adapter = _requests_adapter()
+        for prefix, inner in list(client.adapters.items()):
+            client.mount(prefix,adapter(inner,service))
+    client._prep_transport = True
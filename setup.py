@@ -8,5 +8,5 @@ setup(
       "write_to": "prep/version.py",
       "write_to_template": "__version__ = '{version}'",
     },
-    entry_points=dict(console_scripts=['auto-prep=prep.auto:main'])
+    entry_points=dict(console_scripts=['auto-prep=prep.cli:main'])
 )
\ No newline at end of file
@@ -0,0 +1,110 @@
+import os
+import pytest
+import prep.auto
+from prep import stream
+
+class crash(BaseException):
+    # stands in for the process dying during a fit, past the consumer's own error handling
+    pass
+
+def alert(name, mjd, source='alerce'):
+    return {'source':source,'name':name,'ra':10.,'dec':-5.,'detections':[{'mjd':mjd,'band':1,'mag':19.,'magerr':0.1}]}
+
+class fit_log(list):
+
+    def __init__(self):
+        super().__init__()
+        self.crash_on = set()
+
+@pytest.fixture
+def fits(monkeypatch):
+    # names of the fitted objects, a fit of a name in crash_on dies
+    fits = fit_log()
+    def fit_object(obj, *args):
+        fits.append(obj.name)
+        if obj.name in fits.crash_on:
+            raise crash(obj.name)
+        return f'rec {obj.name}'
+    monkeypatch.setattr(prep.auto,'fit_object',fit_object)
+    return fits
+
+def test_burst_gives_one_fit(fits):
+    topic = stream.memory_topic()
+    for i in range(5):
+        topic.publish(alert('ZTF1',60000.+i))
+    consumer = stream.alert_consumer(topic,debounce=0.2,min_points=4)
+    assert consumer.run(idle=0.5) == 1
+    assert fits == ['ZTF1']
+    assert len(consumer.objects[('alerce','ZTF1')]['rows']) == 5
+
+def test_malformed_alerts_are_skipped(fits, capsys):
+    topic = stream.memory_topic()
+    topic.publish({'bad':1})
+    topic.publish(alert('2024abc',60000.,source='yse'))
+    topic.publish({'source':'alerce','name':'ZTF2'})
+    topic.publish(alert('ZTF1',60000.))
+    consumer = stream.alert_consumer(topic,debounce=0.1,min_points=1)
+    assert consumer.run(idle=0.5) == 1
+    assert fits == ['ZTF1']
+    assert capsys.readouterr().out.count('skipped alert') == 3
+
+def test_parse_alert_layouts():
+    ztf = {'objectId':'ZTF1','candidate':{'jd':2460000.5,'fid':1,'magpsf':19.,'sigmapsf':0.1,'ra':1.,'dec':2.},
+           'prv_candidates':[{'jd':2459999.5,'fid':2,'magpsf':19.5,'sigmapsf':0.1},{'jd':2459998.5,'fid':1,'magpsf':None,'sigmapsf':None}]}
+    source, name, ra, dec, rows, extra = stream.parse_alert(ztf)
+    assert (source,name,ra,dec) == ('alerce','ZTF1',1.,2.)
+    assert rows == [(60000.,1,19.,0.1),(59999.,2,19.5,0.1)]
+    locus = {'locus_id':'ANT1','ra':1.,'dec':2.,'properties':{'ztf_object_id':'ZTF1'},
+             'new_alert':{'properties':{'ant_mjd':60000.,'ant_mag':19.,'ant_magerr':0.1,'ant_passband':'g'}}}
+    assert stream.parse_alert(locus)[4:] == ([(60000.,'g',19.,0.1)],{'locus_id':'ANT1'})
+    with pytest.raises(ValueError):
+        stream.parse_alert(alert('2024abc',60000.,source='yse'))
+
+def test_offset_committed_only_after_refit(fits, tmp_path):
+    path = str(tmp_path/'alerts.jsonl')
+    topic = stream.file_topic(path)
+    for i in range(3):
+        topic.publish(alert('ZTF1',60000.+i))
+    start = os.path.getsize(path)
+    for i in range(2):
+        topic.publish(alert('ZTF2',60000.+i))
+    fits.crash_on.add('ZTF2')
+    consumer = stream.alert_consumer(topic,debounce=0.2,min_points=1)
+    with pytest.raises(crash):
+        consumer.run()
+    topic.close()
+    assert fits == ['ZTF1','ZTF2']
+    # ZTF1 was fitted, the alerts of ZTF2 stay uncommitted
+    with open(path+'.offset') as f:
+        assert int(f.read()) == start
+
+def test_pending_refits_replay_after_restart(fits, tmp_path):
+    path = str(tmp_path/'alerts.jsonl')
+    topic = stream.file_topic(path)
+    for i in range(3):
+        topic.publish(alert('ZTF1',60000.+i))
+    fits.crash_on.add('ZTF1')
+    with pytest.raises(crash):
+        stream.alert_consumer(topic,debounce=0.1,min_points=1).run()
+    topic.close()
+    fits.crash_on.clear()
+    topic = stream.file_topic(path)
+    consumer = stream.alert_consumer(topic,debounce=0.1,min_points=1)
+    assert consumer.run(idle=0.3) == 1
+    topic.close()
+    assert fits == ['ZTF1','ZTF1']
+    assert consumer.alerts == 3
+    with open(path+'.offset') as f:
+        assert int(f.read()) == os.path.getsize(path)
+    # nothing left once everything was committed
+    assert stream.file_topic(path).poll(0.1) is None
+
+def test_failing_refit_does_not_stop_the_consumer(fits, capsys):
+    topic = stream.memory_topic()
+    topic.publish(alert('ZTF1',60000.))
+    def callback(obj, string):
+        raise RuntimeError('callback')
+    consumer = stream.alert_consumer(topic,debounce=0.1,min_points=1,on_recommendation=callback)
+    consumer.run(idle=0.3)
+    assert 'refit of ZTF1 failed' in capsys.readouterr().out
+    assert consumer.objects[('alerce','ZTF1')]['mark'] is None